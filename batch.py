@@ -0,0 +1,135 @@
+"""Đối soát hàng loạt không cần giao diện.
+
+    python batch.py manifest.json --out ket_qua --workers 4
+    python batch.py manifest.csv --format xlsx
+
+Manifest là danh sách job, mỗi job 1 cặp Đơn Hàng / Phiếu Xuất:
+    JSON: [{"name": "CN1", "dh": "cn1/don_hang.xlsx", "px": "cn1/phieu_xuat.xlsx", "config": "cn1.json"}, ...]
+    CSV : cột name, dh, px, config (config, name, engine có thể bỏ trống)
+dh / px nhận giống ô nhập trên giao diện: 1 file, 1 thư mục hoặc nhiều file ngăn bởi ';'.
+Đường dẫn tương đối tính từ thư mục chứa manifest. Không có config thì dùng config_system.json hiện tại.
+
+Mỗi job ghi Tab 1/2/3 ra <out>/<name>/; tổng kết ghi ra <out>/summary.json.
+Mã thoát 0 nếu mọi job chạy được, 1 nếu có job lỗi.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from check_core import CONFIG_FILE, ConfigManager, DataProcessor, export_workbook, processor_details
+
+OUT_DIR = "batch_output"
+SHEETS = (("tab1", "TongHop"), ("tab2", "ChiTiet"), ("tab3", "NgoaiLe"))
+
+def load_manifest(path):
+    """Đọc manifest (.json / .csv) -> danh sách job với đường dẫn tuyệt đối và tên không trùng."""
+    base = os.path.dirname(os.path.abspath(path))
+    if path.lower().endswith(".csv"):
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            jobs = [{k.strip(): (v or "").strip() for k, v in row.items() if k} for row in csv.DictReader(f)]
+    else:
+        with open(path, encoding="utf-8") as f:
+            jobs = json.load(f)
+        if isinstance(jobs, dict): jobs = jobs.get("jobs", [])
+
+    absolute = lambda p: os.path.normpath(os.path.join(base, p.strip())) if p.strip() else ""
+    seen = Counter()
+    out = []
+    for i, job in enumerate(jobs, 1):
+        if not job.get("dh") or not job.get("px"):
+            raise ValueError(f"Job {i}: thiếu dh hoặc px")
+        name = job.get("name") or os.path.splitext(os.path.basename(job["dh"].split(";")[0].strip().rstrip("/\\")))[0]
+        seen[name] += 1
+        if seen[name] > 1: name = f"{name}_{seen[name]}"
+        out.append({
+            "name": name,
+            "dh": "; ".join(absolute(p) for p in job["dh"].split(";") if p.strip()),
+            "px": "; ".join(absolute(p) for p in job["px"].split(";") if p.strip()),
+            "config": absolute(job["config"]) if job.get("config") else "",
+            "engine": job.get("engine") or None,
+        })
+    return out
+
+def write_results(p, folder, fmt="csv"):
+    os.makedirs(folder, exist_ok=True)
+    if fmt == "xlsx": # cùng bố cục với nút XUẤT EXCEL: Tab 1/2/3 + chi tiết 2 bên, giữ màu trạng thái
+        orders, exports = processor_details(p.res_tab1, p.detail_map)
+        export_workbook(os.path.join(folder, "ket_qua.xlsx"), p.res_tab1, p.res_tab2, p.res_tab3, orders, exports)
+    else:
+        frames = {"tab1": pd.DataFrame(p.res_tab1), "tab2": pd.DataFrame(p.res_tab2), "tab3": pd.DataFrame(p.res_tab3).drop(columns="Samples", errors="ignore")}
+        for key, _ in SHEETS:
+            frames[key].to_csv(os.path.join(folder, f"{key}.csv"), index=False, encoding="utf-8-sig") # utf-8-sig: Excel mở đúng tiếng Việt
+
+def run_job(job, out_dir, fmt="csv"):
+    """Chạy trong process con: 1 lần run_analysis + ghi kết quả. Không ném lỗi ra ngoài, lỗi trả về trong dict."""
+    t0 = time.perf_counter()
+    res = {"name": job["name"], "ok": False, "msg": ""}
+    try:
+        if job["config"] and not os.path.exists(job["config"]):
+            raise FileNotFoundError(f"Không thấy file cấu hình: {job['config']}")
+        cfg = ConfigManager(job["config"] or CONFIG_FILE)
+        cfg.data["paths"] = {"dh": job["dh"], "px": job["px"]}
+        cfg.data["read_workers"] = 1 # đã song song theo job, không mở thêm pool đọc file bên trong
+        p = DataProcessor(cfg)
+        ok, msg = p.run_analysis(job["engine"])
+        res.update(ok=ok, msg=msg)
+        if ok:
+            folder = os.path.join(out_dir, job["name"])
+            write_results(p, folder, fmt)
+            res.update(out=folder, tab1=len(p.res_tab1), tab2=len(p.res_tab2), tab3=sum(r["Số dòng"] for r in p.res_tab3),
+                       tags=dict(Counter(r["Tag"] for r in p.res_tab1)),
+                       phases={k: round(v["sec"], 4) for k, v in p.stats.phases.items()})
+    except Exception as e:
+        res["msg"] = f"{type(e).__name__}: {e}"
+    res["sec"] = round(time.perf_counter() - t0, 3)
+    return res
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Đối soát hàng loạt Đơn Hàng / Phiếu Xuất theo manifest")
+    ap.add_argument("manifest", help="file .json hoặc .csv liệt kê các job")
+    ap.add_argument("--out", default=OUT_DIR, help="thư mục ghi kết quả")
+    ap.add_argument("--workers", type=int, default=0, help="số process chạy song song (0 = theo số CPU)")
+    ap.add_argument("--format", choices=("csv", "xlsx"), default="csv")
+    args = ap.parse_args(argv)
+
+    try:
+        jobs = load_manifest(args.manifest)
+    except Exception as e:
+        print(f"Lỗi đọc manifest: {e}", file=sys.stderr)
+        return 2
+    if not jobs:
+        print("Manifest không có job nào.")
+        return 0
+
+    os.makedirs(args.out, exist_ok=True)
+    workers = min(len(jobs), args.workers or os.cpu_count() or 1)
+    t0 = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_job, job, args.out, args.format) for job in jobs]
+        for fut in as_completed(futures):
+            r = fut.result()
+            results.append(r)
+            if r["ok"]:
+                errs = sum(n for tag, n in r["tags"].items() if tag in ("do", "vang", "tim"))
+                print(f"[OK]   {r['name']}: {r['tab1']:,} dòng tổng hợp, {errs:,} dòng lệch, {r['tab3']:,} ngoại lệ ({r['sec']:.1f}s)")
+            else:
+                print(f"[LỖI]  {r['name']}: {r['msg']}")
+
+    order = {job["name"]: i for i, job in enumerate(jobs)}
+    results.sort(key=lambda r: order[r["name"]])
+    failed = [r for r in results if not r["ok"]]
+    with open(os.path.join(args.out, "summary.json"), "w", encoding="utf-8") as f:
+        json.dump({"jobs": results, "failed": len(failed), "sec": round(time.perf_counter() - t0, 3)}, f, ensure_ascii=False, indent=1)
+    print(f"Xong {len(results) - len(failed)}/{len(results)} job trong {time.perf_counter() - t0:.1f}s. Kết quả: {args.out}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,276 @@
+"""Benchmark đối soát Đơn Hàng / Phiếu Xuất trên dữ liệu giả lập.
+
+    python bench.py                          # 1k, 10k, 100k dòng
+    python bench.py --sizes 1000,1000000     # tới 1 triệu dòng (lần đầu sinh file khá lâu)
+    python bench.py --compare bench_results/20261017_103000.json
+
+Mỗi cỡ dữ liệu chạy trong 1 process riêng để số đo RAM đỉnh không bị lẫn giữa các cỡ.
+Kết quả ghi ra bench_results/<thời điểm>.json để so sánh giữa các phiên bản.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import types
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import check2 # chỉ dùng phần lọc / định dạng dòng của MainApp
+from check_core import SYSTEM_COLS, ConfigManager, DataProcessor, RunStats, peak_memory_mb
+
+BENCH_DIR = "bench_data" # File Excel sinh ra (dùng lại giữa các lần chạy)
+RESULT_DIR = "bench_results"
+TOLERANCE = {"kg_min": -0.5, "kg_max": 0.5, "bag_diff": 0}
+
+# Gom các bước của RunStats thành nhóm để so sánh
+GROUPS = {
+    "read": ["Đọc file"],
+    "aggregate": ["Đơn hàng", "Phiếu xuất"],
+    "status": ["Tab 1", "Tab 2", "Chi tiết"],
+}
+
+# =============================================================================
+# SINH DỮ LIỆU
+# =============================================================================
+
+def _variants(codes, rng, lower=0.03, spaces=0.02):
+    # Cùng 1 mã nhưng gõ khác nhau: chữ thường, thừa khoảng trắng
+    r = rng.random(len(codes))
+    return np.where(r < lower, np.char.lower(codes.astype(str)),
+                    np.where(r < lower + spaces, np.char.add(codes.astype(str), "  "), codes)).astype(object)
+
+def _key_text(cust, rng):
+    # Ô mã khách như người nhập: "ST00012", "ST00012 - Cửa hàng 12", " st00012 "
+    r = rng.random(len(cust))
+    out = cust.astype(object).copy()
+    m = r < 0.4
+    out[m] = [f"{c} - Cửa hàng {c[2:].lstrip('0')}" for c in cust[m]]
+    m = (r >= 0.4) & (r < 0.45)
+    out[m] = [f" {c.lower()} " for c in cust[m]]
+    return out
+
+def generate(n, seed=0):
+    """n dòng Đơn Hàng + Phiếu Xuất tương ứng (theo bố cục SYSTEM_COLS) và cấu hình đi kèm.
+    Có: mã ST/DC/KH, hàng túi lẫn hàng kg, mã cũ (alias), khách không rõ mã, đơn gộp, xuất thiếu/thừa/sai mã."""
+    rng = np.random.default_rng(seed)
+    n_cust = max(20, n // 40)
+    n_item = min(5000, max(50, n // 100))
+    prefix = rng.choice(["ST", "DC", "KH"], n_cust)
+    cust = np.array([f"{p}{i:05d}" for i, p in enumerate(prefix)])
+    items = np.array([f"MH{i:04d}" for i in range(n_item)])
+    is_bag = rng.random(n_item) < 0.15
+    names = np.array([("Túi " if b else "Hàng ") + f"số {i}" for i, b in enumerate(is_bag)], dtype=object)
+    has_alias = np.zeros(n_item, dtype=bool)
+    has_alias[rng.choice(n_item, max(3, n_item // 20), replace=False)] = True
+    alias_map = {f"{items[i]}-CU": items[i] for i in np.flatnonzero(has_alias)} # mã cũ -> mã mới
+
+    def item_text(it):
+        codes = items[it].astype(object)
+        old = has_alias[it] & (rng.random(len(it)) < 0.3)
+        codes[old] = np.char.add(items[it[old]], "-CU")
+        return _variants(codes, rng)
+
+    def qty(it, kg, bag):
+        return np.where(is_bag[it], bag, kg)
+
+    # --- ĐƠN HÀNG: ~8 dòng / đơn; 5% dòng lặp lại (khách, mã hàng) của dòng khác -> đơn gộp ---
+    c = rng.integers(0, n_cust, n)
+    it = rng.integers(0, n_item, n)
+    dup = rng.random(n) < 0.05
+    src = rng.integers(0, n, n)
+    c[dup], it[dup] = c[src[dup]], it[src[dup]]
+    sl = qty(it, np.round(rng.gamma(2.0, 5.0, n) + 0.1, 2), rng.integers(1, 20, n).astype(float))
+
+    code_txt = _key_text(cust[c], rng)
+    unknown = rng.random(n) < 0.02
+    code_txt[unknown] = rng.choice(np.array(["Khách lẻ", "Chưa rõ", None], dtype=object), unknown.sum())
+    sl_txt = np.array([f"{v:g}" for v in sl], dtype=object)
+    sl_txt[rng.random(n) < 0.003] = "abc" # ô số lượng gõ sai
+
+    dh = pd.DataFrame({
+        SYSTEM_COLS["dh_code"]: code_txt,
+        SYSTEM_COLS["dh_item"]: item_text(it),
+        SYSTEM_COLS["dh_name"]: names[it],
+        SYSTEM_COLS["dh_sl"]: sl_txt,
+        SYSTEM_COLS["dh_so"]: np.char.add("DH", (np.arange(n) // 8).astype(str)),
+        SYSTEM_COLS["dh_note"]: np.where(rng.random(n) < 0.05, "Giao sáng", None),
+    })
+
+    # --- PHIẾU XUẤT: theo tổng đặt của từng (khách, mã hàng) ---
+    known = ~unknown
+    g = pd.DataFrame({"c": c[known], "it": it[known], "sl": sl[known]}).groupby(["c", "it"], sort=False)["sl"].sum().reset_index()
+    gc, git, total = g["c"].to_numpy(), g["it"].to_numpy(), g["sl"].to_numpy()
+    m = len(g)
+    bag = is_bag[git]
+    # đủ / lệch trong dung sai / thiếu / thừa / không xuất
+    outcome = rng.choice(5, m, p=[0.80, 0.08, 0.05, 0.04, 0.03])
+    delta = np.select(
+        [outcome == 1, outcome == 2, outcome == 3],
+        [np.where(bag, 0, rng.uniform(-0.3, 0.3, m)),
+         -np.where(bag, rng.integers(1, 4, m), rng.uniform(1, 5, m)),
+         np.where(bag, rng.integers(1, 4, m), rng.uniform(1, 5, m))], 0.0)
+    out = np.maximum(np.round(total + delta, 2), 0)
+    keep = outcome != 4
+    gc, git, out, bag = gc[keep], git[keep], out[keep], bag[keep]
+
+    # 30% nhóm xuất làm 2 phiếu
+    split = rng.random(len(out)) < 0.3
+    part = np.where(bag, np.floor(out / 2), np.round(out / 2, 2))
+    lines_c = np.concatenate([gc, gc[split]])
+    lines_it = np.concatenate([git, git[split]])
+    lines_q = np.concatenate([np.where(split, out - part, out), part[split]])
+
+    # 2% dòng xuất cho (khách, mã hàng) không có trong đơn -> sai mã / không đặt
+    k = max(1, len(lines_q) // 50)
+    lines_c = np.concatenate([lines_c, rng.integers(0, n_cust, k)])
+    lines_it = np.concatenate([lines_it, rng.integers(0, n_item, k)])
+    lines_q = np.concatenate([lines_q, np.round(rng.uniform(1, 10, k), 2)])
+
+    order = rng.permutation(len(lines_q))
+    lc, li, lq = lines_c[order], lines_it[order], lines_q[order]
+    lbag = is_bag[li]
+    p = len(lq)
+    px = pd.DataFrame({
+        SYSTEM_COLS["px_code"]: _key_text(cust[lc], rng),
+        SYSTEM_COLS["px_item"]: item_text(li),
+        SYSTEM_COLS["px_name"]: names[li],
+        SYSTEM_COLS["px_sl_xuat"]: [f"{v:g}" for v in np.where(lbag, np.round(lq * 0.5, 2), lq)], # hàng túi vẫn có kg
+        SYSTEM_COLS["px_sl_tui"]: np.where(lbag, [f"{v:g}" for v in lq], None),
+        SYSTEM_COLS["px_so"]: np.char.add("PX", (np.arange(p) // 10).astype(str)),
+    })
+    settings = {"bag_items": sorted(items[is_bag].tolist()), "alias_map": alias_map, "tolerance": dict(TOLERANCE)}
+    return dh, px, settings
+
+def write_inputs(n, seed=0, directory=BENCH_DIR):
+    """Sinh file Excel cho cỡ n nếu chưa có; trả về (đường dẫn đơn hàng, phiếu xuất, file cấu hình)."""
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, f"{n}_{seed}")
+    paths = (base + "_dh.xlsx", base + "_px.xlsx", base + "_settings.json")
+    if all(os.path.exists(p) for p in paths): return paths
+    dh, px, settings = generate(n, seed)
+    dh.to_excel(paths[0], index=False)
+    px.to_excel(paths[1], index=False)
+    with open(paths[2], "w", encoding="utf-8") as f:
+        json.dump(settings, f, ensure_ascii=False, indent=1)
+    return paths
+
+# =============================================================================
+# ĐO
+# =============================================================================
+
+def bench_one(n, seed=0, engine="vector", cache=False, stream=False, directory=BENCH_DIR):
+    """Chạy 1 lần đối soát + dựng giao diện (không cần màn hình) cho cỡ n; trả về dict số đo."""
+    dh_path, px_path, settings_path = write_inputs(n, seed, directory)
+    with open(settings_path, encoding="utf-8") as f:
+        settings = json.load(f)
+
+    cfg = ConfigManager()
+    cfg.save = lambda: None # không đụng config_system.json của người dùng
+    cfg.data.update(settings)
+    cfg.data.update({"paths": {"dh": dh_path, "px": px_path}, "col_map": {}, "engine": engine,
+                     "cache": dict(cfg.data["cache"], enabled=cache),
+                     "stream": dict(cfg.data["stream"], enabled=stream),
+                     "perf": {"log": False, "profile": False}})
+
+    p = DataProcessor(cfg)
+    ok, msg = p.run_analysis()
+    stats = p.stats
+
+    # Phần giao diện của on_search / export_excel: chỉ mục tìm kiếm, lọc, định dạng dòng
+    check2.load_core()
+    ui = types.SimpleNamespace(processor=p, search_idx=None, changed=set(), sort_state={1: (None, False), 2: (None, False), 3: (None, False)})
+    ui.key_display = lambda r: check2.MainApp.key_display(ui, r)
+    ui_stats = RunStats()
+    if ok:
+        ui_stats.mark("Chỉ mục", len(p.res_tab1) + len(p.res_tab2) + len(p.res_tab3))
+        check2.MainApp.build_search_index(ui)
+        ui_stats.mark("Lọc")
+        views = {t: check2.MainApp.filtered_ids(ui, t, "", False) for t in (1, 2, 3)}
+        for t in (1, 2):
+            check2.MainApp.filtered_ids(ui, t, "MH00", True)
+        ui_stats.mark("Định dạng", len(views[1]) + len(views[2]))
+        for r in check2.RowView(p.res_tab1, views[1]): check2.MainApp.fmt_tab1(ui, r)
+        for r in check2.RowView(p.res_tab2, views[2]): check2.MainApp.fmt_tab2(ui, r)
+        ui_stats.mark(None)
+
+    phases = {k: v["sec"] for k, v in stats.phases.items()}
+    res = {"rows": n, "ok": ok, "msg": msg,
+           "tab1": len(p.res_tab1), "tab2": len(p.res_tab2), "tab3": len(p.res_tab3)}
+    for name, parts in GROUPS.items():
+        res[name] = round(sum(phases.get(x, 0.0) for x in parts), 4)
+    res["render"] = round(ui_stats.total(), 4)
+    res["total"] = round(stats.total() + ui_stats.total(), 4)
+    res["peak_mb"] = peak_memory_mb()
+    res["phases"] = {k: round(v, 4) for k, v in phases.items()}
+    res["phases"].update({k: round(v["sec"], 4) for k, v in ui_stats.phases.items()})
+    return res
+
+def git_version():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return ""
+
+def print_table(results, baseline=None):
+    cols = ["read", "aggregate", "status", "render", "total", "peak_mb"]
+    old = {r["rows"]: r for r in (baseline or {}).get("results", [])}
+    print(f"{'rows':>9} " + " ".join(f"{c:>16}" for c in cols))
+    for r in results:
+        cells = []
+        for c in cols:
+            v = r.get(c)
+            cell = "-" if v is None else f"{v:.0f}" if c == "peak_mb" else f"{v:.3f}"
+            b = old.get(r["rows"], {}).get(c)
+            if b and v is not None: cell += f" (x{v / b:.2f})" # so với bản cũ: <1 là nhanh hơn
+            cells.append(f"{cell:>16}")
+        print(f"{r['rows']:>9} " + " ".join(cells))
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark đối soát trên dữ liệu giả lập")
+    ap.add_argument("--sizes", default="1000,10000,100000", help="các cỡ số dòng Đơn Hàng, ngăn bởi dấu phẩy")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--engine", choices=DataProcessor.ENGINES, default="vector")
+    ap.add_argument("--cache", action="store_true", help="cho phép dùng cache file Excel (mặc định tắt để đo cả bước đọc)")
+    ap.add_argument("--stream", action="store_true", help="đọc file theo khối")
+    ap.add_argument("--data-dir", default=BENCH_DIR)
+    ap.add_argument("--out", default=RESULT_DIR)
+    ap.add_argument("--compare", help="file kết quả cũ để so sánh")
+    args = ap.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    for n in sizes:
+        print(f"Chuẩn bị dữ liệu {n:,} dòng...")
+        write_inputs(n, args.seed, args.data_dir)
+
+    results = []
+    for n in sizes:
+        # process mới (spawn) cho mỗi cỡ: không kế thừa bộ nhớ của process sinh dữ liệu
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            r = pool.submit(bench_one, n, args.seed, args.engine, args.cache, args.stream, args.data_dir).result()
+        if not r["ok"]: print(f"{n:,} dòng: {r['msg']}")
+        results.append(r)
+
+    report = {"time": datetime.now().isoformat(timespec="seconds"), "version": git_version(),
+              "python": platform.python_version(), "pandas": pd.__version__,
+              "engine": args.engine, "cache": args.cache, "stream": args.stream, "seed": args.seed,
+              "results": results}
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, f"{datetime.now():%Y%m%d_%H%M%S}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_table(results, baseline)
+    print(f"Đã ghi {path}")
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,48 @@
-    import tkinter as tk
+import time
+APP_START = time.perf_counter() # mốc đo thời gian khởi động
+
+import tkinter as tk
 from tkinter import filedialog, messagebox, ttk, simpledialog
-import pandas as pd
-import json
 import os
-import re
 import unicodedata
-import hashlib
 import threading
 from datetime import datetime
 
+from check_config import ConfigManager
+
+# Phần xử lý dữ liệu (không phụ thuộc tkinter) nằm trong check_core.py - dùng chung với chạy hàng loạt (batch.py).
+# check_core kéo theo pandas / NumPy / engine Excel (mất vài giây) nên được nạp ở luồng nền sau khi cửa sổ đã hiện.
+pd = np = None
+DataProcessor = AnalysisJob = SearchIndex = SortOrders = ResultStore = FileWatcher = AliasSuggester = None
+read_catalog = merge_catalog = export_catalog = None
+ExportJob = processor_details = stored_details = DetailSource = None
+
+def load_core():
+    """Nạp check_core + thư viện đọc file; chạy ở luồng nền (MainApp.warm_up)."""
+    global pd, np, DataProcessor, AnalysisJob, SearchIndex, SortOrders, ResultStore, FileWatcher, AliasSuggester
+    global read_catalog, merge_catalog, export_catalog, ExportJob, processor_details, stored_details, field_values, DetailSource
+    import pandas
+    import numpy
+    import check_core
+    for mod in ("openpyxl", "pyarrow.feather"): # engine đọc .xlsx / cache; thiếu thì để lúc dùng mới báo lỗi
+        try:
+            __import__(mod)
+        except ImportError:
+            pass
+    pd, np = pandas, numpy
+    DataProcessor, AnalysisJob = check_core.DataProcessor, check_core.AnalysisJob
+    SearchIndex, SortOrders = check_core.SearchIndex, check_core.SortOrders
+    ResultStore, FileWatcher = check_core.ResultStore, check_core.FileWatcher
+    AliasSuggester = check_core.AliasSuggester
+    read_catalog, merge_catalog, export_catalog = check_core.read_catalog, check_core.merge_catalog, check_core.export_catalog
+    ExportJob, processor_details, stored_details = check_core.ExportJob, check_core.processor_details, check_core.stored_details
+    field_values, DetailSource = check_core.field_values, check_core.DetailSource
+
 # =============================================================================
-# 1. CẤU HÌNH & HẰNG SỐ
+# 1. HẰNG SỐ GIAO DIỆN
 # =============================================================================
 
-CONFIG_FILE = "config_system.json"
+SEARCH_DELAY_MS = 150 # Chờ ngừng gõ bao lâu thì mới lọc
 
 # Màu sắc giao diện
 COLOR_BG_MAIN = "#F5F7FA"       
@@ -29,357 +58,133 @@ COLOR_INFO_GOP = "#BBDEFB"      # Xanh dương nhạt (Đơn gộp)
 COLOR_TEXT_GOP = "#0D47A1"      # Chữ xanh đậm cho đơn gộp
 COLOR_OK = "#FFFFFF"            # Trắng
 
-# Cột hệ thống mặc định
-SYSTEM_COLS = {
-   "dh_code": "Mã Khách/ĐC (Đơn Hàng)",
-   "dh_item": "Mã Hàng (Đơn Hàng)",
-   "dh_name": "Tên Hàng (Đơn Hàng)",
-   "dh_sl": "Số Lượng (Đơn Hàng)",
-   "dh_so": "Số Đơn Hàng",
-   "dh_note": "Ghi chú", # Thêm cột ghi chú nếu có
-   
-   "px_code": "Mã Khách/ĐC (Phiếu Xuất)",
-   "px_item": "Mã Hàng (Phiếu Xuất)",
-   "px_name": "Tên Hàng (Phiếu Xuất)",
-   "px_sl_xuat": "SL Xuất (Kg/Thùng)",
-   "px_sl_tui": "SL Túi/Con",
-   "px_so": "Số Phiếu Xuất"
-}
-
-# =============================================================================
-# 2. HỆ THỐNG BẢO MẬT & CẤU HÌNH
-# =============================================================================
-
-class SecurityManager:
-    @staticmethod
-    def hash_pin(pin):
-        return hashlib.sha256(str(pin).encode()).hexdigest()
-
-class ConfigManager:
-    def __init__(self):
-        self.data = {
-            "pin_hash": SecurityManager.hash_pin("1234"),
-            "paths": {"dh": "", "px": ""},
-            "col_map": {},
-            "bag_items": [],
-            "alias_map": {},
-            "tolerance": {"kg_min": 0.0, "kg_max": 0.0, "bag_diff": 0}
-        }
-        self.load()
-
-    def load(self):
-        if os.path.exists(CONFIG_FILE):
-            try:
-                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                    loaded = json.load(f)
-                    for k, v in loaded.items():
-                        if k in self.data and isinstance(self.data[k], dict):
-                            self.data[k].update(v)
-                        else:
-                            self.data[k] = v
-            except: pass
-
-    def save(self):
-        try:
-            with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f, indent=4, ensure_ascii=False)
-        except: pass
-
-# =============================================================================
-# 3. XỬ LÝ DỮ LIỆU (CORE LOGIC)
-# =============================================================================
-
-class DataProcessor:
-    def __init__(self, config_mgr):
-        self.cfg = config_mgr
-        
-        # Dữ liệu hiển thị (List of Dict)
-        self.res_tab1 = [] 
-        self.res_tab2 = [] 
-        self.res_tab3 = [] 
-        
-        # Dữ liệu chi tiết cho Popup (Map: (Key, Item) -> {Orders:[], Exports:[]})
-        self.detail_map = {} 
-
-    def normalize(self, text):
-        if pd.isna(text) or text == "": return ""
-        t = str(text).strip().upper()
-        t = " ".join(t.split())
-        return unicodedata.normalize('NFC', t)
-
-    def extract_key(self, text):
-        s = self.normalize(text)
-        match = re.search(r'((ST|DC|KH)\d+)', s)
-        return match.group(1) if match else "UNKNOWN"
-
-    def run_analysis(self):
-        self.res_tab1, self.res_tab2, self.res_tab3 = [], [], []
-        self.detail_map = {}
-        
-        p_dh = self.cfg.data["paths"]["dh"]
-        p_px = self.cfg.data["paths"]["px"]
-        cmap = self.cfg.data["col_map"] if self.cfg.data["col_map"] else SYSTEM_COLS
-        bag_list = set(self.cfg.data["bag_items"])
-        alias_map = self.cfg.data["alias_map"]
-
-        # --- 1. ĐỌC FILE ---
-        try:
-            df_dh = pd.read_excel(p_dh, dtype=str)
-            df_px = pd.read_excel(p_px, dtype=str)
-        except Exception as e:
-            return False, f"Lỗi đọc file: {str(e)}"
-
-        # --- 2. XỬ LÝ ĐƠN HÀNG ---
-        # Map cột
-        dh_c_code = cmap.get("dh_code", "")
-        dh_c_item = cmap.get("dh_item", "")
-        dh_c_sl = cmap.get("dh_sl", "")
-        dh_c_name = cmap.get("dh_name", "")
-        dh_c_so = cmap.get("dh_so", "")
-        dh_c_note = cmap.get("dh_note", "Ghi chú")
-
-        # Temp Storage
-        orders_agg = {} # (Key, Item) -> Total SL
-        orders_count = {} # (Key, Item) -> Count lines (để check gộp)
-
-        for idx, row in df_dh.iterrows():
-            raw_key = str(row.get(dh_c_code, ''))
-            key = self.extract_key(raw_key)
-            
-            raw_item = self.normalize(row.get(dh_c_item, ''))
-            item = alias_map.get(raw_item, raw_item)
-            
-            try: sl = float(row.get(dh_c_sl, 0))
-            except: sl = 0
-            if sl <= 0: continue
-
-            if key == "UNKNOWN":
-                self.res_tab3.append({"Loại": "Đơn Hàng", "Lỗi": "Không định danh Khách", "Dữ liệu": f"{raw_key}|{raw_item}"})
-                continue
-
-            k = (key, item)
-            
-            # Cộng dồn
-            orders_agg[k] = orders_agg.get(k, 0) + sl
-            orders_count[k] = orders_count.get(k, 0) + 1
-            
-            # Lưu chi tiết vào detail_map
-            if k not in self.detail_map: self.detail_map[k] = {'orders': [], 'exports': []}
-            self.detail_map[k]['orders'].append({
-                "SoDH": row.get(dh_c_so, ''),
-                "Name": row.get(dh_c_name, ''),
-                "SL": sl,
-                "Note": row.get(dh_c_note, '')
-            })
-
-        # --- 3. XỬ LÝ PHIẾU XUẤT ---
-        exports_agg = {}
-        list_px_lines = []
-
-        px_c_code = cmap.get("px_code", "")
-        px_c_item = cmap.get("px_item", "")
-        px_c_sl_x = cmap.get("px_sl_xuat", "")
-        px_c_sl_t = cmap.get("px_sl_tui", "")
-        px_c_so = cmap.get("px_so", "")
-        px_c_name = cmap.get("px_name", "")
-
-        for idx, row in df_px.iterrows():
-            raw_key = str(row.get(px_c_code, ''))
-            key = self.extract_key(raw_key)
-            raw_item = self.normalize(row.get(px_c_item, ''))
-            item = alias_map.get(raw_item, raw_item)
-            
-            try: sl_x = float(row.get(px_c_sl_x, 0))
-            except: sl_x = 0
-            try: sl_t = float(row.get(px_c_sl_t, 0))
-            except: sl_t = 0
-            
-            if key == "UNKNOWN":
-                self.res_tab3.append({"Loại": "Phiếu Xuất", "Lỗi": "Không định danh Khách", "Dữ liệu": f"{raw_key}|{raw_item}|PX:{row.get(px_c_so,'')}"})
-                continue
-            if item == "":
-                self.res_tab3.append({"Loại": "Phiếu Xuất", "Lỗi": "Mã hàng rỗng", "Dữ liệu": str(row.values)})
-                continue
-
-            k = (key, item)
-            
-            # Cộng dồn
-            if k not in exports_agg: exports_agg[k] = {'Kg': 0.0, 'Tui': 0.0}
-            exports_agg[k]['Kg'] += sl_x
-            exports_agg[k]['Tui'] += sl_t
-
-            # Lưu chi tiết
-            if k not in self.detail_map: self.detail_map[k] = {'orders': [], 'exports': []}
-            self.detail_map[k]['exports'].append({
-                "SoPX": row.get(px_c_so, ''),
-                "Name": row.get(px_c_name, ''),
-                "SL_Xuat": sl_x,
-                "SL_Tui": sl_t
-            })
-
-            # Lưu dòng để tính Tab 2
-            list_px_lines.append({
-                "SoPX": str(row.get(px_c_so, '')),
-                "Key": key, "Item": item, "Name": str(row.get(px_c_name, '')),
-                "SL_Xuat": sl_x, "SL_Tui": sl_t
-            })
-
-        # --- 4. TÍNH TOÁN TAB 1 (TỔNG HỢP) ---
-        all_keys = set(orders_agg.keys()) | set(exports_agg.keys())
-        
-        tol_min = self.cfg.data["tolerance"]["kg_min"]
-        tol_max = self.cfg.data["tolerance"]["kg_max"]
-        tol_bag = self.cfg.data["tolerance"]["bag_diff"]
-
-        for k, item in all_keys:
-            sl_dat = orders_agg.get((k, item), 0)
-            ex_data = exports_agg.get((k, item), {'Kg': 0, 'Tui': 0})
-            
-            is_bag = item in bag_list
-            unit = "Túi" if is_bag else "Kg"
-            
-            sl_xuat_final = ex_data['Tui'] if is_bag else ex_data['Kg']
-            lech = sl_xuat_final - sl_dat
-            
-            # Logic Trạng Thái
-            status = "ĐỦ"
-            tag = "ok"
-            
-            if is_bag:
-                if abs(lech) > tol_bag:
-                    if sl_dat == 0: status = "KHÔNG ĐẶT MÀ XUẤT"; tag = "tim"
-                    elif lech < 0: status = f"THIẾU {abs(lech):.0f}"; tag = "do"
-                    else: status = f"THỪA {abs(lech):.0f}"; tag = "vang"
-            else:
-                if lech < tol_min: status = f"THIẾU {abs(lech):.2f}"; tag = "do"
-                elif lech > tol_max:
-                    if sl_dat == 0: status = "KHÔNG ĐẶT MÀ XUẤT"; tag = "tim"
-                    else: status = f"THỪA {abs(lech):.2f}"; tag = "vang"
-            
-            # Check Gộp
-            is_merged = orders_count.get((k, item), 0) > 1
-            if is_merged:
-                tag = "gop" if tag == "ok" else tag # Nếu lỗi thì ưu tiên màu lỗi, nếu đủ thì màu gộp
-                # Nhưng yêu cầu là màu xanh dương cho dòng gộp. 
-                # Ta sẽ xử lý hiển thị icon ở giao diện.
-            
-            self.res_tab1.append({
-                "Key": k, "Item": item, "Unit": unit,
-                "SL_Dat": sl_dat, "SL_Xuat": sl_xuat_final, "Lech": lech,
-                "Status": status, "Tag": tag, "IsMerged": is_merged
-            })
-
-        # --- 5. TÍNH TOÁN TAB 2 (CHI TIẾT) ---
-        for row in list_px_lines:
-            k = row['Key']; item = row['Item']
-            is_bag = item in bag_list
-            unit = "Túi" if is_bag else "Kg"
-            
-            total_dat = orders_agg.get((k, item), 0)
-            total_xuat = exports_agg.get((k, item), {'Kg':0, 'Tui':0})
-            val_xuat_total = total_xuat['Tui'] if is_bag else total_xuat['Kg']
-            
-            lech_tong = val_xuat_total - total_dat
-            
-            status = ""
-            tag = "ok"
-            # Logic tương tự Tab 1 nhưng gán cho dòng
-            if is_bag:
-                if abs(lech_tong) > tol_bag:
-                    if total_dat == 0: status = "SAI MÃ / KHÔNG ĐẶT"; tag = "tim"
-                    elif lech_tong < 0: status = "TỔNG THIẾU"; tag = "do"
-                    else: status = "TỔNG THỪA"; tag = "vang"
-            else:
-                if lech_tong < tol_min: status = "TỔNG THIẾU"; tag = "do"
-                elif lech_tong > tol_max:
-                    if total_dat == 0: status = "SAI MÃ / KHÔNG ĐẶT"; tag = "tim"
-                    else: status = "TỔNG THỪA"; tag = "vang"
-
-            row_out = row.copy()
-            row_out.update({
-                "Unit": unit, "SL_Dong": row['SL_Tui'] if is_bag else row['SL_Xuat'],
-                "Total_Dat": total_dat, "Total_Xuat": val_xuat_total,
-                "Lech_Tong": lech_tong, "Status": status, "Tag": tag
-            })
-            self.res_tab2.append(row_out)
-
-        return True, "Xử lý hoàn tất!"
-
 # =============================================================================
 # 4. SMART POPUP (CỬA SỔ CHI TIẾT 2 BÊN)
 # =============================================================================
 
 class SmartPopup:
-    def __init__(self, parent_root, title, data_left, data_right, is_bag):
+    """Cửa sổ chi tiết 2 bên của 1 (Key, Item). Dùng chung 1 cửa sổ, cập nhật tại chỗ (rê chuột ra thì ẩn, không hủy);
+    cửa sổ đã ghim tách riêng và giữ nguyên các dòng đã nạp. Dòng nạp theo trang PAGE khi cuộn tới cuối,
+    tổng lấy từ số đã cộng sẵn của Tab 1 / Tab 2 chứ không cộng khi chèn dòng."""
+    PAGE = 200
+    SIDES = {"orders": ("📦 NGUỒN ĐẶT (Đơn Hàng)", "blue", ["Số ĐH", "Tên Hàng Gốc", "SL Đặt", "Ghi chú"], [80, 150, 80, 80]),
+             "exports": ("🚚 NGUỒN XUẤT (Thực tế)", "red", ["Số PX", "Tên Hàng Xuất", "SL Xuất", "SL Túi"], [150, 150, 80, 80])}
+    shared = None # cửa sổ dùng chung (chưa ghim)
+
+    @classmethod
+    def open(cls, parent_root, title, source, totals, is_bag):
+        """Hiện chi tiết trên cửa sổ dùng chung; tạo mới nếu chưa có / đã đóng / đã ghim."""
+        p = cls.shared
+        if p is None or p.pinned or not p.top.winfo_exists():
+            p = cls.shared = cls(parent_root)
+        p.show(title, source, totals, is_bag)
+        return p
+
+    def __init__(self, parent_root):
         self.top = tk.Toplevel(parent_root)
-        self.top.title(title)
         self.top.geometry("900x400")
         self.top.configure(bg="white")
         # Luôn nổi trên cùng
         self.top.attributes('-topmost', True)
-        
+        self.top.protocol("WM_DELETE_WINDOW", self.top.destroy)
+
         self.pinned = False
-        
+        self.source = None # DetailSource đang hiện
+        self.loaded = {side: 0 for side in self.SIDES} # số dòng đã chèn mỗi bên
+        self.pending = set() # bên đang chờ nạp trang tiếp (after_idle)
+        self.totals, self.is_bag = (0, 0), False
+
         # Header + Pin Button
         f_head = tk.Frame(self.top, bg="#ECEFF1", padx=5, pady=5)
         f_head.pack(fill="x")
         self.btn_pin = tk.Button(f_head, text="📌 Ghim cửa sổ", command=self.toggle_pin, bg="white", relief="flat")
         self.btn_pin.pack(side="right")
-        tk.Label(f_head, text=title, font=("Arial", 11, "bold"), bg="#ECEFF1").pack(side="left")
+        self.lbl_title = tk.Label(f_head, font=("Arial", 11, "bold"), bg="#ECEFF1")
+        self.lbl_title.pack(side="left")
 
         # Layout Split
         paned = tk.PanedWindow(self.top, orient=tk.HORIZONTAL, bg="white")
         paned.pack(fill="both", expand=True, padx=5, pady=5)
-        
-        # --- LEFT: ĐƠN ĐẶT ---
-        f_left = tk.LabelFrame(paned, text="📦 NGUỒN ĐẶT (Đơn Hàng)", bg="white", fg="blue")
-        paned.add(f_left)
-        
-        cols_l = ["Số ĐH", "Tên Hàng Gốc", "SL Đặt", "Ghi chú"]
-        tree_l = ttk.Treeview(f_left, columns=cols_l, show="headings", height=8)
-        for c in cols_l: 
-            tree_l.heading(c, text=c)
-            tree_l.column(c, width=80 if c != "Tên Hàng Gốc" else 150)
-        tree_l.pack(fill="both", expand=True)
-        
-        total_dat = 0
-        for item in data_left:
-            sl = item.get('SL', 0)
-            total_dat += sl
-            tree_l.insert("", "end", values=(item.get('SoDH'), item.get('Name'), f"{sl:g}", item.get('Note')))
-        
-        tk.Label(f_left, text=f"TỔNG ĐẶT: {total_dat:g}", font=("Arial", 10, "bold"), fg="blue", bg="white").pack(anchor="e")
 
-        # --- RIGHT: PHIẾU XUẤT ---
-        f_right = tk.LabelFrame(paned, text="🚚 NGUỒN XUẤT (Thực tế)", bg="white", fg="red")
-        paned.add(f_right)
-        
-        cols_r = ["Số PX", "Tên Hàng Xuất", "SL Xuất", "SL Túi"]
-        tree_r = ttk.Treeview(f_right, columns=cols_r, show="headings", height=8)
-        for c in cols_r: 
-            tree_r.heading(c, text=c)
-            tree_r.column(c, width=80 if "SL" in c else 150)
-        tree_r.pack(fill="both", expand=True)
-        
-        total_xuat = 0
-        for item in data_right:
-            val = item.get('SL_Tui', 0) if is_bag else item.get('SL_Xuat', 0)
-            total_xuat += val
-            tree_r.insert("", "end", values=(item.get('SoPX'), item.get('Name'), f"{item.get('SL_Xuat',0):g}", f"{item.get('SL_Tui',0):g}"))
-            
-        tk.Label(f_right, text=f"TỔNG XUẤT ({'Túi' if is_bag else 'Kg'}): {total_xuat:g}", font=("Arial", 10, "bold"), fg="red", bg="white").pack(anchor="e")
+        # Trái: đơn đặt, phải: phiếu xuất
+        self.trees, self.labels = {}, {}
+        for side, (text, color, cols, widths) in self.SIDES.items():
+            frame = tk.LabelFrame(paned, text=text, bg="white", fg=color)
+            paned.add(frame)
+            self.labels[side] = tk.Label(frame, font=("Arial", 10, "bold"), fg=color, bg="white")
+            self.labels[side].pack(side="bottom", anchor="e")
+            sb = ttk.Scrollbar(frame, orient="vertical")
+            tree = ttk.Treeview(frame, columns=cols, show="headings", height=8)
+            for c, w in zip(cols, widths):
+                tree.heading(c, text=c)
+                tree.column(c, width=w)
+            sb.config(command=tree.yview)
+            tree.config(yscrollcommand=lambda first, last, side=side, sb=sb: self.on_scroll(side, sb, first, last))
+            sb.pack(side="right", fill="y")
+            tree.pack(fill="both", expand=True)
+            self.trees[side] = tree
 
         # --- EVENTS ---
-        # Rê chuột ra khỏi cửa sổ -> Đóng (Nếu chưa ghim)
+        # Rê chuột ra khỏi cửa sổ -> Ẩn (Nếu chưa ghim)
         self.top.bind("<Leave>", self.check_close)
-        
+
+    def show(self, title, source, totals, is_bag):
+        """Đổi sang nhóm khác tại chỗ; cùng nhóm của cùng kết quả thì giữ các dòng đã nạp, chỉ cập nhật tổng."""
+        self.top.title(title)
+        self.lbl_title.config(text=title)
+        self.totals, self.is_bag = totals, is_bag
+        if not source.same(self.source):
+            self.source = source
+            for side, tree in self.trees.items():
+                tree.delete(*tree.get_children())
+                tree.yview_moveto(0)
+                self.loaded[side] = 0
+                self.load_more(side)
+        self.update_totals()
+        self.top.deiconify()
+        self.top.lift()
+
+    @staticmethod
+    def row_values(side, item):
+        if side == "orders":
+            return (item.get('SoDH'), item.get('Name'), f"{item.get('SL', 0):g}", item.get('Note'))
+        return (item.get('SoPX'), item.get('Name'), f"{item.get('SL_Xuat', 0):g}", f"{item.get('SL_Tui', 0):g}")
+
+    def load_more(self, side):
+        """Chèn trang tiếp theo của 1 bên."""
+        self.pending.discard(side)
+        n, total = self.loaded[side], self.source.counts[side]
+        if n >= total: return
+        rows = self.source.page(side, n, self.PAGE)
+        tree = self.trees[side]
+        for item in rows:
+            tree.insert("", "end", values=self.row_values(side, item))
+        self.loaded[side] = n + len(rows) if rows else total
+        self.update_totals()
+
+    def on_scroll(self, side, sb, first, last):
+        sb.set(first, last)
+        # Cuộn tới cuối mà còn dòng chưa nạp -> nạp trang tiếp sau khi vẽ xong
+        if float(last) >= 1.0 and self.source and side not in self.pending and self.loaded[side] < self.source.counts[side]:
+            self.pending.add(side)
+            self.top.after_idle(self.load_more, side)
+
+    def update_totals(self):
+        total_dat, total_xuat = self.totals
+        texts = {"orders": f"TỔNG ĐẶT: {total_dat:g}",
+                 "exports": f"TỔNG XUẤT ({'Túi' if self.is_bag else 'Kg'}): {total_xuat:g}"}
+        for side, label in self.labels.items():
+            n, total = self.loaded[side], self.source.counts[side]
+            more = f"   (đang hiện {n:,}/{total:,} dòng)" if n < total else ""
+            label.config(text=texts[side] + more)
+
     def toggle_pin(self):
         self.pinned = not self.pinned
         if self.pinned:
             self.btn_pin.config(bg="yellow", text="📍 Đã Ghim")
         else:
             self.btn_pin.config(bg="white", text="📌 Ghim cửa sổ")
-            
+
     def check_close(self, event):
         # Kiểm tra xem chuột có thực sự ra khỏi toplevel không (tránh sự kiện con kích hoạt)
         if self.pinned: return
@@ -387,7 +192,220 @@ class SmartPopup:
         widget = self.top.winfo_containing(x, y)
         if str(widget).startswith(str(self.top)):
             return # Vẫn đang trong cửa sổ hoặc con của nó
-        self.top.destroy()
+        if self is SmartPopup.shared:
+            self.top.withdraw() # giữ lại để lần mở sau cập nhật tại chỗ
+        else:
+            self.top.destroy() # cửa sổ đã ghim rồi bỏ ghim
+
+# =============================================================================
+# 4b. LƯỚI KẾT QUẢ ẢO (CHỈ VẼ CÁC DÒNG ĐANG NHÌN THẤY)
+# =============================================================================
+
+class RowView:
+    """Dãy bản ghi records[ids[i]] - đưa cho VirtualGrid mà không phải dựng list mới."""
+    def __init__(self, records, ids):
+        self.records, self.ids = records, ids
+    def __len__(self): return len(self.ids)
+    def __getitem__(self, i): return self.records[self.ids[i]]
+    def __iter__(self): return (self.records[i] for i in self.ids)
+
+class GroupedRows:
+    """Tab 3: mỗi nhóm ngoại lệ 1 dòng; nhóm có trong expanded thì thêm các dòng mẫu ngay bên dưới.
+    groups: RowView chỉ gồm các nhóm (để xuất Excel)."""
+    def __init__(self, records, ids, expanded):
+        self.groups = RowView(records, ids)
+        extra = np.zeros(len(ids), dtype=np.int64)
+        if expanded:
+            for i, gid in enumerate(ids):
+                r = records[gid]
+                if group_id(r) in expanded: extra[i] = len(r["Samples"])
+        self.starts = np.arange(len(ids)) + np.concatenate(([0], np.cumsum(extra)[:-1])) if len(ids) else extra
+        self.n = len(ids) + int(extra.sum())
+
+    def group_of(self, i):
+        """Dòng lưới i -> (vị trí nhóm trong groups, thứ tự dòng mẫu hoặc -1 nếu là dòng nhóm)."""
+        g = int(np.searchsorted(self.starts, i, side="right")) - 1
+        return g, i - int(self.starts[g]) - 1
+
+    def __len__(self): return self.n
+    def __getitem__(self, i):
+        if i < 0: i += self.n
+        if not 0 <= i < self.n: raise IndexError(i)
+        g, j = self.group_of(i)
+        r = self.groups[g]
+        if j < 0: return r
+        row, text = r["Samples"][j]
+        return {"Loại": r["Loại"], "Lỗi": r["Lỗi"], "Mẫu Key": r["Mẫu Key"], "Dòng": row, "Dữ liệu": text, "Sample": True}
+    def __iter__(self): return (self[i] for i in range(self.n))
+
+def group_id(r):
+    return (r["Loại"], r["Lỗi"], r["Mẫu Key"])
+
+class StoredRows:
+    """Như RowView nhưng đọc từ ResultStore theo trang khi lưới cần tới (kết quả đã lưu của lần chạy trước)."""
+    PAGE = 500
+    MAX_PAGES = 40
+
+    def __init__(self, store, run_id, tab, keyword="", errors_only=False, order=(None, False)):
+        self.store, self.args = store, (run_id, tab)
+        self.filters = dict(keyword=keyword, errors_only=errors_only)
+        self.order = order
+        self.n = store.count(run_id, tab, **self.filters)
+        self.pages = {} # số trang -> list bản ghi (giữ tối đa MAX_PAGES trang gần nhất)
+
+    def _page(self, k):
+        if k not in self.pages:
+            if len(self.pages) >= self.MAX_PAGES: self.pages.pop(next(iter(self.pages)))
+            self.pages[k] = self.store.page(*self.args, k * self.PAGE, self.PAGE, order=self.order, **self.filters)
+        return self.pages[k]
+
+    def __len__(self): return self.n
+    def __getitem__(self, i):
+        if i < 0: i += self.n
+        if not 0 <= i < self.n: raise IndexError(i)
+        return self._page(i // self.PAGE)[i % self.PAGE]
+    def __iter__(self):
+        for k in range((self.n + self.PAGE - 1) // self.PAGE):
+            yield from self.store.page(*self.args, k * self.PAGE, self.PAGE, order=self.order, **self.filters)
+
+class VirtualGrid:
+    """Treeview chỉ giữ số dòng vừa khung nhìn; khi cuộn thì nạp lại giá trị cho các dòng đó.
+    rows: danh sách bản ghi đã lọc; fmt(bản ghi) -> (values, tag)."""
+    CACHE_PAGES = 4 # số trang đã định dạng giữ lại quanh vị trí cuộn
+
+    def __init__(self, parent, cols):
+        self.frame = tk.Frame(parent)
+        self.tree = ttk.Treeview(self.frame, columns=cols, show="headings", selectmode="browse")
+        self.sb = ttk.Scrollbar(self.frame, orient="vertical", command=self.yview)
+        self.tree.pack(side="left", fill="both", expand=True); self.sb.pack(side="right", fill="y")
+
+        try: self.rowheight = int(ttk.Style().lookup("Treeview", "rowheight") or 20)
+        except (TypeError, ValueError): self.rowheight = 20
+
+        self.rows, self.fmt = [], None
+        self.top = 0          # chỉ số bản ghi ở dòng đầu khung nhìn
+        self.slots = []       # iid các dòng Treeview đang dùng
+        self.shown = 0        # số slot đang gắn vào Treeview
+        self.selected = None  # chỉ số bản ghi đang chọn
+        self.cache = {}
+
+        self.tree.bind("<Configure>", lambda e: self._resize())
+        self.tree.bind("<<TreeviewSelect>>", self._on_select)
+        self.tree.bind("<MouseWheel>", lambda e: self._wheel(-3 if e.delta > 0 else 3))
+        self.tree.bind("<Button-4>", lambda e: self._wheel(-3))
+        self.tree.bind("<Button-5>", lambda e: self._wheel(3))
+        for key, step in (("<Up>", -1), ("<Down>", 1), ("<Prior>", "-page"), ("<Next>", "page"), ("<Home>", "home"), ("<End>", "end")):
+            self.tree.bind(key, lambda e, s=step: self._key(s))
+
+    # --- API giống Treeview cho phần còn lại của giao diện ---
+    def bind(self, seq, func): self.tree.bind(seq, func)
+    def heading(self, *a, **kw): return self.tree.heading(*a, **kw)
+    def column(self, *a, **kw): return self.tree.column(*a, **kw)
+    def tag_configure(self, *a, **kw): return self.tree.tag_configure(*a, **kw)
+
+    def set_rows(self, rows, fmt, keep_position=False):
+        self.rows, self.fmt = rows, fmt
+        self.cache = {}
+        if not keep_position:
+            self.top, self.selected = 0, None
+        else: # giữ vị trí cuộn, danh sách ngắn đi thì kéo về cuối
+            self.top = max(0, min(self.top, len(rows) - max(1, self.visible())))
+            if self.selected is not None and self.selected >= len(rows): self.selected = None
+        self._render()
+
+    def visible(self):
+        return len(self.slots)
+
+    def index_at(self, y):
+        iid = self.tree.identify_row(y)
+        if iid not in self.slots: return None
+        i = self.top + self.slots.index(iid)
+        return i if i < len(self.rows) else None
+
+    def select_index(self, i):
+        self.selected = i
+        self._render()
+
+    def selected_record(self):
+        if self.selected is None or self.selected >= len(self.rows): return None
+        return self.rows[self.selected]
+
+    def values(self, i):
+        if i not in self.cache:
+            if len(self.cache) > self.CACHE_PAGES * max(1, self.visible()): self.cache = {}
+            self.cache[i] = self.fmt(self.rows[i])
+        return self.cache[i]
+
+    # --- Cuộn ---
+    def yview(self, *args):
+        n, vis = len(self.rows), max(1, self.visible())
+        if args[0] == "moveto":
+            self.scroll_to(int(float(args[1]) * n))
+        elif args[0] == "scroll":
+            step = int(args[1]) * (vis if args[2] == "pages" else 1)
+            self.scroll_to(self.top + step)
+
+    def scroll_to(self, top):
+        top = max(0, min(top, len(self.rows) - self.visible()))
+        if top != self.top:
+            self.top = top
+            self._render()
+
+    def _wheel(self, step):
+        self.scroll_to(self.top + step)
+        return "break"
+
+    def _key(self, step):
+        n, vis = len(self.rows), max(1, self.visible())
+        if not n: return "break"
+        cur = self.top if self.selected is None else self.selected
+        if step == "home": cur = 0
+        elif step == "end": cur = n - 1
+        elif step == "page": cur += vis
+        elif step == "-page": cur -= vis
+        else: cur += step
+        cur = max(0, min(cur, n - 1))
+        if cur < self.top: self.top = cur
+        elif cur >= self.top + vis: self.top = cur - vis + 1
+        self.select_index(cur)
+        return "break"
+
+    def _on_select(self, event):
+        sel = self.tree.selection()
+        if not sel or sel[0] not in self.slots: return
+        i = self.top + self.slots.index(sel[0])
+        if i < len(self.rows): self.selected = i
+
+    # --- Vẽ ---
+    def _resize(self):
+        # Trừ 1 dòng cho tiêu đề cột
+        need = max(1, self.tree.winfo_height() // self.rowheight - 1)
+        if need == len(self.slots): return
+        while len(self.slots) < need:
+            self.slots.append(self.tree.insert("", "end"))
+        while len(self.slots) > need:
+            self.tree.delete(self.slots.pop())
+        self.shown = len(self.slots)
+        self.top = max(0, min(self.top, len(self.rows) - need))
+        self._render()
+
+    def _render(self):
+        n = len(self.rows)
+        count = max(0, min(len(self.slots), n - self.top))
+        # Gắn/bỏ slot theo số dòng còn lại, không tạo mới item
+        for i in range(count, self.shown): self.tree.detach(self.slots[i])
+        for i in range(self.shown, count): self.tree.move(self.slots[i], "", i)
+        self.shown = count
+
+        sel = ()
+        for i in range(count):
+            vals, tag = self.values(self.top + i)
+            self.tree.item(self.slots[i], values=vals, tags=(tag,) if tag else ())
+            if self.top + i == self.selected: sel = (self.slots[i],)
+        if tuple(self.tree.selection()) != sel: self.tree.selection_set(sel)
+
+        if n: self.sb.set(self.top / n, min(1.0, (self.top + count) / n))
+        else: self.sb.set(0.0, 1.0)
 
 # =============================================================================
 # 5. GIAO DIỆN CHÍNH (MAIN APP)
@@ -404,12 +422,106 @@ class MainApp:
         #    root.destroy(); return
             
         self.setup_ui()
-        self.processor = DataProcessor(self.cfg)
+        self.processor = None # có sau khi nạp xong check_core (warm_up)
+        self.store = None # ResultStore: kết quả các lần chạy đã lưu
+        self.save_lock = threading.Lock() # giữ save_queue / save_busy
+        self.save_queue = {} # id(processor) -> (processor, bản chụp) chờ lưu, theo thứ tự
+        self.save_busy = False # đang có luồng lưu
+        self.stored = None # lần chạy đã lưu đang xem (dict của ResultStore.runs), None = đang xem processor
+        self.changed = set() # (Key, Item) có dòng PX mới ở lần kiểm tra cộng dồn gần nhất
+        self.core_ready = threading.Event()
+        self.pending_run = False # bấm CHẠY khi chưa nạp xong: chạy ngay khi nạp xong
+        self.job = None # AnalysisJob đang chạy nền
+        self.export_job = None # ExportJob đang ghi file Excel
+        self.watcher = None # FileWatcher: tự chạy lại khi file đầu vào được lưu
         
-        # Biến lưu dữ liệu đang hiển thị trên lưới (để xuất Excel đúng cái đang thấy)
-        self.current_view_data = [] 
+        # Bản ghi đang hiển thị trên lưới (để xuất Excel đúng cái đang thấy)
+        self.view_tab1, self.view_tab2, self.view_tab3 = [], [], []
+
+        # Chỉ mục tìm kiếm dựng theo processor.version
+        self.search_idx = None
+        self.search_job = None
+
+        # Nạp thư viện nặng sau khi cửa sổ đã vẽ xong
+        self.root.after_idle(self.warm_up)
+
+    def warm_up(self):
+        self.t_ui = time.perf_counter() - APP_START
+        self.lbl_status.config(text=f"Đang nạp thư viện xử lý... (giao diện {self.t_ui:.2f}s)")
+        threading.Thread(target=self._warm_up_thread, daemon=True).start()
+
+    def _warm_up_thread(self):
+        t0 = time.perf_counter()
+        err = None
+        try:
+            load_core()
+        except Exception as e:
+            err = e
+        self.root.after(0, self.on_core_ready, err, time.perf_counter() - t0)
+
+    def on_core_ready(self, err, sec):
+        if err:
+            self.pending_run = False
+            self.lbl_status.config(text=f"Lỗi nạp thư viện: {err}")
+            messagebox.showerror("Lỗi", f"Không nạp được thư viện xử lý (pandas / openpyxl):\n{err}")
+            return
+        self.processor = DataProcessor(self.cfg)
+        self.store = ResultStore() if self.cfg.data["store"].get("enabled", True) else None
+        self.core_ready.set()
+        total = time.perf_counter() - APP_START
+        status = f"Khởi động {total:.2f}s (giao diện {self.t_ui:.2f}s, thư viện {sec:.2f}s)."
+        self.lbl_status.config(text="Sẵn sàng. " + status)
+        if self.var_watch.get(): self.toggle_watch()
+        if self.pending_run:
+            self.pending_run = False
+            self.run_process()
+        elif self.store and self.cfg.data["store"].get("open_last", True):
+            try:
+                runs = self.store.runs(1)
+            except Exception:
+                runs = []
+            if runs: self.open_stored(runs[0], status)
+
+    # --- KẾT QUẢ ĐÃ LƯU ---
+    def save_result(self, processor):
+        """Lưu kết quả vào results.db ở luồng nền; processor đã lưu rồi (đổi trạng thái / alias) thì ghi đè đúng lần chạy đó.
+        Chụp kết quả ngay trên luồng giao diện; các lần lưu chạy lần lượt nên lần sau luôn thấy run_id của lần trước
+        (không chèn lần chạy trùng), đổi nhiều lần khi đang lưu thì chỉ ghi bản chụp mới nhất."""
+        if not self.store: return
+        with self.save_lock:
+            self.save_queue[id(processor)] = (processor, processor.snapshot())
+            if self.save_busy: return
+            self.save_busy = True
+        threading.Thread(target=self.save_worker, daemon=True).start()
+
+    def save_worker(self):
+        store, keep = self.store, self.cfg.data["store"].get("keep_runs", 30)
+        while True:
+            with self.save_lock:
+                if not self.save_queue:
+                    self.save_busy = False; return
+                processor, snap = self.save_queue.pop(next(iter(self.save_queue)))
+            try:
+                processor.run_id = store.save_run(snap, getattr(processor, "run_id", None))
+                store.prune(keep)
+            except Exception as e:
+                msg = f"Không lưu được kết quả: {e}"
+                self.root.after(0, lambda m=msg: self.lbl_status.config(text=m))
+
+    def open_stored(self, run, note=""):
+        self.stored = run
+        self.changed = set()
+        self.refresh_views()
+        self.lbl_status.config(text=f"Đang xem kết quả đã lưu lúc {run['created'].replace('T', ' ')} "
+                                    f"({run['n1']:,} dòng tổng hợp, {run['errors']:,} lỗi) - bấm CHẠY để tính lại. " + note)
+
+    def open_history(self):
+        if not self.store:
+            messagebox.showinfo("Lịch sử", "Chưa bật lưu kết quả (store.enabled)."); return
+        RunHistoryDialog(self.root, self.store, self.open_stored)
 
     def setup_ui(self):
+        self.sort_state = {}
         self.root.title("CHECK ĐƠN HÀNG PRO v1.0")
         self.root.geometry("1400x850")
         self.root.configure(bg=COLOR_BG_MAIN)
@@ -431,7 +543,26 @@ class MainApp:
         
         tk.Label(self.f_side, text="--------------", bg=COLOR_SIDEBAR, fg="gray").pack(pady=10)
         tk.Button(self.f_side, text="📦 QUẢN LÝ TÚI/KG", bg="#FF9800", fg="black", font=("Arial", 10, "bold"), command=self.open_bag_manager).pack(fill="x", padx=10, pady=5)
-        tk.Button(self.f_side, text="▶ BẮT ĐẦU CHẠY", bg=COLOR_ACCENT, fg="white", font=("Arial", 12, "bold"), height=2, command=self.run_process).pack(fill="x", padx=10, pady=20)
+        self.tol_menu = tk.Menu(self.root, tearoff=0)
+        self.tol_menu.add_command(label="Dung sai chung", command=self.edit_tolerance)
+        self.tol_menu.add_command(label="Dung sai riêng (mã / nhóm hàng / khách)", command=self.open_tolerance_rules)
+        self.btn_tol = tk.Button(self.f_side, text="⚖️ DUNG SAI", bg="#FFC107", fg="black", font=("Arial", 10, "bold"),
+                                 command=lambda: self.tol_menu.post(self.btn_tol.winfo_rootx(), self.btn_tol.winfo_rooty() + self.btn_tol.winfo_height()))
+        self.btn_tol.pack(fill="x", padx=10, pady=5)
+        tk.Button(self.f_side, text="🔗 GỢI Ý MÃ HÀNG", bg="#AB47BC", fg="white", font=("Arial", 10, "bold"), command=self.open_alias_suggest).pack(fill="x", padx=10, pady=5)
+        self.catalog_menu = tk.Menu(self.root, tearoff=0)
+        self.catalog_menu.add_command(label="📥 Nhập từ Excel (gộp)", command=lambda: self.import_catalog(False))
+        self.catalog_menu.add_command(label="📥 Nhập từ Excel (thay toàn bộ)", command=lambda: self.import_catalog(True))
+        self.catalog_menu.add_command(label="📤 Xuất ra Excel", command=self.export_catalog)
+        self.btn_catalog = tk.Button(self.f_side, text="📚 DANH MỤC ALIAS / TÚI", bg="#8D6E63", fg="white", font=("Arial", 10, "bold"),
+                                     command=lambda: self.catalog_menu.post(self.btn_catalog.winfo_rootx(), self.btn_catalog.winfo_rooty() + self.btn_catalog.winfo_height()))
+        self.btn_catalog.pack(fill="x", padx=10, pady=5)
+        tk.Button(self.f_side, text="▶ BẮT ĐẦU CHẠY", bg=COLOR_ACCENT, fg="white", font=("Arial", 12, "bold"), height=2, command=self.run_process).pack(fill="x", padx=10, pady=(20, 5))
+        tk.Button(self.f_side, text="■ DỪNG", bg="#78909C", fg="white", font=("Arial", 10, "bold"), command=self.cancel_process).pack(fill="x", padx=10)
+        tk.Button(self.f_side, text="🕘 LẦN CHẠY TRƯỚC", bg="#546E7A", fg="white", font=("Arial", 10, "bold"), command=self.open_history).pack(fill="x", padx=10, pady=(20, 5))
+        self.var_watch = tk.BooleanVar(value=self.cfg.data["watch"].get("enabled", False))
+        tk.Checkbutton(self.f_side, text="👁 Tự chạy khi file thay đổi", variable=self.var_watch, command=self.toggle_watch,
+                       bg=COLOR_SIDEBAR, fg="white", selectcolor=COLOR_SIDEBAR, activebackground=COLOR_SIDEBAR).pack(anchor="w", padx=10, pady=5)
         
         # --- MAIN AREA ---
         f_main = tk.Frame(self.root, bg=COLOR_BG_MAIN)
@@ -445,7 +576,8 @@ class MainApp:
         tk.Label(f_tool, text="🔍 Tìm nhanh:", bg="white").pack(side="left")
         self.entry_search = tk.Entry(f_tool, width=30, font=("Arial", 10))
         self.entry_search.pack(side="left", padx=5)
-        self.entry_search.bind("<KeyRelease>", self.on_search) # Lọc real-time
+        self.entry_search.bind("<KeyRelease>", self.on_search_key) # Lọc real-time (có trễ, gõ tiếp thì hủy lần lọc cũ)
+        self.entry_search.bind("<Return>", self.on_search)
         
         # Nút In/Xuất
         tk.Button(f_tool, text="🖨️ XUẤT EXCEL (WYSIWYG)", bg="#4CAF50", fg="white", font=("Arial", 10, "bold"), command=self.export_excel).pack(side="right")
@@ -453,6 +585,8 @@ class MainApp:
         # Checkbox Focus
         self.var_focus = tk.BooleanVar(value=False)
         tk.Checkbutton(f_tool, text="🔥 Chỉ hiện lỗi", variable=self.var_focus, bg="white", command=self.refresh_views).pack(side="right", padx=10)
+        self.var_changed = tk.BooleanVar(value=False)
+        tk.Checkbutton(f_tool, text="🆕 Chỉ hiện thay đổi", variable=self.var_changed, bg="white", command=self.refresh_views).pack(side="right")
 
         # NOTEBOOK TABS
         self.nb = ttk.Notebook(f_main)
@@ -460,17 +594,22 @@ class MainApp:
         
         # Tab 1
         self.tree1 = self.create_tree(self.nb, "TAB 1: TỔNG HỢP", 
-                                      ["Key", "Mã Hàng", "Đơn Vị", "SL Đặt", "SL Xuất", "LỆCH", "TRẠNG THÁI"])
+                                      ["Key", "Mã Hàng", "Đơn Vị", "SL Đặt", "SL Xuất", "LỆCH", "TRẠNG THÁI"],
+                                      1, ["Key", "Item", "Unit", "SL_Dat", "SL_Xuat", "Lech", "Status"])
         self.tree1.bind("<Double-1>", self.on_popup_trigger)
         self.tree1.bind("<Button-3>", self.on_right_click)
         
         # Tab 2
         self.tree2 = self.create_tree(self.nb, "TAB 2: CHI TIẾT PHIẾU",
-                                      ["Số PX", "Key", "Mã Hàng", "Tên Hàng", "Đơn Vị", "SL Dòng", "Tổng Đặt", "Tổng Xuất", "LỆCH TỔNG", "TRẠNG THÁI"])
+                                      ["Số PX", "Key", "Mã Hàng", "Tên Hàng", "Đơn Vị", "SL Dòng", "Tổng Đặt", "Tổng Xuất", "LỆCH TỔNG", "TRẠNG THÁI"],
+                                      2, ["SoPX", "Key", "Item", "Name", "Unit", "SL_Dong", "Total_Dat", "Total_Xuat", "Lech_Tong", "Status"])
         self.tree2.bind("<Double-1>", self.on_popup_trigger)
         
         # Tab 3
-        self.tree3 = self.create_tree(self.nb, "TAB 3: NGOẠI LỆ", ["Loại", "Lỗi", "Dữ liệu"])
+        self.tree3 = self.create_tree(self.nb, "TAB 3: NGOẠI LỆ", ["Loại", "Lỗi", "Mẫu Key", "Số dòng", "Dòng", "Dữ liệu"],
+                                      3, ["Loại", "Lỗi", "Mẫu Key", "Số dòng", "Dòng", "Dữ liệu"])
+        self.tree3.bind("<Double-1>", self.on_toggle_group) # mở / đóng dòng mẫu của nhóm
+        self.expanded3 = set() # nhóm Tab 3 đang mở: (Loại, Lỗi, Mẫu Key)
         
         # Status Bar
         self.lbl_status = tk.Label(f_main, text="Sẵn sàng.", relief=tk.SUNKEN, anchor="w", bg="#ECEFF1")
@@ -481,6 +620,7 @@ class MainApp:
         self.context_menu.add_command(label="👀 Xem Chi tiết (2 bên)", command=self.on_popup_menu)
         self.context_menu.add_separator()
         self.context_menu.add_command(label="➕ Thêm vào Hàng Tính Túi", command=self.quick_add_bag)
+        self.context_menu.add_command(label="🔗 Gợi ý mã đặt (sai mã)", command=lambda: self.open_alias_suggest(self.tree1.selected_record()))
 
     def create_input(self, label, key):
         tk.Label(self.f_side, text=label, bg=COLOR_SIDEBAR, fg=COLOR_TEXT_SIDE).pack(anchor="w", padx=10, pady=(10,0))
@@ -488,18 +628,18 @@ class MainApp:
         f.pack(fill="x", padx=10)
         e = tk.Entry(f); e.pack(side="left", fill="x", expand=True)
         e.insert(0, self.cfg.data["paths"][key])
+        tk.Button(f, text="📁", width=3, command=lambda: self.browse_dir(e, key)).pack(side="right")
         tk.Button(f, text="...", width=3, command=lambda: self.browse(e, key)).pack(side="right")
         setattr(self, f"e_{key}", e)
 
-    def create_tree(self, parent, title, cols):
-        f = tk.Frame(parent); parent.add(f, text=title)
-        tree = ttk.Treeview(f, columns=cols, show="headings")
-        sb = ttk.Scrollbar(f, orient="vertical", command=tree.yview)
-        tree.configure(yscrollcommand=sb.set)
-        tree.pack(side="left", fill="both", expand=True); sb.pack(side="right", fill="y")
+    def create_tree(self, parent, title, cols, tab, fields):
+        tree = VirtualGrid(parent, cols)
+        parent.add(tree.frame, text=title)
+        tree.fields = dict(zip(cols, fields))
+        self.sort_state[tab] = (None, False) # (cột đang sắp xếp, giảm dần?)
         
         for c in cols:
-            tree.heading(c, text=c)
+            tree.heading(c, text=c, command=lambda t=tab, c=c: self.on_sort(t, c))
             w = 80 if "SL" in c else 150
             tree.column(c, width=w)
             
@@ -512,95 +652,236 @@ class MainApp:
         return tree
 
     def browse(self, entry, key):
-        p = filedialog.askopenfilename(filetypes=[("Excel", "*.xlsx *.xls")])
-        if p:
-            entry.delete(0, tk.END); entry.insert(0, p)
-            self.cfg.data["paths"][key] = p; self.cfg.save()
+        # Chọn được nhiều file cùng lúc, lưu dạng "a.xlsx; b.xlsx"
+        ps = filedialog.askopenfilenames(filetypes=[("Excel", "*.xlsx *.xlsm *.xls")])
+        if ps: self.set_path(entry, key, "; ".join(ps))
+
+    def browse_dir(self, entry, key):
+        # Cả thư mục: mọi file Excel bên trong
+        p = filedialog.askdirectory()
+        if p: self.set_path(entry, key, p)
+
+    def set_path(self, entry, key, p):
+        entry.delete(0, tk.END); entry.insert(0, p)
+        self.cfg.data["paths"][key] = p; self.cfg.save()
+
+    # --- THEO DÕI FILE ---
+    def toggle_watch(self):
+        """Bật / tắt tự chạy lại khi file Đơn Hàng / Phiếu Xuất được lưu."""
+        on = self.var_watch.get()
+        self.cfg.data["watch"]["enabled"] = on
+        self.cfg.save()
+        if self.watcher:
+            self.watcher.stop()
+            self.watcher = None
+        if not on or not self.core_ready.is_set(): return # chưa nạp xong: on_core_ready sẽ bật lại
+        w = self.cfg.data["watch"]
+        # Luồng theo dõi không đụng tới widget: đọc đường dẫn từ cfg, báo về luồng giao diện qua after()
+        self.watcher = FileWatcher(lambda: dict(self.cfg.data["paths"]),
+                                   lambda sides: self.root.after(0, self.auto_rerun, sides),
+                                   w.get("interval", 1.0), w.get("debounce", 2.0))
+        self.watcher.start()
+        self.lbl_status.config(text="👁 Đang theo dõi file đầu vào.")
+
+    def auto_rerun(self, sides):
+        if not self.var_watch.get(): return
+        names = ", ".join({"dh": "Đơn Hàng", "px": "Phiếu Xuất"}.get(s, s) for s in sorted(sides))
+        self.lbl_status.config(text=f"👁 Phát hiện thay đổi: {names} - đang chạy lại...")
+        self.run_process(auto=True, sides=sides)
 
-    def run_process(self):
+    def run_process(self, auto=False, sides=None):
+        """sides: các bên có file đổi (tự chạy lại khi theo dõi file) - bên còn lại dùng lại khung đã đọc lần trước."""
         self.cfg.data["paths"]["dh"] = self.e_dh.get()
         self.cfg.data["paths"]["px"] = self.e_px.get()
         self.cfg.save()
+
+        if not self.core_ready.is_set():
+            self.pending_run = True
+            self.lbl_status.config(text="Đang nạp thư viện xử lý - sẽ chạy ngay khi nạp xong...")
+            return
         
-        self.lbl_status.config(text="Đang xử lý...")
-        self.root.update()
-        threading.Thread(target=self._run_thread).start()
+        # Lần chạy mới thay thế lần đang chạy (bấm 2 lần, đổi file...)
+        if self.job: self.job.cancel()
+        # Lần trước đang hiển thị: nếu chỉ Phiếu Xuất được ghi thêm dòng thì chỉ xử lý phần mới
+        p = DataProcessor(self.cfg, previous=None if self.stored else self.processor)
+        p.keep_frames = self.var_watch.get()
+        p.changed_sides = set(sides) if sides is not None else None
+        job = AnalysisJob(p)
+        job.auto = auto # chạy lại do file thay đổi: không bật hộp thoại, giữ nguyên vị trí đang xem
+        job.on_progress = lambda phase, done: self.root.after(0, self.show_progress, job, phase, done)
+        self.job = job
+        
+        if not auto: self.lbl_status.config(text="Đang xử lý...")
+        self.root.update_idletasks()
+        threading.Thread(target=self._run_thread, args=(job,), daemon=True).start()
+
+    def cancel_process(self):
+        if self.export_job:
+            self.export_job.cancel() # export_done báo "Đã hủy"
+        if self.pending_run:
+            self.pending_run = False
+            self.lbl_status.config(text="Đã hủy.")
+        if self.job:
+            self.job.cancel()
+            self.job = None
+            self.lbl_status.config(text="Đã hủy.")
+
+    def _run_thread(self, job):
+        result = job.run()
+        self.root.after(0, self.publish_result, job, result)
+
+    def show_progress(self, job, phase, done):
+        if job is not self.job: return # job cũ đã bị thay thế
+        self.lbl_status.config(text=f"Đang xử lý: {phase}" + (f" ({done:,} dòng)" if done is not None else "") + "...")
+
+    def publish_result(self, job, result):
+        """Chạy trên luồng giao diện: chỉ job mới nhất, chưa hủy, mới được đưa lên lưới (đổi nguyên processor 1 lần)."""
+        if job is not self.job or result is None: return
+        self.job = None
+        ok, msg = result
+        stats = job.processor.stats
+        stats.info["ok"] = ok
+        if ok:
+            self.processor = job.processor
+            self.stored = None
+            p = self.processor
+            self.changed = p.changes["groups"] if p.changes else set()
+            stats.mark("Hiển thị", len(p.res_tab1) + len(p.res_tab2) + len(p.res_tab3))
+            self.refresh_views(keep_position=job.auto)
+            self.root.update_idletasks()
+            stats.mark(None)
+        if self.cfg.data["perf"].get("log", True): stats.append_log()
+        if ok: self.save_result(self.processor)
 
-    def _run_thread(self):
-        ok, msg = self.processor.run_analysis()
-        self.root.after(0, lambda: [self.refresh_views(), messagebox.showinfo("Kết quả", msg) if ok else messagebox.showerror("Lỗi", msg)])
-        self.root.after(0, lambda: self.lbl_status.config(text="Sẵn sàng."))
+        status = stats.summary() if ok else "Sẵn sàng."
+        ch = job.processor.changes
+        if ok and ch:
+            status = (f"Kiểm tra cộng dồn: +{ch['rows']:,} dòng PX, {len(ch['groups']):,} mã cập nhật "
+                      f"({ch['status_changed']:,} đổi trạng thái, {ch['new_groups']:,} mã mới). " + status)
+        if stats.info.get("profile"): status += f" | Profile: {stats.info['profile']}"
+        if job.auto:
+            self.lbl_status.config(text=("👁 Đã cập nhật. " + status) if ok else f"👁 Lỗi khi chạy lại: {msg}")
+            return
+        self.lbl_status.config(text=status)
+        if ok: messagebox.showinfo("Kết quả", msg)
+        else: messagebox.showerror("Lỗi", msg)
+
+    def refresh_views(self, keep_position=False):
+        self.on_search(None, keep_position) # Gọi hàm Search để nạp dữ liệu (vì search sẽ nạp dữ liệu gốc nếu ô search rỗng)
 
-    def refresh_views(self):
-        self.on_search(None) # Gọi hàm Search để nạp dữ liệu (vì search sẽ nạp dữ liệu gốc nếu ô search rỗng)
+    def on_search_key(self, event):
+        if event.keysym == "Return": return
+        if self.search_job: self.root.after_cancel(self.search_job)
+        self.search_job = self.root.after(SEARCH_DELAY_MS, self.on_search, None)
+
+    def build_search_index(self):
+        """Dựng 1 lần sau mỗi lần phân tích: chỉ mục tìm kiếm, thứ tự ưu tiên và cờ lỗi của từng tab."""
+        p = self.processor
+        t1, t2, t3 = p.res_tab1, p.res_tab2, p.res_tab3
+        # Sort ưu tiên: Lỗi -> Gộp -> OK (ổn định như sorted cũ)
+        prio1 = np.array([0 if r['Tag'] in ('do', 'vang', 'tim') else 1 if r['Tag'] == 'gop' else 2 for r in t1], dtype=np.int8)
+        err2 = np.asarray(field_values(t2, 'Tag'), dtype=object) != 'ok' # Tab 2 đọc thẳng theo cột
+        ch = self.changed
+        changed = lambda rows: (np.array([k in ch for k in zip(field_values(rows, 'Key'), field_values(rows, 'Item'))], dtype=bool)
+                                if ch else np.zeros(len(rows), dtype=bool))
+        self.search_idx = {
+            "processor": p, "version": p.version,
+            1: (SearchIndex(t1, ["Key", "Item", "Status"]), SortOrders(t1, np.argsort(prio1, kind="stable")), prio1 != 2, changed(t1)),
+            2: (SearchIndex(t2, ["Key", "Item", "SoPX", "Status"]), SortOrders(t2, np.argsort(~err2, kind="stable")), err2, changed(t2)),
+            3: (SearchIndex(t3, [], lambda r: " ".join([str(r[f]) for f in ("Loại", "Lỗi", "Mẫu Key", "Dòng")] + [t for _, t in r["Samples"]]).upper()),
+                SortOrders(t3, np.arange(len(t3))), np.ones(len(t3), dtype=bool), None),
+        }
 
-    def on_search(self, event):
-        """Hàm lọc dữ liệu & Hiển thị"""
+    def filtered_ids(self, tab, keyword, focus_err, only_changed=False):
+        index, sorts, is_err, is_changed = self.search_idx[tab]
+        order = sorts.get(*self.sort_state[tab])
+        keep = np.ones(index.n, dtype=bool) if not focus_err else is_err.copy()
+        if only_changed and is_changed is not None: keep &= is_changed
+        hits = index.search(keyword)
+        if hits is not None:
+            m = np.zeros(index.n, dtype=bool); m[hits] = True
+            keep &= m
+        return order[keep[order]]
+
+    def on_search(self, event, keep_position=False):
+        """Hàm lọc dữ liệu & Hiển thị. keep_position: giữ dòng đang chọn / vị trí cuộn (khi tự chạy lại)."""
+        if self.search_job: self.root.after_cancel(self.search_job)
+        self.search_job = None
+        if not self.core_ready.is_set(): return # chưa có dữ liệu
         keyword = self.normalize_search(self.entry_search.get())
         focus_err = self.var_focus.get()
-        
-        # --- TAB 1 ---
-        self.tree1.delete(*self.tree1.get_children())
-        raw_t1 = self.processor.res_tab1
-        
-        # Sort ưu tiên: Lỗi -> Gộp -> OK
-        def sort_prio(x):
-            if x['Tag'] in ['do', 'vang', 'tim']: return 0
-            if x['Tag'] == 'gop': return 1
-            return 2
-        
-        sorted_t1 = sorted(raw_t1, key=sort_prio)
-        
-        self.current_view_data_tab1 = [] # Lưu để xuất excel
-        
-        for r in sorted_t1:
-            # Filter Focus
-            if focus_err and r['Tag'] == 'ok' and r['Tag'] != 'gop': continue
-            
-            # Filter Search
-            search_str = f"{r['Key']} {r['Item']} {r['Status']}".upper()
-            if keyword and keyword not in search_str: continue
-            
-            # Thêm icon cho đơn gộp
-            item_display = r['Item']
-            if r.get('IsMerged', False):
-                item_display = "📦+ " + item_display
-                
-            vals = (r['Key'], item_display, r['Unit'], f"{r['SL_Dat']:g}", f"{r['SL_Xuat']:g}", f"{r['Lech']:g}", r['Status'])
-            self.tree1.insert("", "end", values=vals, tags=(r['Tag'],))
-            self.current_view_data_tab1.append(vals)
-
-        # --- TAB 2 ---
-        self.tree2.delete(*self.tree2.get_children())
-        raw_t2 = self.processor.res_tab2
-        sorted_t2 = sorted(raw_t2, key=lambda x: 0 if x['Tag'] != 'ok' else 1)
-        
-        self.current_view_data_tab2 = []
-        
-        for r in sorted_t2:
-            if focus_err and r['Tag'] == 'ok': continue
-            search_str = f"{r['Key']} {r['Item']} {r['SoPX']} {r['Status']}".upper()
-            if keyword and keyword not in search_str: continue
-            
-            vals = (r['SoPX'], r['Key'], r['Item'], r['Name'], r['Unit'], f"{r['SL_Dong']:g}", f"{r['Total_Dat']:g}", f"{r['Total_Xuat']:g}", f"{r['Lech_Tong']:g}", r['Status'])
-            self.tree2.insert("", "end", values=vals, tags=(r['Tag'],))
-            self.current_view_data_tab2.append(vals)
+        if self.stored: # lọc / sắp xếp bằng truy vấn trên results.db, lưới đọc theo trang
+            rows = lambda tab, fe: StoredRows(self.store, self.stored["id"], tab, keyword, fe, self.sort_state[tab])
+            self.view_tab1, self.view_tab2, self.view_tab3 = rows(1, focus_err), rows(2, focus_err), rows(3, False)
+            self.tree1.set_rows(self.view_tab1, self.fmt_tab1, keep_position)
+            self.tree2.set_rows(self.view_tab2, self.fmt_tab2, keep_position)
+            self.tree3.set_rows(self.view_tab3, self.fmt_tab3, keep_position)
+            return
+        idx = self.search_idx
+        if not idx or idx["processor"] is not self.processor or idx["version"] != self.processor.version:
+            self.build_search_index()
+
+        p = self.processor
+        only_changed = self.var_changed.get()
+        self.view_tab1 = RowView(p.res_tab1, self.filtered_ids(1, keyword, focus_err, only_changed))
+        self.view_tab2 = RowView(p.res_tab2, self.filtered_ids(2, keyword, focus_err, only_changed))
+        self.view_tab3 = GroupedRows(p.res_tab3, self.filtered_ids(3, keyword, False), self.expanded3)
+        self.tree1.set_rows(self.view_tab1, self.fmt_tab1, keep_position)
+        self.tree2.set_rows(self.view_tab2, self.fmt_tab2, keep_position)
+        self.tree3.set_rows(self.view_tab3, self.fmt_tab3, keep_position)
+
+    def on_sort(self, tab, col):
+        """Bấm tiêu đề cột: tăng dần -> giảm dần -> thứ tự mặc định (lỗi trước)."""
+        tree = {1: self.tree1, 2: self.tree2, 3: self.tree3}[tab]
+        field, desc = self.sort_state[tab]
+        if field != tree.fields[col]: state = (tree.fields[col], False)
+        elif not desc: state = (field, True)
+        else: state = (None, False)
+        self.sort_state[tab] = state
+        for c, f in tree.fields.items():
+            arrow = (" ▼" if state[1] else " ▲") if f == state[0] else ""
+            tree.heading(c, text=c + arrow)
+        if self.search_idx or self.stored: self.on_search(None)
+
+    # Định dạng 1 bản ghi -> (giá trị các cột, tag màu); lưới ảo chỉ gọi cho dòng đang hiển thị
+    def fmt_tab1(self, r):
+        # Thêm icon cho đơn gộp
+        item_display = "📦+ " + r['Item'] if r.get('IsMerged', False) else r['Item']
+        return (self.key_display(r), item_display, r['Unit'], f"{r['SL_Dat']:g}", f"{r['SL_Xuat']:g}", f"{r['Lech']:g}", r['Status']), r['Tag']
+
+    def fmt_tab2(self, r):
+        return (r['SoPX'], self.key_display(r), r['Item'], r['Name'], r['Unit'], f"{r['SL_Dong']:g}", f"{r['Total_Dat']:g}", f"{r['Total_Xuat']:g}", f"{r['Lech_Tong']:g}", r['Status']), r['Tag']
+
+    def key_display(self, r):
+        # Đánh dấu (Key, Item) có dòng PX mới ở lần kiểm tra cộng dồn
+        return "🆕 " + r['Key'] if self.changed and (r['Key'], r['Item']) in self.changed else r['Key']
 
-        # --- TAB 3 ---
-        self.tree3.delete(*self.tree3.get_children())
-        for r in self.processor.res_tab3:
-            search_str = str(r).upper()
-            if keyword and keyword not in search_str: continue
-            self.tree3.insert("", "end", values=(r['Loại'], r['Lỗi'], r['Dữ liệu']))
+    def fmt_tab3(self, r):
+        if r.get('Sample'): return ("", "", "", "", f"dòng {r['Dòng']}", r['Dữ liệu']), ""
+        text = lambda v: "" if v is None or v != v else str(v) # kết quả đã lưu từ bản cũ: cột mới để trống
+        mark = ("▾ " if group_id(r) in self.expanded3 else "▸ ") if r.get('Samples') else ""
+        return (mark + r['Loại'], r['Lỗi'], text(r.get('Mẫu Key')), text(r.get('Số dòng')), text(r.get('Dòng')), text(r['Dữ liệu'])), ""
+
+    def on_toggle_group(self, event):
+        view = self.view_tab3
+        i = self.tree3.index_at(event.y)
+        if i is None or not isinstance(view, GroupedRows): return # kết quả đã lưu không giữ dòng mẫu
+        g, _ = view.group_of(i)
+        r = view.groups[g]
+        if not r.get('Samples'): return
+        self.expanded3 ^= {group_id(r)}
+        self.view_tab3 = GroupedRows(view.groups.records, view.groups.ids, self.expanded3)
+        self.tree3.selected = int(self.view_tab3.starts[g])
+        self.tree3.set_rows(self.view_tab3, self.fmt_tab3, keep_position=True)
 
     def normalize_search(self, txt):
         return unicodedata.normalize('NFC', txt.strip().upper())
 
     # --- POPUP LOGIC ---
     def on_right_click(self, event):
-        item = self.tree1.identify_row(event.y)
-        if item:
-            self.tree1.selection_set(item)
+        i = self.tree1.index_at(event.y)
+        if i is not None:
+            self.tree1.select_index(i)
             self.context_menu.post(event.x_root, event.y_root)
 
     def on_popup_menu(self):
@@ -611,77 +892,210 @@ class MainApp:
         current_tab = self.nb.index(self.nb.select())
         tree = self.tree1 if current_tab == 0 else self.tree2
         
-        sel = tree.selection()
-        if not sel: return
-        vals = tree.item(sel[0], "values")
-        
-        # Tab 1: Key=0, Item=1; Tab 2: Key=1, Item=2
-        key = vals[0] if current_tab == 0 else vals[1]
-        item_raw = vals[1] if current_tab == 0 else vals[2]
-        
-        # Bỏ icon 📦+ nếu có
-        item = item_raw.replace("📦+ ", "")
+        r = tree.selected_record()
+        if not r: return
+        key, item = r['Key'], r['Item']
         
-        details = self.processor.detail_map.get((key, item))
-        if not details: return
-        
-        is_bag = item in self.cfg.data["bag_items"]
-        
-        SmartPopup(self.root, f"CHI TIẾT: {key} - {item}", details['orders'], details['exports'], is_bag)
+        if self.stored:
+            source = DetailSource((key, item), store=self.store, run_id=self.stored["id"])
+        else:
+            source = DetailSource((key, item), self.processor.detail_map)
+        if not source: return
+
+        # Tổng 2 bên đã cộng sẵn trên dòng đang chọn (Tab 1: SL_Dat / SL_Xuat, Tab 2: Total_Dat / Total_Xuat), cùng đơn vị với dòng
+        totals = (r['SL_Dat'], r['SL_Xuat']) if 'SL_Dat' in r else (r['Total_Dat'], r['Total_Xuat'])
+        SmartPopup.open(self.root, f"CHI TIẾT: {key} - {item}", source, totals, r['Unit'] == "Túi")
 
     # --- EXPORT EXCEL ---
     def export_excel(self):
-        current_tab = self.nb.index(self.nb.select())
-        
-        if current_tab == 0:
-            cols = ["Key", "Mã Hàng", "Đơn Vị", "SL Đặt", "SL Xuất", "LỆCH", "TRẠNG THÁI"]
-            data = self.current_view_data_tab1
-            sheet_name = "TongHop"
-        elif current_tab == 1:
-            cols = ["Số PX", "Key", "Mã Hàng", "Tên Hàng", "Đơn Vị", "SL Dòng", "Tổng Đặt", "Tổng Xuất", "LỆCH TỔNG", "TRẠNG THÁI"]
-            data = self.current_view_data_tab2
-            sheet_name = "ChiTiet"
-        else:
-            messagebox.showinfo("Info", "Tab Ngoại lệ chưa hỗ trợ xuất in đẹp. Hãy copy trực tiếp.")
-            return
-
-        if not data:
+        """Xuất 1 file nhiều sheet ở luồng nền: Tab 1 / Tab 2 đúng như đang thấy (lọc + sắp xếp), Tab 3,
+        và chi tiết Đơn Hàng / Phiếu Xuất của các mã trên Tab 1."""
+        if self.export_job:
+            messagebox.showinfo("Xuất Excel", "Đang xuất file trước - bấm DỪNG nếu muốn hủy."); return
+        if not (len(self.view_tab1) or len(self.view_tab2) or len(self.view_tab3)):
             messagebox.showwarning("Trống", "Không có dữ liệu để xuất!")
             return
 
         # Tạo file
         timestamp = datetime.now().strftime("%H%M%S")
-        fname = f"BaoCao_{sheet_name}_{timestamp}.xlsx"
-        
-        df = pd.DataFrame(data, columns=cols)
+        fname = f"BaoCao_DoiChieu_{timestamp}.xlsx"
+
+        if self.stored:
+            orders, exports = stored_details(self.store, self.stored["id"], self.view_tab1, self.stored["n1"])
+        else:
+            orders, exports = processor_details(self.view_tab1, self.processor.detail_map)
+        parts = dict(tab1=self.view_tab1, tab2=self.view_tab2, tab3=getattr(self.view_tab3, "groups", self.view_tab3), orders=orders, exports=exports)
+        job = ExportJob(fname, parts)
+        job.on_progress = lambda phase, done: self.root.after(0, self.show_export_progress, job, phase, done)
+        job.t0 = time.perf_counter()
+        self.export_job = job
+        self.lbl_status.config(text="Đang xuất Excel...")
+        threading.Thread(target=self._export_thread, args=(job,), daemon=True).start()
+
+    def _export_thread(self, job):
         try:
-            df.to_excel(fname, index=False)
-            os.startfile(fname) # Mở file ngay (Windows)
+            job.run()
+            err = None
         except Exception as e:
-            messagebox.showerror("Lỗi Xuất File", str(e))
+            err = e
+        self.root.after(0, self.export_done, job, err)
+
+    def show_export_progress(self, job, phase, done):
+        if job is not self.export_job or job.cancelled.is_set(): return
+        self.lbl_status.config(text=f"Đang xuất Excel: {phase} ({done:,} dòng)...")
+
+    def export_done(self, job, err):
+        if job is not self.export_job: return
+        self.export_job = None
+        if err:
+            self.lbl_status.config(text="Lỗi xuất Excel.")
+            messagebox.showerror("Lỗi Xuất File", str(err)); return
+        if job.result is None:
+            self.lbl_status.config(text="Đã hủy xuất Excel."); return
+        self.lbl_status.config(text=f"Đã xuất {sum(job.result.values()):,} dòng ra {job.path} "
+                                    f"({time.perf_counter() - job.t0:.1f}s).")
+        try:
+            os.startfile(job.path) # Mở file ngay (Windows)
+        except Exception: pass
 
     # --- TIỆN ÍCH KHÁC ---
     def open_bag_manager(self):
         items = set()
-        if self.processor.detail_map:
+        if self.stored:
+            items = self.store.items(self.stored["id"])
+        elif self.processor and self.processor.detail_map:
              items = {k[1] for k in self.processor.detail_map.keys()}
-        BagManagerDialog(self.root, self.cfg, items) # (Cần class BagManagerDialog như cũ)
+        BagManagerDialog(self.root, self.cfg, items, on_save=self.apply_status_change) # (Cần class BagManagerDialog như cũ)
 
     def quick_add_bag(self):
-        sel = self.tree1.selection()
-        if not sel: return
-        val = self.tree1.item(sel[0], "values")[1].replace("📦+ ", "")
+        r = self.tree1.selected_record()
+        if not r: return
+        val = r['Item']
         if val not in self.cfg.data["bag_items"]:
-            self.cfg.data["bag_items"].append(val)
+            self.cfg.data["bag_items"].add(val)
             self.cfg.save()
+            self.apply_status_change([val])
             messagebox.showinfo("OK", f"Đã thêm {val} vào tính Túi.")
 
+    # --- DANH MỤC ALIAS / HÀNG TÚI ---
+    def import_catalog(self, replace):
+        if not self.core_ready.is_set(): return
+        path = filedialog.askopenfilename(filetypes=[("Excel", "*.xlsx *.xls")])
+        if not path: return
+        if replace and not messagebox.askyesno("Xác nhận", "Thay toàn bộ alias / hàng túi bằng nội dung file (sheet nào có trong file)?"):
+            return
+        self.lbl_status.config(text="Đang đọc danh mục...")
+
+        def work():
+            try:
+                res, err = read_catalog(self.cfg, path), None
+            except Exception as e:
+                res, err = None, e
+            self.root.after(0, done, res, err)
+
+        def done(res, err): # gộp trên luồng giao diện: processor / dialog đang đọc cùng dict, set
+            if err:
+                self.lbl_status.config(text="Lỗi nhập danh mục.")
+                messagebox.showerror("Lỗi", f"Không nhập được danh mục:\n{err}"); return
+            old_alias, bags_changed, n_alias = merge_catalog(self.cfg, *res, replace=replace)
+            self.lbl_status.config(text=f"Đã nhập danh mục: {n_alias:,} alias thay đổi, {len(bags_changed):,} mã túi thay đổi "
+                                        f"(tổng {len(self.cfg.data['alias_map']):,} alias, {len(self.cfg.data['bag_items']):,} mã túi).")
+            if n_alias: self.apply_alias_change(old_alias)
+            if bags_changed: self.apply_status_change(bags_changed)
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def export_catalog(self):
+        if not self.core_ready.is_set(): return
+        path = filedialog.asksaveasfilename(defaultextension=".xlsx", initialfile="danh_muc.xlsx", filetypes=[("Excel", "*.xlsx")])
+        if not path: return
+        try:
+            n_alias, n_bag = export_catalog(self.cfg, path)
+        except Exception as e:
+            messagebox.showerror("Lỗi", f"Không ghi được file:\n{e}"); return
+        self.lbl_status.config(text=f"Đã xuất {n_alias:,} alias, {n_bag:,} mã túi ra {os.path.basename(path)}.")
+
+    def edit_tolerance(self):
+        tol = self.cfg.data["tolerance"]
+        new = {}
+        for k, label in (("kg_min", "Lệch Kg tối thiểu (âm = cho thiếu):"), ("kg_max", "Lệch Kg tối đa:"), ("bag_diff", "Lệch Túi cho phép:")):
+            v = simpledialog.askfloat("Dung sai", label, initialvalue=tol[k], parent=self.root)
+            if v is None: return
+            new[k] = int(v) if k == "bag_diff" else v
+        tol.update(new); self.cfg.save()
+        self.apply_status_change(None)
+
+    def open_tolerance_rules(self):
+        ToleranceRulesDialog(self.root, self.cfg, on_save=lambda: self.apply_status_change(None))
+
+    def apply_status_change(self, items):
+        """Hàng túi / dung sai đổi: tính lại trạng thái trên dữ liệu đã đọc thay vì chạy lại từ file (engine "loop" thì chạy lại)."""
+        t0 = datetime.now()
+        if self.stored:
+            self.lbl_status.config(text="Đã lưu cấu hình. Đang xem kết quả đã lưu - bấm CHẠY để tính lại.")
+        elif self.processor and self.processor.update_status(items):
+            self.refresh_views()
+            ms = (datetime.now() - t0).total_seconds() * 1000
+            self.lbl_status.config(text=f"Đã cập nhật trạng thái ({ms:.0f} ms).")
+            self.save_result(self.processor)
+        elif self.processor and self.processor.res_tab1: # engine "loop": không tính lại nhanh được -> chạy lại từ file
+            self.run_process()
+
+    def open_alias_suggest(self, record=None):
+        """Gợi ý mã đặt cho các dòng KHÔNG ĐẶT MÀ XUẤT; record (dòng Tab 1) = chỉ xem gợi ý của dòng đó."""
+        if self.stored or not self.processor or not self.processor.res_tab1:
+            messagebox.showinfo("Gợi ý mã hàng", "Cần chạy đối chiếu trước (kết quả đã lưu không có chi tiết để so mã)."); return
+        if record is not None and record.get("Tag") != "tim":
+            messagebox.showinfo("Gợi ý mã hàng", "Chỉ gợi ý cho dòng KHÔNG ĐẶT MÀ XUẤT."); return
+        p = self.processor
+        self.lbl_status.config(text="Đang tìm mã đặt gần giống...")
+
+        def work():
+            try:
+                sug = AliasSuggester(p.res_tab1, p.detail_map)
+                if record is None:
+                    rows = sug.suggest_all()
+                else:
+                    name = sug.name_of(record["Key"], record["Item"], "exports")
+                    rows = [{"Key": record["Key"], "Item": record["Item"], "Name": name, "SL_Xuat": record["SL_Xuat"],
+                             "Suggest": cand, "SuggestName": sug.name_of(record["Key"], cand, "orders"),
+                             "Score": round(score, 3), "Rank": rank, "OrderedElsewhere": sug.ordered_in[record["Item"]]}
+                            for rank, (cand, score) in enumerate(sug.suggest(record["Key"], record["Item"], name, top=5))]
+                err = None
+            except Exception as e:
+                rows, err = [], e
+            self.root.after(0, done, rows, err)
+
+        def done(rows, err):
+            if p is not self.processor: return # đã chạy lại trong lúc tìm
+            if err:
+                self.lbl_status.config(text=f"Lỗi gợi ý mã: {err}"); return
+            self.lbl_status.config(text=f"{len({(r['Key'], r['Item']) for r in rows}):,} mã xuất có gợi ý.")
+            if not rows:
+                messagebox.showinfo("Gợi ý mã hàng", "Không tìm thấy mã đặt nào đủ giống."); return
+            AliasSuggestDialog(self.root, self.cfg, rows, on_save=self.apply_alias_change)
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def apply_alias_change(self, old_alias_map):
+        """alias_map đổi: đổi khóa các dòng liên quan; trường hợp không tính nhanh được thì chạy lại toàn bộ."""
+        if not self.processor: return
+        if self.stored:
+            self.lbl_status.config(text="Đã lưu alias. Đang xem kết quả đã lưu - bấm CHẠY để tính lại.")
+        elif self.processor.update_aliases(old_alias_map):
+            self.refresh_views()
+            self.lbl_status.config(text="Đã cập nhật alias.")
+            self.save_result(self.processor)
+        elif self.processor.res_tab1:
+            self.run_process()
+
 # =============================================================================
 # CÁC CLASS PHỤ (LOGIN, BAG MANAGER) - GIỮ NGUYÊN TỪ VERSION TRƯỚC
 # =============================================================================
 class BagManagerDialog:
-    def __init__(self, parent, config_mgr, all_items):
+    def __init__(self, parent, config_mgr, all_items, on_save=None):
         self.top = tk.Toplevel(parent)
+        self.on_save = on_save
         self.top.title("QUẢN LÝ HÀNG TÍNH TÚI")
         self.top.geometry("700x500")
         self.cfg = config_mgr
@@ -710,7 +1124,194 @@ class BagManagerDialog:
             if s in self.current_bags: self.current_bags.remove(s)
         self.refresh()
     def save(self):
-        self.cfg.data["bag_items"] = list(self.current_bags); self.cfg.save(); self.top.destroy()
+        changed = self.current_bags ^ set(self.cfg.data["bag_items"])
+        self.cfg.data["bag_items"] = set(self.current_bags); self.cfg.save(); self.top.destroy()
+        if self.on_save and changed: self.on_save(changed)
+
+class ToleranceRulesDialog:
+    """Dung sai riêng theo mã hàng / nhóm hàng / tiền tố Key (ST, DC, KH). Rule ở trên được ưu tiên;
+    ô dung sai để trống = theo dung sai chung; "%" = các giá trị của rule tính theo % SL đặt."""
+    RULE_COLS = (("item", "Mã hàng (cách nhau dấu phẩy)", 200), ("group", "Nhóm hàng", 110), ("key_prefix", "Tiền tố Key", 90),
+                 ("kg_min", "Kg min", 70), ("kg_max", "Kg max", 70), ("bag_diff", "Túi", 60), ("pct", "%", 40))
+    NUMBERS = ("kg_min", "kg_max", "bag_diff")
+
+    def __init__(self, parent, config_mgr, on_save=None):
+        self.top = tk.Toplevel(parent)
+        self.top.title("DUNG SAI RIÊNG")
+        self.top.geometry("820x560")
+        self.cfg = config_mgr
+        self.on_save = on_save
+        tol = self.cfg.data["tolerance"]
+
+        f1 = tk.LabelFrame(self.top, text="Rule (trên xuống = ưu tiên cao xuống thấp)"); f1.pack(fill="both", expand=True, padx=10, pady=(10, 5))
+        self.tree = ttk.Treeview(f1, columns=[c for c, _, _ in self.RULE_COLS], show="headings", selectmode="browse", height=8)
+        for c, text, w in self.RULE_COLS:
+            self.tree.heading(c, text=text); self.tree.column(c, width=w)
+        self.tree.pack(fill="both", expand=True)
+        self.tree.bind("<<TreeviewSelect>>", lambda e: self.load_selected())
+        fe = tk.Frame(f1); fe.pack(fill="x", pady=5)
+        self.entries = {}
+        for c, text, _ in self.RULE_COLS[:-1]:
+            tk.Label(fe, text=text.split(" (")[0]).pack(side="left")
+            self.entries[c] = tk.Entry(fe, width=22 if c == "item" else 8); self.entries[c].pack(side="left", padx=(0, 5))
+        self.var_pct = tk.BooleanVar()
+        tk.Checkbutton(fe, text="%", variable=self.var_pct).pack(side="left")
+        fb = tk.Frame(f1); fb.pack(fill="x")
+        tk.Button(fb, text="➕ Thêm", command=lambda: self.put_rule(False)).pack(side="left", padx=2)
+        tk.Button(fb, text="✎ Sửa dòng chọn", command=lambda: self.put_rule(True)).pack(side="left", padx=2)
+        tk.Button(fb, text="✖ Xóa", command=lambda: self.delete(self.tree)).pack(side="left", padx=2)
+        tk.Button(fb, text="▲", command=lambda: self.move(-1)).pack(side="left", padx=2)
+        tk.Button(fb, text="▼", command=lambda: self.move(1)).pack(side="left", padx=2)
+
+        f2 = tk.LabelFrame(self.top, text="Nhóm hàng"); f2.pack(fill="both", padx=10, pady=5)
+        self.tree_groups = ttk.Treeview(f2, columns=("name", "items"), show="headings", height=4)
+        self.tree_groups.heading("name", text="Tên nhóm"); self.tree_groups.column("name", width=120)
+        self.tree_groups.heading("items", text="Mã hàng"); self.tree_groups.column("items", width=600)
+        self.tree_groups.pack(fill="both", expand=True)
+        fg = tk.Frame(f2); fg.pack(fill="x", pady=5)
+        tk.Label(fg, text="Tên").pack(side="left"); self.e_group = tk.Entry(fg, width=14); self.e_group.pack(side="left", padx=(0, 5))
+        tk.Label(fg, text="Mã hàng").pack(side="left"); self.e_group_items = tk.Entry(fg, width=50); self.e_group_items.pack(side="left", padx=(0, 5))
+        tk.Button(fg, text="➕ Thêm / thay", command=self.put_group).pack(side="left", padx=2)
+        tk.Button(fg, text="✖ Xóa", command=lambda: self.delete(self.tree_groups)).pack(side="left", padx=2)
+
+        tk.Button(self.top, text="LƯU CẤU HÌNH", bg="green", fg="white", command=self.save).pack(pady=5)
+        for r in tol.get("rules") or []:
+            self.tree.insert("", "end", values=self.rule_values(r))
+        for name, items in (tol.get("item_groups") or {}).items():
+            self.tree_groups.insert("", "end", values=(name, ", ".join(items)))
+
+    @staticmethod
+    def rule_values(r):
+        text = lambda v: ", ".join(v) if isinstance(v, (list, tuple)) else ("" if v is None else str(v))
+        return [text(r.get(c)) for c, _, _ in ToleranceRulesDialog.RULE_COLS[:-1]] + ["✔" if r.get("pct") else ""]
+
+    def load_selected(self):
+        sel = self.tree.selection()
+        if not sel: return
+        vals = self.tree.item(sel[0], "values")
+        for (c, _, _), v in zip(self.RULE_COLS, vals):
+            if c in self.entries:
+                self.entries[c].delete(0, tk.END); self.entries[c].insert(0, v)
+        self.var_pct.set(vals[-1] == "✔")
+
+    def put_rule(self, replace):
+        vals = {c: e.get().strip() for c, e in self.entries.items()}
+        if not (vals["item"] or vals["group"] or vals["key_prefix"]):
+            messagebox.showwarning("Dung sai", "Cần ít nhất 1 điều kiện: mã hàng, nhóm hàng hoặc tiền tố Key.", parent=self.top); return
+        for c in self.NUMBERS:
+            try:
+                if vals[c]: float(vals[c])
+            except ValueError:
+                messagebox.showwarning("Dung sai", f"Giá trị không hợp lệ: {vals[c]}", parent=self.top); return
+        row = [vals[c] for c, _, _ in self.RULE_COLS[:-1]] + ["✔" if self.var_pct.get() else ""]
+        sel = self.tree.selection()
+        if replace and sel: self.tree.item(sel[0], values=row)
+        else: self.tree.insert("", "end", values=row)
+
+    def put_group(self):
+        name = self.e_group.get().strip()
+        if not name: return
+        for iid in self.tree_groups.get_children():
+            if str(self.tree_groups.item(iid, "values")[0]) == name: self.tree_groups.delete(iid)
+        self.tree_groups.insert("", "end", values=(name, self.e_group_items.get().strip()))
+
+    def delete(self, tree):
+        for iid in tree.selection(): tree.delete(iid)
+
+    def move(self, step):
+        sel = self.tree.selection()
+        if sel: self.tree.move(sel[0], "", max(0, self.tree.index(sel[0]) + step))
+
+    def save(self):
+        split = lambda v: [x.strip() for x in str(v).split(",") if x.strip()]
+        rules = []
+        for iid in self.tree.get_children():
+            vals = dict(zip([c for c, _, _ in self.RULE_COLS], map(str, self.tree.item(iid, "values")))) # Tk có thể trả về số
+            r = {}
+            if vals["item"]: r["item"] = split(vals["item"])
+            if vals["group"]: r["group"] = vals["group"]
+            if vals["key_prefix"]: r["key_prefix"] = split(vals["key_prefix"])
+            for c in self.NUMBERS:
+                if vals[c] != "": r[c] = float(vals[c])
+            if vals["pct"]: r["pct"] = True
+            rules.append(r)
+        groups = {}
+        for iid in self.tree_groups.get_children():
+            name, items = self.tree_groups.item(iid, "values")
+            groups[str(name)] = split(items)
+        tol = self.cfg.data["tolerance"]
+        changed = rules != (tol.get("rules") or []) or groups != (tol.get("item_groups") or {})
+        tol["rules"], tol["item_groups"] = rules, groups
+        self.cfg.save(); self.top.destroy()
+        if self.on_save and changed: self.on_save()
+
+class AliasSuggestDialog:
+    """Danh sách gợi ý mã xuất -> mã đặt; chọn rồi ÁP DỤNG (hoặc nhấp đúp) để ghi vào alias_map."""
+    COLS = (("Key", "Khách", 80), ("Item", "Mã xuất", 120), ("Name", "Tên xuất", 170), ("SL_Xuat", "SL xuất", 70),
+            ("Suggest", "→ Mã đặt", 120), ("SuggestName", "Tên đặt", 170), ("Score", "Điểm", 60), ("OrderedElsewhere", "KH khác đặt", 80))
+
+    def __init__(self, parent, config_mgr, rows, on_save=None):
+        self.top = tk.Toplevel(parent)
+        self.top.title("GỢI Ý MÃ HÀNG (KHÔNG ĐẶT MÀ XUẤT)")
+        self.top.geometry("1000x500")
+        self.cfg = config_mgr
+        self.on_save = on_save
+        self.rows = rows
+        tk.Label(self.top, text="Mỗi mã xuất có tối đa vài gợi ý (dòng in đậm = gợi ý tốt nhất). "
+                                "Chọn dòng rồi ÁP DỤNG: mã xuất sẽ được ghi alias sang mã đặt.", anchor="w").pack(fill="x", padx=10, pady=(10, 0))
+        f = tk.Frame(self.top); f.pack(fill="both", expand=True, padx=10, pady=5)
+        self.tree = ttk.Treeview(f, columns=[c for c, _, _ in self.COLS], show="headings", selectmode="extended")
+        for c, text, w in self.COLS:
+            self.tree.heading(c, text=text)
+            self.tree.column(c, width=w, anchor="e" if c in ("SL_Xuat", "Score", "OrderedElsewhere") else "w")
+        self.tree.tag_configure("best", font=("Arial", 9, "bold"))
+        sb = ttk.Scrollbar(f, command=self.tree.yview); self.tree.configure(yscrollcommand=sb.set)
+        sb.pack(side="right", fill="y"); self.tree.pack(fill="both", expand=True)
+        for i, r in enumerate(rows):
+            vals = [f"{r[c]:,.2f}" if c in ("SL_Xuat", "Score") else r[c] for c, _, _ in self.COLS]
+            self.tree.insert("", "end", iid=str(i), values=vals, tags=("best",) if r["Rank"] == 0 else ())
+        self.tree.bind("<Double-1>", lambda e: self.apply())
+        tk.Button(self.top, text="✔ ÁP DỤNG", bg="green", fg="white", command=self.apply).pack(pady=5)
+
+    def apply(self):
+        chosen = {}
+        for iid in self.tree.selection(): # mỗi mã xuất lấy gợi ý chọn đầu tiên
+            r = self.rows[int(iid)]
+            chosen.setdefault(r["Item"], r)
+        if not chosen: return
+        shared = [it for it, r in chosen.items() if r["OrderedElsewhere"]]
+        if shared and not messagebox.askyesno("Xác nhận", f"{len(shared)} mã xuất vẫn là mã đặt của khách khác "
+                                              f"(vd. {shared[0]}). Alias áp dụng cho mọi khách - vẫn ghi?", parent=self.top):
+            return
+        alias_map = self.cfg.data["alias_map"]
+        old = dict(alias_map)
+        for item, r in chosen.items():
+            AliasSuggester.accept(alias_map, item, r["Suggest"])
+        self.cfg.save()
+        for iid in self.tree.get_children(): # bỏ mọi gợi ý của các mã đã xử lý
+            if self.rows[int(iid)]["Item"] in chosen: self.tree.delete(iid)
+        if self.on_save: self.on_save(old)
+        if not self.tree.get_children(): self.top.destroy()
+
+class RunHistoryDialog:
+    """Danh sách các lần chạy đã lưu trong results.db; nhấp đúp (hoặc MỞ) để xem lại."""
+    def __init__(self, parent, store, on_open):
+        self.top = tk.Toplevel(parent)
+        self.top.title("CÁC LẦN CHẠY ĐÃ LƯU")
+        self.top.geometry("900x400")
+        self.on_open = on_open
+        self.runs = store.runs()
+        self.lb = tk.Listbox(self.top, font=("Consolas", 10)); self.lb.pack(fill="both", expand=True, padx=10, pady=10)
+        for r in self.runs:
+            self.lb.insert(tk.END, f"{r['created'].replace('T', ' ')}  | {r['n1']:>8,} dòng | {r['errors']:>6,} lỗi | "
+                                   f"{os.path.basename(str(r['dh']))} / {os.path.basename(str(r['px']))}")
+        self.lb.bind("<Double-1>", lambda e: self.open())
+        tk.Button(self.top, text="MỞ", bg="green", fg="white", command=self.open).pack(pady=5)
+    def open(self):
+        sel = self.lb.curselection()
+        if not sel: return
+        self.top.destroy()
+        self.on_open(self.runs[sel[0]])
 
 if __name__ == "__main__":
     root = tk.Tk()
@@ -0,0 +1,203 @@
+# Cấu hình & hằng số dùng chung. Chỉ dùng thư viện chuẩn để giao diện mở nhanh (pandas nạp sau, trong check_core).
+import atexit
+import json
+import os
+import hashlib
+import sqlite3
+import sys
+import threading
+import weakref
+
+# =============================================================================
+# 1. CẤU HÌNH & HẰNG SỐ
+# =============================================================================
+
+CONFIG_FILE = "config_system.json"
+CACHE_DIR = ".cache_excel" # Cache file Excel đã đọc (Arrow/feather)
+PERF_LOG = "perf_log.jsonl" # Mỗi lần chạy 1 dòng JSON: thời gian từng bước, số dòng, bộ nhớ
+PROFILE_DIR = "profiles" # Báo cáo cProfile/tracemalloc (chế độ perf.profile)
+RESULT_DB = "results.db" # Kết quả các lần chạy (SQLite) - mở lại không cần đọc file
+CATALOG_DB = "catalog.db" # alias_map + bag_items của config_system.json (SQLite, xem Catalog)
+CATALOG_KEYS = ("alias_map", "bag_items") # không còn ghi trong file JSON cấu hình
+
+# Cột hệ thống mặc định
+SYSTEM_COLS = {
+   "dh_code": "Mã Khách/ĐC (Đơn Hàng)",
+   "dh_item": "Mã Hàng (Đơn Hàng)",
+   "dh_name": "Tên Hàng (Đơn Hàng)",
+   "dh_sl": "Số Lượng (Đơn Hàng)",
+   "dh_so": "Số Đơn Hàng",
+   "dh_note": "Ghi chú", # Thêm cột ghi chú nếu có
+   
+   "px_code": "Mã Khách/ĐC (Phiếu Xuất)",
+   "px_item": "Mã Hàng (Phiếu Xuất)",
+   "px_name": "Tên Hàng (Phiếu Xuất)",
+   "px_sl_xuat": "SL Xuất (Kg/Thùng)",
+   "px_sl_tui": "SL Túi/Con",
+   "px_so": "Số Phiếu Xuất"
+}
+
+# =============================================================================
+# 2. HỆ THỐNG BẢO MẬT & CẤU HÌNH
+# =============================================================================
+
+class SecurityManager:
+    @staticmethod
+    def hash_pin(pin):
+        return hashlib.sha256(str(pin).encode()).hexdigest()
+
+_CATALOGS = weakref.WeakSet() # Catalog còn sống - ghi nốt khi thoát (1 lần atexit cho cả process)
+
+def _flush_catalogs():
+    for catalog in list(_CATALOGS): catalog.flush()
+
+atexit.register(_flush_catalogs)
+
+class Catalog:
+    """Danh mục alias (mã gốc -> mã chuẩn) và hàng tính túi, lưu trong SQLite riêng (khóa chính = chỉ mục).
+    Trong bộ nhớ là dict / set (tra O(1)), chính là cfg.data["alias_map"] / cfg.data["bag_items"].
+    Ghi kiểu write-behind: save() chỉ hẹn giờ; luồng nền ghi phần chênh lệch so với lần ghi trước trong 1 transaction.
+    Ghi lỗi thì giữ lại phần chờ để hẹn ghi lại; error = thông báo lỗi lần ghi gần nhất (None = đã ghi được)."""
+    DELAY = 1.0 # giây gom các lần save() liên tiếp
+
+    def __init__(self, path):
+        self.path = path
+        self._saved = ({}, set()) # nội dung đã có trong file
+        self._pending = None # (alias_map, bag_items) chờ ghi
+        self._timer = None
+        self._lock = threading.Lock() # giữ _pending / _timer
+        self._write_lock = threading.Lock() # 1 lần ghi tại 1 thời điểm
+        self.error = None
+        _CATALOGS.add(self)
+
+    def load(self):
+        """-> (alias_map dict, bag_items set) đọc từ file; chưa có file thì rỗng."""
+        alias, bags = {}, set()
+        if os.path.exists(self.path):
+            try:
+                con = sqlite3.connect(self.path)
+                try:
+                    alias = dict(con.execute("SELECT raw, target FROM alias"))
+                    bags = {r[0] for r in con.execute("SELECT item FROM bag")}
+                finally:
+                    con.close()
+            except sqlite3.Error: pass
+        self._saved = (dict(alias), set(bags))
+        return alias, bags
+
+    def save(self, alias_map, bag_items):
+        with self._lock:
+            self._pending = (alias_map, bag_items)
+            self._schedule()
+
+    def _schedule(self):
+        # gọi khi đang giữ _lock
+        if self._timer: self._timer.cancel()
+        self._timer = threading.Timer(self.DELAY, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self):
+        """Ghi ngay phần đang chờ (gọi từ timer, khi thoát chương trình, hoặc khi cần file cập nhật ngay).
+        -> True nếu file đã có đủ danh mục, False nếu ghi lỗi (phần chờ được giữ lại, hẹn ghi lại)."""
+        with self._lock:
+            pending, self._pending = self._pending, None
+            if self._timer: self._timer.cancel()
+            self._timer = None
+        if pending is None: return self.error is None
+        with self._write_lock:
+            alias, bags = dict(pending[0]), set(pending[1]) # chụp lại: giao diện có thể đang sửa tiếp
+            old_alias, old_bags = self._saved
+            upsert = [(k, v) for k, v in alias.items() if k not in old_alias or old_alias[k] != v]
+            removed = [(k,) for k in old_alias.keys() - alias.keys()]
+            if not upsert and not removed and bags == old_bags:
+                self.error = None
+                return True
+            try:
+                con = sqlite3.connect(self.path, timeout=30)
+                try:
+                    con.execute("PRAGMA journal_mode=WAL")
+                    with con: # 1 transaction: đọc lại luôn thấy danh mục trọn vẹn
+                        con.execute("CREATE TABLE IF NOT EXISTS alias (raw TEXT PRIMARY KEY, target TEXT NOT NULL)")
+                        con.execute("CREATE TABLE IF NOT EXISTS bag (item TEXT PRIMARY KEY)")
+                        con.executemany("INSERT OR REPLACE INTO alias VALUES (?, ?)", upsert)
+                        con.executemany("DELETE FROM alias WHERE raw = ?", removed)
+                        con.executemany("INSERT OR IGNORE INTO bag VALUES (?)", [(i,) for i in bags - old_bags])
+                        con.executemany("DELETE FROM bag WHERE item = ?", [(i,) for i in old_bags - bags])
+                finally:
+                    con.close()
+                self._saved = (alias, bags)
+                self.error = None
+                return True
+            except sqlite3.Error as e:
+                self.error = f"Không ghi được danh mục {self.path}: {e}"
+                print(self.error, file=sys.stderr)
+                with self._lock:
+                    if self._pending is None: self._pending = pending # save() mới hơn thì lấy bản mới
+                    self._schedule()
+                return False
+
+def catalog_path(config_path):
+    # config mặc định -> catalog.db; config khác (batch) -> <tên config>.catalog.db cạnh file đó
+    if os.path.abspath(config_path) == os.path.abspath(CONFIG_FILE): return CATALOG_DB
+    return os.path.splitext(config_path)[0] + ".catalog.db"
+
+class ConfigManager:
+    def __init__(self, path=CONFIG_FILE):
+        self.path = path
+        self.catalog = Catalog(catalog_path(path))
+        self.migrate = False # file JSON còn alias_map / bag_items (bản cũ): chỉ bỏ khỏi JSON khi Catalog đã ghi xong
+        self.data = {
+            "pin_hash": SecurityManager.hash_pin("1234"),
+            "paths": {"dh": "", "px": ""},
+            "col_map": {},
+            "bag_items": set(), # Catalog: không lưu trong file JSON
+            "alias_map": {},
+            # rules: dung sai riêng theo mã / nhóm hàng (item_groups) / tiền tố Key / % SL đặt (xem ToleranceRules)
+            "tolerance": {"kg_min": 0.0, "kg_max": 0.0, "bag_diff": 0, "rules": [], "item_groups": {}},
+            "engine": "vector", # "vector" (tính theo cột) | "loop" (duyệt từng dòng - bản gốc)
+            "cache": {"enabled": True, "max_mb": 500, "max_days": 14},
+            "stream": {"enabled": False, "chunk_rows": 50000}, # Đọc file lớn theo khối (chỉ .xlsx, engine vector)
+            # Chỉ đọc các cột trong col_map: dò dòng tiêu đề trong header_rows dòng đầu, tên cột khớp gần đúng từ tỉ lệ fuzzy (0-1)
+            "read": {"prune_columns": True, "header_rows": 30, "fuzzy": 0.85},
+            "read_workers": 0, # Số process đọc file song song (0 = theo số CPU, 1 = tắt)
+            "perf": {"log": True, "profile": False}, # Ghi perf_log.jsonl / chạy kèm cProfile + tracemalloc
+            "store": {"enabled": True, "keep_runs": 30, "open_last": True}, # Lưu kết quả vào results.db, mở lại lần chạy cuối khi khởi động
+            "incremental": True, # Phiếu Xuất chỉ ghi thêm dòng: chỉ xử lý dòng mới
+            "watch": {"enabled": False, "interval": 1.0, "debounce": 2.0}, # Tự chạy lại khi file đầu vào được lưu (giây)
+            "service": {"host": "127.0.0.1", "port": 8765, "workers": 2, "cache_runs": 20} # python service.py (HTTP/JSON cho ERP)
+        }
+        self.load()
+
+    def load(self):
+        self.data["alias_map"], self.data["bag_items"] = self.catalog.load()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    loaded = json.load(f)
+                    self.migrate = any(k in loaded for k in CATALOG_KEYS)
+                    for k, v in loaded.items():
+                        if k == "bag_items": # file cũ / config batch còn danh mục trong JSON: gộp vào, lần save sau chuyển sang Catalog
+                            self.data[k].update(v)
+                        elif k in self.data and isinstance(self.data[k], dict):
+                            self.data[k].update(v)
+                        else:
+                            self.data[k] = v
+            except: pass
+
+    def save(self):
+        """Ghi file JSON (nhỏ, không còn danh mục) qua file tạm rồi đổi tên; danh mục ghi nền qua Catalog.
+        Đang chuyển file cũ thì ghi Catalog ngay trước: chết giữa chừng cũng không mất danh mục."""
+        self.catalog.save(self.data["alias_map"], self.data["bag_items"])
+        keep = ()
+        if self.migrate:
+            if self.catalog.flush(): self.migrate = False
+            else: keep = CATALOG_KEYS # Catalog ghi lỗi: giữ danh mục trong JSON như cũ
+        out = {k: v for k, v in self.data.items() if k not in CATALOG_KEYS or k in keep}
+        if "bag_items" in out: out["bag_items"] = sorted(out["bag_items"])
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(out, f, indent=4, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except: pass
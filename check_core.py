@@ -0,0 +1,2798 @@
+# Lõi đối soát Đơn Hàng / Phiếu Xuất: đọc file, tính toán (cấu hình ở check_config). Không import tkinter (dùng được khi chạy không giao diện).
+import pandas as pd
+import numpy as np
+import json
+import os
+import re
+import unicodedata
+import hashlib
+import bisect
+import contextlib
+import copy
+import html
+import posixpath
+import threading
+import time
+import io
+import itertools
+import sys
+import cProfile
+import difflib
+import pstats
+import tracemalloc
+import sqlite3
+import zipfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from check_config import CONFIG_FILE, CACHE_DIR, PERF_LOG, PROFILE_DIR, RESULT_DB, SYSTEM_COLS, SecurityManager, ConfigManager
+
+# =============================================================================
+# 3. XỬ LÝ DỮ LIỆU (CORE LOGIC)
+# =============================================================================
+
+# Chuỗi pandas coi là ô trống khi đọc Excel (giống na_values mặc định của pd.read_excel)
+EXCEL_NA_VALUES = {
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+}
+
+def _excel_cell_str(v):
+    # Chuyển giá trị openpyxl -> chuỗi giống pd.read_excel(dtype=str)
+    if v is None: return np.nan
+    if isinstance(v, bool): s = str(v)
+    elif isinstance(v, float) and v.is_integer(): s = str(int(v))
+    else: s = str(v)
+    return np.nan if s in EXCEL_NA_VALUES else s
+
+def iter_excel_chunks(path, chunk_rows=50000, spec=None, layouts=None):
+    """Đọc sheet đầu của file .xlsx, trả về từng khối DataFrame (chuỗi như dtype=str). Bộ nhớ chỉ giữ 1 khối tại một thời điểm.
+    spec / layouts: chỉ lấy các cột cần dùng như parse_excel (quét XML bằng read_xlsx_columns, không được thì openpyxl read-only)."""
+    if spec is not None:
+        layout = layouts.get(path, spec) if layouts else None
+        for fresh in (False, True):
+            if fresh or layout is None:
+                layout = detect_header(excel_head(path, spec["rows"]), spec)
+                if layout is None: break
+                if layouts: layouts.put(path, spec, layout)
+            chunks = read_xlsx_columns(path, layout, spec["numeric"], chunk_rows)
+            try:
+                first = next(chunks)
+            except LayoutMismatch:
+                continue
+            except Exception:
+                break # cấu trúc XML lạ: đọc bằng openpyxl bên dưới
+            first.attrs["files"] = [(len(first), layout["row"] + 2)] # xem RowNumbers
+            yield first
+            yield from chunks
+            return
+
+    from openpyxl import load_workbook
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        layout, skip = None, 1 # skip: số dòng Excel tới hết dòng tiêu đề
+        if spec is not None:
+            head = [[_excel_cell_str(v) for v in r] for r in itertools.islice(rows, spec["rows"])]
+            layout = detect_header(head, spec)
+            skip = layout["row"] + 1 if layout else 1
+            header = head[skip - 1] if head else []
+            rows = itertools.chain(head[skip:], rows)
+        else:
+            header = list(next(rows, None) or [])
+        while header and (header[-1] is None or header[-1] is np.nan): header.pop()
+        names, seen = [], {}
+        for i, h in enumerate(header):
+            name = f"Unnamed: {i}" if h is None or h is np.nan else str(h)
+            if name in seen: # cột trùng tên: "A", "A.1", ...
+                seen[name] += 1
+                name = f"{name}.{seen[name]}"
+            else:
+                seen[name] = 0
+            names.append(name)
+        width = len(names)
+        if layout: # chỉ giữ các cột đã khớp, đặt lại tên theo cấu hình
+            pos, names = [c[0] for c in layout["cols"]], [c[2] for c in layout["cols"]]
+            width = max(width, pos[-1] + 1)
+        else:
+            pos = range(width)
+
+        def frame(buf, start):
+            df = pd.DataFrame(buf, columns=names, dtype=object, index=pd.RangeIndex(start, start + len(buf)))
+            if not start: df.attrs["files"] = [(len(df), skip + 1)] # xem RowNumbers
+            return numeric_cols(df, spec["numeric"]) if spec else df
+
+        buf, start, blank = [], 0, 0
+        for r in rows:
+            if all(_excel_cell_str(v) is np.nan for v in r[:width]): # dòng trống: pandas giữ ở giữa, bỏ ở cuối sheet
+                blank += 1
+                continue
+            buf.extend([[np.nan] * len(names) for _ in range(blank)]); blank = 0
+            buf.append([_excel_cell_str(r[i]) if i < len(r) else np.nan for i in pos])
+            if len(buf) >= chunk_rows:
+                yield frame(buf, start)
+                start += len(buf); buf = []
+        if buf or not start:
+            yield frame(buf, start)
+    finally:
+        wb.close()
+
+EXCEL_EXTS = (".xlsx", ".xlsm", ".xls")
+
+def resolve_inputs(spec):
+    """Đường dẫn 1 bên (Đơn Hàng / Phiếu Xuất) -> danh sách file.
+    spec: 1 file, 1 thư mục (mọi file Excel bên trong, theo tên) hoặc nhiều mục (list / chuỗi ngăn bởi ';')."""
+    items = spec if isinstance(spec, (list, tuple)) else str(spec).split(";")
+    files = []
+    for s in items:
+        s = s.strip()
+        if not s: continue
+        if os.path.isdir(s):
+            files.extend(sorted(os.path.join(s, f) for f in os.listdir(s)
+                                if f.lower().endswith(EXCEL_EXTS) and not f.startswith("~$"))) # ~$: file tạm của Excel
+        else:
+            files.append(s)
+    return files
+
+def file_signature(files):
+    """[(đường dẫn, size, mtime)] của danh sách file - đổi khi file được ghi lại."""
+    sig = []
+    for p in files:
+        try:
+            st = os.stat(p)
+            sig.append((os.path.abspath(p), st.st_size, st.st_mtime_ns))
+        except OSError:
+            sig.append((os.path.abspath(p), None, None))
+    return sig
+
+class FileWatcher:
+    """Theo dõi file đầu vào của 2 bên bằng cách hỏi định kỳ size + mtime (không cần thư viện ngoài).
+    get_specs() -> {"dh": ..., "px": ...} (giá trị như ô nhập: file / thư mục / nhiều file).
+    Excel lưu qua file tạm rồi đổi tên nên chỉ báo on_change(các bên đổi) khi file đã đứng yên debounce giây."""
+    def __init__(self, get_specs, on_change, interval=1.0, debounce=2.0):
+        self.get_specs = get_specs
+        self.on_change = on_change
+        self.interval, self.debounce = interval, debounce
+        self._stop = threading.Event()
+        self._thread = None
+
+    def snapshot(self):
+        return {side: file_signature(resolve_inputs(spec)) for side, spec in self.get_specs().items()}
+
+    def start(self):
+        if self._thread and self._thread.is_alive(): return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive() and not self._stop.is_set()
+
+    def _loop(self):
+        try:
+            last = self.snapshot()
+        except Exception:
+            last = {}
+        pending, since = set(), 0.0
+        while not self._stop.wait(self.interval):
+            try:
+                cur = self.snapshot()
+            except Exception:
+                continue # thư mục đang bị đổi tên / mạng chập chờn: hỏi lại lần sau
+            changed = {s for s in cur if cur[s] != last.get(s)}
+            last = cur
+            if changed:
+                pending |= changed
+                since = time.monotonic()
+            elif pending and time.monotonic() - since >= self.debounce:
+                sides, pending = pending, set()
+                self.on_change(sides)
+
+# -----------------------------------------------------------------------------
+# CHỈ ĐỌC CÁC CỘT CẦN DÙNG: dò dòng tiêu đề, khớp tên cột theo col_map
+# -----------------------------------------------------------------------------
+NUMERIC_COLS = ("dh_sl", "px_sl_xuat", "px_sl_tui") # cột số lượng: đọc xong đổi sang float nếu toàn số
+
+def header_text(v):
+    """Tiêu đề cột -> dạng so khớp: bỏ dấu (đ -> d), chữ thường, ký tự khác chữ / số thành 1 khoảng trắng."""
+    if v is None or v != v: return ""
+    t = unicodedata.normalize("NFD", str(v).replace("đ", "d").replace("Đ", "D"))
+    t = "".join(c for c in t if not unicodedata.combining(c)).lower()
+    return " ".join(re.sub(r"[\W_]+", " ", t).split())
+
+def read_spec(cmap, side, settings):
+    """Các cột 1 bên ("dh" / "px") cần đọc theo col_map -> spec cho parse_excel / iter_excel_chunks; None = đọc nguyên sheet."""
+    if not settings.get("prune_columns", True): return None
+    keys = dict.fromkeys(k for k in list(SYSTEM_COLS) + list(cmap) if k.startswith(side + "_"))
+    names = {k: cmap.get(k, "Ghi chú" if k == "dh_note" else "") for k in keys} # "Ghi chú": mặc định của _prepare_orders
+    return {"names": list(dict.fromkeys(n for n in names.values() if n)),
+            "numeric": [names[k] for k in NUMERIC_COLS if names.get(k)],
+            "rows": settings.get("header_rows", 30), "fuzzy": settings.get("fuzzy", 0.85)}
+
+def spec_key(spec):
+    # Phân biệt bản cache của cùng 1 file đọc theo các spec khác nhau
+    if spec is None: return ""
+    return hashlib.sha1(json.dumps(spec, sort_keys=True, ensure_ascii=False).encode()).hexdigest()[:12]
+
+def match_header(texts, names, fuzzy=1.0):
+    """texts: tiêu đề 1 dòng (đã qua header_text) -> {tên cấu hình: vị trí cột}. Khớp đúng trước, rồi gần đúng
+    (difflib, tỉ lệ >= fuzzy) theo điểm cao nhất; mỗi cột chỉ gán cho 1 tên."""
+    first = {}
+    for i, t in enumerate(texts):
+        if t: first.setdefault(t, i)
+    found, used = {}, set()
+    for n in names:
+        i = first.get(header_text(n))
+        if i is not None and i not in used: found[n] = i; used.add(i)
+    if fuzzy >= 1 or len(found) == len(names): return found
+    cands = []
+    sm = difflib.SequenceMatcher(autojunk=False)
+    for n in names:
+        if n in found: continue
+        sm.set_seq2(header_text(n))
+        for i, t in enumerate(texts):
+            if not t or i in used: continue
+            sm.set_seq1(t)
+            if sm.real_quick_ratio() >= fuzzy and sm.quick_ratio() >= fuzzy:
+                r = sm.ratio()
+                if r >= fuzzy: cands.append((-r, i, n))
+    for _, i, n in sorted(cands, key=lambda c: c[:2]):
+        if n not in found and i not in used: found[n] = i; used.add(i)
+    return found
+
+def detect_header(rows, spec):
+    """rows: các dòng đầu sheet (list giá trị) -> bố cục {"row": dòng tiêu đề, "cols": [[vị trí, tiêu đề gốc, tên cấu hình], ...]}.
+    Chọn dòng khớp được nhiều tên cột nhất (dòng trên cùng nếu bằng nhau); None nếu không dòng nào khớp."""
+    texts = [[header_text(v) for v in r] for r in rows]
+    best = None
+    for fuzzy in (1.0, spec["fuzzy"]): # khớp đúng đủ cột thì khỏi so gần đúng
+        for i, t in enumerate(texts):
+            found = match_header(t, spec["names"], fuzzy)
+            if found and (best is None or len(found) > len(best[1])): best = (i, found)
+        if best and len(best[1]) == len(spec["names"]): break
+    if best is None: return None
+    i, found = best
+    return {"row": i, "cols": [[pos, str(rows[i][pos]), name] for name, pos in sorted(found.items(), key=lambda kv: kv[1])]}
+
+def layout_matches(rows, layout):
+    # Dòng tiêu đề của file vẫn đúng như bố cục đã lưu (so theo header_text)
+    if layout["row"] >= len(rows): return False
+    header = rows[layout["row"]]
+    return all(pos < len(header) and header_text(header[pos]) == header_text(raw) for pos, raw, _ in layout["cols"])
+
+def numeric_cols(df, names):
+    # Cột số lượng toàn số -> float64 (nhẹ hơn chuỗi, cache gọn); có ô chữ thì giữ chuỗi để to_float_col xử lý như cũ
+    for n in names:
+        if n in df.columns:
+            try: df[n] = df[n].astype(float)
+            except (TypeError, ValueError): pass
+    return df
+
+class LayoutMismatch(Exception):
+    """Dòng tiêu đề của file không còn khớp bố cục đã lưu."""
+
+# Thẻ ô không bắt đầu bằng r="..." hoặc có tiền tố namespace: không quét nhanh được, đọc qua pandas / openpyxl
+_XLSX_ODD_CELL = re.compile(rb'<c(?:\s(?!r=")|/?>)|<\w+:c[\s/>]')
+_XLSX_TEXT = re.compile(rb'<t(?:\s[^>]*)?>(.*?)</t>', re.S)
+_XLSX_PHONETIC = re.compile(rb'<rPh\b.*?</rPh>', re.S) # phiên âm (tiếng Nhật): openpyxl bỏ qua
+
+def _xlsx_parts(z):
+    """-> (mục XML của sheet đầu tiên, mục bảng chuỗi dùng chung hoặc None), theo workbook.xml và quan hệ của nó.
+    Sheet đầu tiên theo thứ tự trong workbook.xml, giống sheet_name=0 của pandas."""
+    rid = re.search(rb'<(?:\w+:)?sheet\b[^>]*?\s\w+:id="([^"]+)"', z.read("xl/workbook.xml")).group(1)
+    sheet = strings = None
+    for rel in re.findall(rb'<(?:\w+:)?Relationship\b[^>]*>', z.read("xl/_rels/workbook.xml.rels")):
+        target = re.search(rb'\sTarget="([^"]+)"', rel).group(1).decode()
+        target = target.lstrip("/") if target.startswith("/") else posixpath.normpath("xl/" + target)
+        if re.search(rb'\sId="' + re.escape(rid) + rb'"', rel): sheet = target
+        elif re.search(rb'\sType="[^"]*/sharedStrings"', rel): strings = target
+    if sheet is None: raise KeyError(rid)
+    return sheet, strings
+
+def read_xlsx_columns(path, layout, numeric=(), chunk_rows=None, block=1 << 24):
+    """Đọc các cột của layout từ sheet đầu file .xlsx bằng cách quét thẳng XML của sheet theo từng khối: regex chỉ dừng ở
+    ô thuộc các cột cần, các cột khác không phải dựng thành ô như openpyxl. Kết quả giống
+    pd.read_excel(dtype=str, header=layout["row"], usecols=...) đã đặt tên theo cấu hình.
+    Trả về từng khối chunk_rows dòng (None: 1 khối). LayoutMismatch nếu dòng tiêu đề không khớp (trước khối đầu tiên)."""
+    from openpyxl import load_workbook
+    from openpyxl.reader.strings import read_string_table
+    from openpyxl.utils import get_column_letter
+    from openpyxl.utils.datetime import from_excel, from_ISO8601
+
+    cols = layout["cols"]
+    names = [c[2] for c in cols]
+    letters = {get_column_letter(c[0] + 1).encode(): j for j, c in enumerate(cols)}
+    cell_re = re.compile(rb'<c r="(' + b"|".join(letters) + rb')(\d+)"([^>]*?)(?:/>|>(.*?)</c>)', re.S)
+    head_row = layout["row"] + 1 # số dòng Excel của dòng tiêu đề; dữ liệu từ head_row + 1
+
+    wb = load_workbook(path, read_only=True, data_only=True, keep_links=False) # style nào là ngày / khoảng thời gian
+    try:
+        epoch, dates, durations = wb.epoch, wb._date_formats, wb._timedelta_formats
+    finally:
+        wb.close()
+
+    kinds = {} # thuộc tính ô (lặp lại rất nhiều) -> (kiểu t, style là ngày?, là khoảng thời gian?)
+    def kind(attrs):
+        i, j = attrs.find(b' t="'), attrs.find(b' s="')
+        t = attrs[i + 4:attrs.index(b'"', i + 4)] if i >= 0 else b"n"
+        style = int(attrs[j + 4:attrs.index(b'"', j + 4)]) if j >= 0 else 0
+        kinds[attrs] = k = (t, style in dates, style in durations)
+        return k
+
+    def text(b):
+        s = b.decode()
+        return html.unescape(s) if "&" in s else s
+
+    def value(attrs, inner):
+        # Chuỗi của 1 ô như pd.read_excel(dtype=str) qua openpyxl (data_only): ô trống, lỗi (#N/A...) -> NaN
+        t, is_date, is_duration = kinds.get(attrs) or kind(attrs)
+        if t == b"inlineStr":
+            if b"<rPh" in inner: inner = _XLSX_PHONETIC.sub(b"", inner)
+            parts = _XLSX_TEXT.findall(inner)
+            return _excel_cell_str(text(parts[0]) if len(parts) == 1 else "".join(map(text, parts)))
+        i = inner.find(b"<v>")
+        if i < 0: return np.nan
+        v = inner[i + 3:inner.index(b"</v>", i)]
+        if not v or t == b"e": return np.nan
+        if t == b"s": return _excel_cell_str(strings[int(v)])
+        if t == b"str": return _excel_cell_str(text(v))
+        if t == b"b": return str(bool(int(v)))
+        if t == b"d": return _excel_cell_str(from_ISO8601(v.decode()))
+        x = float(v) if b"." in v or b"E" in v or b"e" in v else int(v)
+        if is_date:
+            try: return _excel_cell_str(from_excel(x, epoch, timedelta=is_duration))
+            except (OverflowError, ValueError): return np.nan
+        return _excel_cell_str(int(x) if x == int(x) else float(x))
+
+    pend = [([], []) for _ in cols] # mỗi cột: (chỉ số dòng dữ liệu, giá trị) chưa xuất, tăng dần
+    header = {}
+    state = {"last": head_row, "start": 0, "checked": False} # last: dòng Excel cuối có giá trị (mọi cột)
+
+    def frame(end):
+        a = state["start"]
+        data = {}
+        for j, (idx, vals) in enumerate(pend):
+            k = bisect.bisect_left(idx, end)
+            col = np.full(end - a, np.nan, dtype=object)
+            if k:
+                col[np.asarray(idx[:k]) - a] = np.array(vals[:k], dtype=object)
+                del idx[:k], vals[:k]
+            data[names[j]] = col
+        state["start"] = end
+        return numeric_cols(pd.DataFrame(data, index=pd.RangeIndex(a, end)), numeric)
+
+    def check():
+        if not state["checked"] and [header_text(header.get(j)) for j in range(len(cols))] != [header_text(c[1]) for c in cols]:
+            raise LayoutMismatch(path)
+        state["checked"] = True
+
+    with zipfile.ZipFile(path) as z:
+        sheet, sst = _xlsx_parts(z)
+        if sst:
+            with z.open(sst) as f: strings = read_string_table(f)
+        else:
+            strings = []
+        with z.open(sheet) as f:
+            carry = b""
+            while True:
+                data = f.read(block)
+                buf = carry + data
+                cut = buf.rfind(b"</row>") + 6 if data else len(buf) # khối cắt ở cuối 1 dòng
+                if data and cut < 6:
+                    carry = buf; continue
+                buf, carry = buf[:cut], buf[cut:]
+                if _XLSX_ODD_CELL.search(buf): raise ValueError("Không quét nhanh được sheet")
+                for col, row, attrs, inner in cell_re.findall(buf):
+                    if not inner: continue
+                    row = int(row) - head_row - 1 # chỉ số dòng dữ liệu
+                    if row >= 0:
+                        idx, vals = pend[letters[col]]
+                        idx.append(row); vals.append(value(attrs, inner))
+                    elif row == -1:
+                        header[letters[col]] = value(attrs, inner)
+                end = max(buf.rfind(b"</v>"), buf.rfind(b"</is>"))
+                if end >= 0: # dòng cuối có giá trị (kể cả cột không đọc): pandas bỏ các dòng trống ở cuối sheet
+                    m = re.match(rb'<c r="[A-Z]+(\d+)"', buf[buf.rfind(b'<c r="', 0, end):])
+                    if m: state["last"] = max(state["last"], int(m.group(1)))
+                if not data: break
+                avail = state["last"] - head_row
+                if chunk_rows and avail - state["start"] >= chunk_rows:
+                    check()
+                    while avail - state["start"] >= chunk_rows: yield frame(state["start"] + chunk_rows)
+    check()
+    end = state["last"] - head_row
+    if chunk_rows:
+        while end - state["start"] > chunk_rows: yield frame(state["start"] + chunk_rows)
+    if end > state["start"] or not state["start"]: yield frame(end)
+
+def excel_head(path, n):
+    # n dòng đầu sheet (chưa tách tiêu đề) để dò dòng tiêu đề
+    return pd.read_excel(path, header=None, nrows=n, dtype=str).to_numpy(dtype=object).tolist()
+
+def _read_layout(path, layout, spec):
+    """Các cột của layout, đặt tên theo cấu hình; LayoutMismatch nếu dòng tiêu đề không khớp."""
+    if path.lower().endswith((".xlsx", ".xlsm")):
+        try:
+            return next(read_xlsx_columns(path, layout, spec["numeric"]))
+        except LayoutMismatch:
+            raise
+        except Exception:
+            pass # cấu trúc XML lạ: đọc qua pandas
+    cols = layout["cols"]
+    df = pd.read_excel(path, header=layout["row"], usecols=[c[0] for c in cols], dtype=str)
+    if [header_text(c) for c in df.columns] != [header_text(c[1]) for c in cols]: raise LayoutMismatch(path)
+    df.columns = [c[2] for c in cols]
+    return numeric_cols(df, spec["numeric"])
+
+def parse_excel(path, spec=None, layout=None):
+    """Hàm cấp module để chạy được trong process pool -> (DataFrame, bố cục đã dùng hoặc None).
+    spec (read_spec): chỉ đọc các cột cần dùng, đặt tên theo cấu hình; layout: bố cục đã lưu của mẫu file
+    (đọc thẳng, tiêu đề không còn khớp thì dò lại). Không khớp được cột nào: đọc nguyên sheet như trước."""
+    if spec is None: return pd.read_excel(path, dtype=str), None
+    if layout is not None:
+        try:
+            return _read_layout(path, layout, spec), layout
+        except LayoutMismatch:
+            pass
+    layout = detect_header(excel_head(path, spec["rows"]), spec)
+    if layout is None: return numeric_cols(pd.read_excel(path, dtype=str), spec["numeric"]), None
+    return _read_layout(path, layout, spec), layout
+
+class HeaderLayouts:
+    """Bố cục tiêu đề đã dò, theo mẫu file (tên file bỏ số: "PX_2024-10.xlsx" -> "px_9-9.xlsx") + spec.
+    File sau cùng mẫu đọc thẳng các cột đã biết; dò lại khi tiêu đề không khớp. Lưu JSON trong thư mục cache."""
+    MAX = 200
+
+    lock = threading.Lock()
+
+    def __init__(self, folder=CACHE_DIR):
+        self.dir = folder
+        self.file = os.path.join(folder, "layouts.json")
+
+    @staticmethod
+    def key(path, spec):
+        name = re.sub(r"\d+", "9", os.path.basename(path).lower())
+        return hashlib.sha1(json.dumps([name, spec], sort_keys=True, ensure_ascii=False).encode()).hexdigest()[:20]
+
+    def _load(self):
+        try:
+            with open(self.file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except: return {}
+
+    def get(self, path, spec):
+        with self.lock:
+            entry = self._load().get(self.key(path, spec))
+        return entry["layout"] if entry else None
+
+    def put(self, path, spec, layout):
+        with self.lock:
+            data = self._load()
+            k = self.key(path, spec)
+            if k in data and data[k]["layout"] == layout: return
+            data[k] = {"layout": layout, "saved": datetime.now().timestamp()}
+            for old in sorted(data, key=lambda k: data[k]["saved"])[:max(0, len(data) - self.MAX)]: del data[old]
+            try:
+                os.makedirs(self.dir, exist_ok=True)
+                tmp = self.file + ".tmp"
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp, self.file)
+            except OSError: pass
+
+class FileLock:
+    """Khóa độc quyền giữa các process qua 1 file khóa (msvcrt trên Windows, fcntl nơi khác); dùng với with."""
+    def __init__(self, path):
+        self.path = path
+        self._f = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._f = open(self.path, "a+b")
+        try:
+            if os.name == "nt":
+                import msvcrt
+                self._f.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(self._f.fileno(), msvcrt.LK_LOCK, 1); break
+                    except OSError: pass # LK_LOCK chỉ chờ ~10 giây rồi báo lỗi: chờ tiếp
+            else:
+                import fcntl
+                fcntl.flock(self._f.fileno(), fcntl.LOCK_EX)
+        except:
+            self._f.close(); raise
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if os.name == "nt":
+                import msvcrt
+                self._f.seek(0)
+                msvcrt.locking(self._f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._f.close()
+
+class ParseCache:
+    """Cache file Excel đã đọc thành file Arrow (feather) cạnh bên.
+    Khóa: đường dẫn + size + mtime (kiểm nhanh) và hash nội dung (tên file cache).
+    Sai lệch bất kỳ hoặc lỗi đọc cache -> đọc lại file gốc.
+    index.json chỉ đọc / sửa khi giữ khóa file index.lock (các process đọc song song, batch, service dùng chung thư mục);
+    băm file, đọc / ghi file Arrow làm ngoài khóa."""
+    VERSION = 2 # 2: lưu kèm df.attrs (dòng tiêu đề của file cho Tab 3)
+
+    lock = threading.Lock() # các luồng trong 1 process; giữa các process là FileLock
+
+    def __init__(self, settings, folder=CACHE_DIR):
+        self.settings = settings
+        self.dir = folder
+        self.index_file = os.path.join(folder, "index.json")
+
+    @contextlib.contextmanager
+    def locked(self):
+        with self.lock, FileLock(os.path.join(self.dir, "index.lock")):
+            yield
+
+    def enabled(self):
+        if not self.settings.get("enabled", True): return False
+        try:
+            import pyarrow # feather cần pyarrow; không có thì bỏ qua cache
+            return True
+        except ImportError:
+            return False
+
+    @staticmethod
+    def file_hash(path):
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        return h.hexdigest()
+
+    def _load_index(self):
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get("version") == self.VERSION: return index
+        except: pass
+        return {"version": self.VERSION, "paths": {}, "entries": {}}
+
+    def _save_index(self, index):
+        tmp = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp, self.index_file)
+
+    def _sidecar(self, digest):
+        return os.path.join(self.dir, f"{digest}.arrow")
+
+    def read(self, path, parser, variant=""):
+        """Trả về DataFrame của path: lấy từ cache nếu khớp, không thì parser(path) rồi ghi cache."""
+        df, ticket = self.lookup(path, variant)
+        if df is not None: return df
+        df = parser(path)
+        self.store(ticket, df)
+        return df
+
+    def lookup(self, path, variant=""):
+        """(DataFrame, None) nếu cache khớp; (None, ticket) nếu phải đọc file - đọc xong gọi store(ticket, df).
+        variant: cách đọc (spec_key) - mỗi cách đọc của cùng 1 file là 1 bản cache riêng."""
+        if not self.enabled(): return None, None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None, None # để parser báo lỗi như cũ
+
+        abspath = os.path.abspath(path)
+        try:
+            with self.locked():
+                index = self._load_index()
+        except OSError:
+            return None, None # không tạo được thư mục / file khóa: chạy không cache
+        seen = index["paths"].get(abspath)
+        if seen and seen["size"] == st.st_size and seen["mtime"] == st.st_mtime_ns:
+            digest = seen["sha"]
+        else:
+            digest = self.file_hash(path)
+
+        key = f"{digest}-{variant}" if variant else digest
+        entry = index["entries"].get(key)
+        if entry and entry["size"] == st.st_size:
+            try:
+                df = pd.read_feather(self._sidecar(key))
+                ok = len(df) == entry["rows"] and list(df.columns) == entry["columns"]
+            except Exception:
+                ok = False
+            if ok:
+                self._touch(abspath, st, digest, key)
+                df = df.where(df.notna(), np.nan) # feather trả None cho ô trống
+                df.attrs.update(entry.get("attrs", {}))
+                return df, None
+            try:
+                with self.locked():
+                    index = self._load_index()
+                    if index["entries"].get(key) == entry: # process khác chưa ghi lại bản mới
+                        self._drop(index, key)
+                        self._save_index(index)
+            except Exception:
+                pass
+        return None, (abspath, st, digest, key)
+
+    def _touch(self, abspath, st, digest, key):
+        # Ghi lại lần dùng; lỗi ghi index (vd. Windows: file đang mở ở nơi khác) không làm hỏng bản cache vừa đọc được
+        try:
+            with self.locked():
+                index = self._load_index()
+                entry = index["entries"].get(key)
+                if entry: entry["used"] = datetime.now().timestamp()
+                index["paths"][abspath] = {"size": st.st_size, "mtime": st.st_mtime_ns, "sha": digest}
+                self._save_index(index)
+        except Exception:
+            pass
+
+    def store(self, ticket, df):
+        if ticket is None: return
+        self._store(*ticket, df)
+
+    def _store(self, abspath, st, digest, key, df):
+        # feather chỉ nhận tên cột dạng chuỗi + RangeIndex mặc định
+        if not all(isinstance(c, str) for c in df.columns): return
+        tmp = f"{self._sidecar(key)}.{os.getpid()}-{threading.get_ident()}.tmp" # ghi ngoài khóa, tên riêng từng luồng
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            df.reset_index(drop=True).to_feather(tmp)
+            with self.locked():
+                os.replace(tmp, self._sidecar(key))
+                index = self._load_index()
+                now = datetime.now().timestamp()
+                index["entries"][key] = {
+                    "size": st.st_size, "rows": len(df), "columns": list(df.columns),
+                    "bytes": os.path.getsize(self._sidecar(key)), "created": now, "used": now, "attrs": df.attrs,
+                }
+                index["paths"][abspath] = {"size": st.st_size, "mtime": st.st_mtime_ns, "sha": digest}
+                self._evict(index)
+                self._save_index(index)
+        except Exception:
+            pass # cache lỗi không được làm hỏng lần chạy
+        finally:
+            try: os.remove(tmp)
+            except OSError: pass
+
+    def _drop(self, index, key):
+        index["entries"].pop(key, None)
+        if "-" not in key: # bản đọc nguyên file: bỏ luôn các đường dẫn trỏ tới nội dung này
+            index["paths"] = {p: v for p, v in index["paths"].items() if v["sha"] != key}
+        try: os.remove(self._sidecar(key))
+        except OSError: pass
+
+    def _evict(self, index):
+        # Bỏ file .arrow không có trong index (sót lại từ lần ghi lỗi / bản cũ), bỏ bản quá hạn,
+        # sau đó bỏ bản ít dùng nhất cho tới khi dưới dung lượng cho phép. Gọi khi đang giữ khóa.
+        for name in os.listdir(self.dir):
+            if name.endswith(".arrow") and name[:-len(".arrow")] not in index["entries"]:
+                try: os.remove(os.path.join(self.dir, name))
+                except OSError: pass
+        now = datetime.now().timestamp()
+        max_age = self.settings.get("max_days", 14) * 86400
+        max_bytes = self.settings.get("max_mb", 500) * 1024 * 1024
+        for digest, e in list(index["entries"].items()):
+            if now - e["used"] > max_age: self._drop(index, digest)
+        by_use = sorted(index["entries"].items(), key=lambda kv: kv[1]["used"])
+        total = sum(e["bytes"] for _, e in by_use)
+        for digest, e in by_use:
+            if total <= max_bytes: break
+            self._drop(index, digest)
+            total -= e["bytes"]
+
+    def clear(self):
+        if not os.path.isdir(self.dir): return
+        with self.locked():
+            index = self._load_index()
+            for digest in list(index["entries"]): self._drop(index, digest)
+            self._save_index(index)
+
+class GroupAccumulator:
+    """Cộng dồn theo (Key, Item) qua nhiều khối dữ liệu.
+    Mã nhóm theo thứ tự xuất hiện; np.add.at cộng tuần tự từng dòng nên tổng trùng khớp cách cộng dồn trong vòng lặp."""
+    def __init__(self):
+        self.index = {} # (Key, Item) -> mã nhóm
+        self.keys = []
+        self.size = 0
+        self.sl_dat = np.zeros(0)
+        self.cnt = np.zeros(0, dtype=np.int64)
+        self.kg = np.zeros(0)
+        self.tui = np.zeros(0)
+
+    def codes_for(self, key, item):
+        if not len(key): return np.zeros(0, dtype=np.int64)
+        codes, uniq = pd.MultiIndex.from_arrays([key, item]).factorize()
+        lut = np.empty(len(uniq), dtype=np.int64)
+        for i, k in enumerate(uniq):
+            c = self.index.get(k)
+            if c is None:
+                c = self.index[k] = len(self.keys)
+                self.keys.append(k)
+            lut[i] = c
+        self._grow(len(self.keys))
+        return lut[codes]
+
+    def _grow(self, n):
+        if n <= self.size: return
+        pad = n - self.size
+        self.sl_dat = np.concatenate([self.sl_dat, np.zeros(pad)])
+        self.cnt = np.concatenate([self.cnt, np.zeros(pad, dtype=np.int64)])
+        self.kg = np.concatenate([self.kg, np.zeros(pad)])
+        self.tui = np.concatenate([self.tui, np.zeros(pad)])
+        self.size = n
+
+    def reset(self, g):
+        self.sl_dat[g] = 0.0; self.cnt[g] = 0; self.kg[g] = 0.0; self.tui[g] = 0.0
+
+    def add_orders(self, codes, sl):
+        np.add.at(self.sl_dat, codes, sl)
+        np.add.at(self.cnt, codes, 1)
+
+    def add_exports(self, codes, kg, tui):
+        np.add.at(self.kg, codes, kg)
+        np.add.at(self.tui, codes, tui)
+
+# -----------------------------------------------------------------------------
+# NGOẠI LỆ (TAB 3): gộp theo nhóm, giới hạn số dòng mẫu
+# -----------------------------------------------------------------------------
+def key_pattern(text):
+    """Mẫu của mã khách gốc: chữ -> A, số -> 9 (gộp các ký tự liền nhau), vd. "KH-0012" -> "A-9"; rỗng -> "(trống)"."""
+    t = " ".join(str(text).split()).upper()
+    if t in ("", "NAN"): return "(trống)"
+    return re.sub(r"\d+", "9", re.sub(r"[^\W\d_]+", "A", t))[:40]
+
+class RowNumbers:
+    """Vị trí dòng của 1 bên (các file nối nhau) -> số dòng ghi ra Tab 3: dòng Excel trong file (tính cả dòng tiêu đề
+    dò được ở dưới), file sau đánh số tiếp sau dòng cuối của file trước.
+    Khung / khối đọc mở đầu 1 file mang attrs["files"] = [(số dòng, dòng Excel của dòng dữ liệu đầu), ...];
+    khối không có attrs này là phần tiếp theo của file trước (đọc theo khối)."""
+    def __init__(self):
+        self.starts, self.shifts = [], [] # vị trí dòng đầu mỗi file, số cộng vào vị trí
+        self.n = 0 # số dòng đã thêm
+        self.last = 0 # số ghi ra của dòng cuối đã thêm
+
+    @classmethod
+    def of(cls, df):
+        out = cls()
+        out.add_frame(df)
+        return out
+
+    def add_frame(self, df):
+        files = df.attrs.get("files")
+        if not files and not self.starts: files = [(len(df), 2)] # không rõ: tiêu đề ở dòng 1
+        if not files:
+            self.n += len(df); self.last += len(df)
+            return
+        for n, first_row in files:
+            self.starts.append(self.n)
+            self.shifts.append(self.last + first_row - self.n)
+            self.n += n
+            self.last += first_row - 1 + n
+
+    def __call__(self, pos):
+        i = np.searchsorted(self.starts, pos, side="right") - 1
+        return pos + np.asarray(self.shifts, dtype=np.int64)[i]
+
+class ExceptionGroups:
+    """Ngoại lệ gộp theo (Loại, Lỗi, mẫu mã khách gốc): số dòng, tối đa SAMPLES dòng mẫu và vị trí dòng nguồn dạng
+    khoảng [đầu, cuối]. Cột khách hỏng cả file cũng chỉ ra vài nhóm thay vì hàng chục nghìn dòng Tab 3."""
+    SAMPLES = 20
+    SHOW_RANGES = 50 # số khoảng ghi ra cột "Dòng"
+
+    def __init__(self):
+        self.groups = {} # (Loại, Lỗi, Mẫu Key) -> {"n": số dòng, "ranges": [[đầu, cuối]], "samples": [(dòng, Dữ liệu)]} - dòng theo RowNumbers
+
+    def copy(self):
+        out = ExceptionGroups()
+        out.groups = {k: {"n": g["n"], "ranges": [list(r) for r in g["ranges"]], "samples": list(g["samples"])}
+                      for k, g in self.groups.items()}
+        return out
+
+    def _group(self, source, error, pattern):
+        g = self.groups.get((source, error, pattern))
+        if g is None: g = self.groups[(source, error, pattern)] = {"n": 0, "ranges": [], "samples": []}
+        return g
+
+    @staticmethod
+    def _extend(ranges, new):
+        # Nối các khoảng (tăng dần) vào danh sách, gộp với khoảng cuối nếu liền nhau
+        for start, end in new:
+            if ranges and start == ranges[-1][1] + 1: ranges[-1][1] = end
+            else: ranges.append([start, end])
+
+    def add_one(self, source, error, raw_key, row, data):
+        """1 dòng (engine "loop"); data() -> chuỗi Dữ liệu, chỉ gọi khi nhóm còn thiếu dòng mẫu."""
+        g = self._group(source, error, key_pattern(raw_key))
+        g["n"] += 1
+        self._extend(g["ranges"], [(row, row)])
+        if len(g["samples"]) < self.SAMPLES: g["samples"].append((row, data()))
+
+    def add(self, source, error, patterns, rows, data):
+        """Cả khối: patterns / rows (số dòng theo RowNumbers, tăng dần) cùng độ dài;
+        data(chỉ số trong rows) -> list chuỗi Dữ liệu, chỉ gọi cho các dòng được giữ làm mẫu."""
+        if not len(rows): return
+        codes, uniques = pd.factorize(np.asarray(patterns, dtype=object))
+        order = np.argsort(codes, kind="stable")
+        counts = np.bincount(codes, minlength=len(uniques))
+        starts = np.cumsum(counts) - counts
+        wanted = [] # (nhóm, chỉ số các dòng mẫu)
+        for ci, pattern in enumerate(uniques):
+            idx = order[starts[ci]:starts[ci] + counts[ci]]
+            g = self._group(source, error, pattern)
+            g["n"] += len(idx)
+            r = rows[idx]
+            cut = np.flatnonzero(np.diff(r) != 1) + 1
+            self._extend(g["ranges"], zip(r[np.r_[0, cut]].tolist(), r[np.r_[cut - 1, len(r) - 1]].tolist()))
+            need = self.SAMPLES - len(g["samples"])
+            if need > 0: wanted.append((g, idx[:need]))
+        if not wanted: return
+        texts = iter(data(np.concatenate([idx for _, idx in wanted])))
+        for g, idx in wanted:
+            g["samples"].extend((row, next(texts)) for row in rows[idx].tolist())
+
+    def total(self):
+        return sum(g["n"] for g in self.groups.values())
+
+    def ranges_text(self, ranges):
+        parts = [f"{a}" if a == b else f"{a}-{b}" for a, b in ranges[:self.SHOW_RANGES]]
+        if len(ranges) > self.SHOW_RANGES: parts.append(f"… (+{len(ranges) - self.SHOW_RANGES} khoảng)")
+        return ", ".join(parts)
+
+    def records(self):
+        """res_tab3: 1 bản ghi mỗi nhóm, theo bên (Đơn Hàng trước) rồi dòng nguồn đầu tiên của nhóm;
+        Samples = ((dòng Excel, Dữ liệu), ...) cho giao diện mở ra xem."""
+        sources = list(dict.fromkeys(k[0] for k in self.groups))
+        out = []
+        for (source, error, pattern), g in sorted(self.groups.items(), key=lambda kv: (sources.index(kv[0][0]), kv[1]["ranges"][0][0])):
+            samples = tuple(g["samples"])
+            out.append({"Loại": source, "Lỗi": error, "Mẫu Key": pattern, "Số dòng": g["n"],
+                        "Dòng": self.ranges_text(g["ranges"]), "Dữ liệu": samples[0][1] if samples else "", "Samples": samples})
+        return out
+
+# -----------------------------------------------------------------------------
+# LƯU THEO CỘT: Tab 2 và chi tiết popup là "khung nhìn" trên các cột dòng đã khóa (_dh / _px),
+# không giữ 1 dict cho mỗi dòng; bản ghi chỉ được dựng khi cần (lưới đang hiện, popup đang mở, xuất file)
+# -----------------------------------------------------------------------------
+class CompactColumns:
+    """Lấy giá trị các cột của 1 DataFrame theo mảng chỉ số dòng.
+    Cột chữ được mã hóa 1 lần (khi dùng tới) thành mã int32 + mảng giá trị duy nhất: Số PX, Tên hàng... lặp lại nhiều
+    chỉ giữ 1 bản, lấy theo dòng chỉ là phép chỉ mục NumPy. Cột số dùng thẳng mảng float của DataFrame."""
+    def __init__(self, frame):
+        self.frame = frame
+        self._cols = {}
+
+    def __len__(self):
+        return len(self.frame)
+
+    def _col(self, name, na):
+        key = (name, na)
+        c = self._cols.get(key)
+        if c is None:
+            s = self.frame[name]
+            if pd.api.types.is_numeric_dtype(s.dtype) and not pd.api.types.is_bool_dtype(s.dtype):
+                c = (None, s.to_numpy())
+            else:
+                codes, uniq = pd.factorize(s) # thiếu giá trị -> -1 -> phần tử cuối (na)
+                c = (codes.astype(np.int32), np.append(np.asarray(uniq, dtype=object), na).astype(object))
+            self._cols[key] = c
+        return c
+
+    def take(self, name, rows, na=np.nan):
+        """Mảng giá trị của cột name tại các dòng rows; na: giá trị thay ô trống của cột chữ ("nan" = giống str(NaN))."""
+        codes, vals = self._col(name, na)
+        if codes is not None: return vals[codes[rows]]
+        out = vals[rows]
+        if isinstance(na, str): # cột số: ô trống -> "nan" như to_str_col
+            out = out.astype(object)
+            out[pd.isna(out)] = na
+        return out
+
+    def value(self, name, i, na=np.nan):
+        """Như take cho 1 dòng, trả về kiểu Python (như tolist)."""
+        codes, vals = self._col(name, na)
+        if codes is not None: return vals[codes[i]]
+        v = vals[i].item()
+        return na if isinstance(na, str) and v != v else v
+
+class Tab2Rows:
+    """res_tab2 của engine "vector": dãy bản ghi (dict) dựng khi đọc tới, từ cột của _px + trạng thái theo nhóm (_g2).
+    Đọc thuộc tính processor mỗi lần truy cập nên update_status / update_aliases (gán mảng mới) hiện ngay trên Tab 2."""
+    FIELDS = ["SoPX", "Key", "Item", "Name", "SL_Xuat", "SL_Tui", "Unit", "SL_Dong", "Total_Dat", "Total_Xuat", "Lech_Tong", "Status", "Tag"]
+    CHUNK = 50000 # số dòng dựng 1 lần khi duyệt hết (lưu / xuất file)
+    _GROUP = {"Unit": "unit", "Total_Dat": "sl_dat", "Total_Xuat": "sl_xuat", "Lech_Tong": "lech", "Status": "status2", "Tag": "tag2"}
+
+    def __init__(self, processor):
+        self.p = processor
+
+    def __len__(self):
+        return len(self.p._c_px)
+
+    def column(self, field, rows=None):
+        """Mảng giá trị 1 cột (rows: chỉ các dòng này) - cho chỉ mục tìm kiếm / sắp xếp, không dựng dict."""
+        p = self.p
+        if rows is None: rows = np.arange(len(p._c_px))
+        c = p._c_px[rows]
+        if field in ("SoPX", "Name"): return p._px_view.take(field, rows, na="nan") # như str(x) của bản gốc
+        if field in ("SL_Xuat", "SL_Tui"): return p._px_view.take(field, rows)
+        if field == "Key": return p._g_key[c]
+        if field == "Item": return p._g_item[c]
+        if field == "SL_Dong":
+            return np.where(p._g2["is_bag"][c], p._px_view.take("SL_Tui", rows), p._px_view.take("SL_Xuat", rows))
+        return p._g2[self._GROUP[field]][c]
+
+    def records(self, rows):
+        return self.p._records({f: self.column(f, rows) for f in self.FIELDS})
+
+    def __getitem__(self, i):
+        # 1 dòng (lưới đang hiện): lấy thẳng từng ô, không qua mảng
+        n = len(self)
+        if i < 0: i += n
+        if not 0 <= i < n: raise IndexError(i)
+        p = self.p
+        c, g2, v = p._c_px[i], p._g2, p._px_view
+        sl_xuat, sl_tui = v.value("SL_Xuat", i), v.value("SL_Tui", i)
+        return {"SoPX": v.value("SoPX", i, "nan"), "Key": p._g_key[c], "Item": p._g_item[c], "Name": v.value("Name", i, "nan"),
+                "SL_Xuat": sl_xuat, "SL_Tui": sl_tui, "Unit": g2["unit"][c], "SL_Dong": sl_tui if g2["is_bag"][c] else sl_xuat,
+                "Total_Dat": g2["sl_dat"][c].item(), "Total_Xuat": g2["sl_xuat"][c].item(), "Lech_Tong": g2["lech"][c].item(),
+                "Status": g2["status2"][c], "Tag": g2["tag2"][c]}
+
+    def __iter__(self):
+        for start in range(0, len(self), self.CHUNK):
+            yield from self.records(np.arange(start, min(start + self.CHUNK, len(self))))
+
+class DetailIndex:
+    """detail_map của engine "vector": (Key, Item) -> {'orders': [...], 'exports': [...]} như bản dict cũ,
+    nhưng chỉ giữ chỉ số dòng của _dh / _px xếp theo nhóm + bảng vị trí bắt đầu (offsets) của từng nhóm;
+    bản ghi của 1 nhóm chỉ được dựng khi mở popup. Chụp trạng thái processor lúc tạo (tạo lại sau mỗi lần đổi)."""
+    SIDES = {"orders": ("_dh_view", "_c_dh", ["SoDH", "Name", "SL", "Note"]),
+             "exports": ("_px_view", "_c_px", ["SoPX", "Name", "SL_Xuat", "SL_Tui"])}
+    CHUNK = 50000
+
+    def __init__(self, processor):
+        p = processor
+        self._keys, self._index = list(p._acc.keys), dict(p._acc.index)
+        self.groups = np.flatnonzero(p._alive) # thứ tự nhóm = thứ tự duyệt
+        self.g_key, self.g_item = p._g_key, p._g_item
+        self.sides = {}
+        for side, (view, codes, cols) in self.SIDES.items():
+            c = getattr(p, codes)
+            order = np.argsort(c, kind="stable") # dòng của cùng nhóm liền nhau, giữ thứ tự dòng
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(c, minlength=len(self._keys)))])
+            self.sides[side] = (getattr(p, view), order, offsets, cols)
+        self.alive = p._alive.copy()
+        self._records = p._records
+
+    def _rows(self, side, g):
+        # Chỉ số dòng (theo thứ tự nhóm g rồi thứ tự dòng) + mã nhóm của từng dòng
+        _, order, offsets, _ = self.sides[side]
+        start, counts = offsets[g], offsets[g + 1] - offsets[g]
+        total = int(counts.sum())
+        pos = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(start, counts)
+        return order[pos], np.repeat(g, counts)
+
+    def _side_records(self, side, rows):
+        view, _, _, cols = self.sides[side]
+        return self._records({c: view.take(c, rows) for c in cols})
+
+    def rows(self, side, key):
+        """Chỉ số dòng chi tiết 1 bên của 1 (Key, Item) theo thứ tự dòng - lát cắt của order, chưa dựng bản ghi."""
+        gi = self._group(key)
+        _, order, offsets, _ = self.sides[side]
+        return order[offsets[gi]:offsets[gi + 1]] if gi is not None else order[:0]
+
+    def _group(self, key):
+        gi = self._index.get(key)
+        return None if gi is None or gi >= len(self.alive) or not self.alive[gi] else gi
+
+    # --- giống dict ---
+    def __getitem__(self, key):
+        gi = self._group(key)
+        if gi is None: raise KeyError(key)
+        g = np.array([gi])
+        return {side: self._side_records(side, self._rows(side, g)[0]) for side in self.sides}
+
+    def get(self, key, default=None):
+        return self[key] if self._group(key) is not None else default
+
+    def __contains__(self, key):
+        return self._group(key) is not None
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __iter__(self):
+        return (self._keys[gi] for gi in self.groups)
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        return ((k, self[k]) for k in self)
+
+    def first_text(self, side, field):
+        """(Key, Item) -> giá trị chữ (khác rỗng) đầu tiên của cột field trong chi tiết 1 bên; tính trên mã cột, không dựng dòng."""
+        view, order, offsets, _ = self.sides[side]
+        codes, vals = view._col(field, np.nan)
+        if codes is None: return {} # cột số
+        good = np.array([isinstance(v, str) and bool(v.strip()) for v in vals], dtype=bool)
+        pos = np.flatnonzero(good[codes[order]])
+        grp = np.searchsorted(offsets, pos, side="right") - 1
+        grp, first = np.unique(grp, return_index=True)
+        keep = self.alive[grp]
+        text = vals[codes[order[pos[first[keep]]]]]
+        return dict(zip((self._keys[gi] for gi in grp[keep]), text.tolist()))
+
+    def lines(self, side, keys=None):
+        """Mọi dòng chi tiết 1 bên (dict kèm Key, Item) theo thứ tự nhóm rồi thứ tự dòng; keys: chỉ các (Key, Item) này.
+        Dựng theo khối CHUNK dòng (lưu kết quả / xuất file), không qua từng nhóm."""
+        if keys is None:
+            g = self.groups
+        else:
+            g = np.array([gi for gi in map(self._group, keys) if gi is not None], dtype=np.int64)
+        rows, gidx = self._rows(side, g)
+        for start in range(0, len(rows), self.CHUNK):
+            r, gg = rows[start:start + self.CHUNK], gidx[start:start + self.CHUNK]
+            recs = self._side_records(side, r)
+            for k, i, rec in zip(self.g_key[gg].tolist(), self.g_item[gg].tolist(), recs):
+                yield {"Key": k, "Item": i, **rec}
+
+def field_values(records, field):
+    """Giá trị 1 trường của mọi bản ghi: Tab2Rows trả thẳng cột, list of dict thì duyệt từng dòng."""
+    if isinstance(records, Tab2Rows): return records.column(field)
+    return [r[field] for r in records]
+
+def detail_lines(detail_map, side, keys=None):
+    """Như DetailIndex.lines cho cả detail_map dạng dict (engine "loop")."""
+    if isinstance(detail_map, DetailIndex):
+        yield from detail_map.lines(side, keys)
+        return
+    for k in (detail_map if keys is None else keys):
+        d = detail_map.get(k)
+        if not d: continue
+        for line in d[side]:
+            yield {"Key": k[0], "Item": k[1], **line}
+
+class DetailSource:
+    """Chi tiết 2 bên của 1 (Key, Item) cho popup: số dòng mỗi bên + dựng từng trang khi cần, không dựng cả nhóm.
+    Nguồn: detail_map (DetailIndex hoặc dict của engine "loop") hoặc ResultStore + run_id (kết quả đã lưu)."""
+    def __init__(self, key, detail_map=None, store=None, run_id=None):
+        self.key = key
+        self.detail_map, self.store, self.run_id = detail_map, store, run_id
+        if store is not None:
+            self.counts = store.detail_count(run_id, *key)
+        elif isinstance(detail_map, DetailIndex):
+            self._rows = {side: detail_map.rows(side, key) for side in DetailIndex.SIDES}
+            self.counts = {side: len(r) for side, r in self._rows.items()}
+        else:
+            self._lines = detail_map.get(key) or {"orders": [], "exports": []}
+            self.counts = {side: len(v) for side, v in self._lines.items()}
+
+    def __bool__(self):
+        return any(self.counts.values())
+
+    def same(self, other):
+        """Cùng nhóm của cùng 1 kết quả -> popup giữ nguyên các dòng đã nạp."""
+        return (other is not None and self.key == other.key and self.detail_map is other.detail_map
+                and self.store is other.store and self.run_id == other.run_id)
+
+    def page(self, side, start, n):
+        """Các dòng thứ start .. start+n-1 của 1 bên (dict như detail_map[key][side])."""
+        if self.store is not None: return self.store.detail_page(self.run_id, *self.key, side, start, n)
+        if isinstance(self.detail_map, DetailIndex): return self.detail_map._side_records(side, self._rows[side][start:start + n])
+        return self._lines[side][start:start + n]
+
+def settings_signature(data):
+    """Chuỗi đại diện các thiết lập làm đổi kết quả (cột, cách đọc cột, alias, hàng túi, dung sai) - so / băm để biết cấu hình có đổi không."""
+    return json.dumps([data["col_map"], data.get("read", {}), data["alias_map"], sorted(data["bag_items"]), data["tolerance"]],
+                      sort_keys=True, ensure_ascii=False)
+
+def peak_memory_mb():
+    """Đỉnh bộ nhớ (RSS) của tiến trình tính đến lúc gọi, MB; None nếu không đo được."""
+    try:
+        import resource
+        kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return kb / (1024 * 1024 if sys.platform == "darwin" else 1024) # macOS trả về byte
+    except ImportError:
+        pass
+    try:
+        import psutil # Windows: không có module resource
+        m = psutil.Process().memory_info()
+        return getattr(m, "peak_wset", m.rss) / 2**20
+    except Exception:
+        return None
+
+class RunStats:
+    """Đo thời gian / số dòng / đỉnh bộ nhớ theo từng bước của 1 lần chạy.
+    mark(phase) kết thúc bước đang đo và bắt đầu bước mới; bước lặp lại (đọc theo khối...) được cộng dồn."""
+    def __init__(self, engine=""):
+        self.engine = engine
+        self.started = datetime.now()
+        self.phases = {} # tên bước -> {"sec", "rows", "peak_mb"}
+        self.info = {} # thông tin thêm ghi vào log (số file, file profile...)
+        self._cur, self._t = None, None
+
+    def mark(self, phase=None, rows=None):
+        now = time.perf_counter()
+        if self._cur is not None:
+            p = self.phases[self._cur]
+            p["sec"] += now - self._t
+            p["peak_mb"] = peak_memory_mb()
+        self._cur, self._t = phase, now
+        if phase is not None:
+            self.phases.setdefault(phase, {"sec": 0.0, "rows": 0, "peak_mb": None})
+            self.add_rows(phase, rows)
+
+    def add_rows(self, phase, rows):
+        if rows: self.phases[phase]["rows"] += int(rows)
+
+    def iterate(self, phase, iterable):
+        """Tính thời gian lấy từng phần tử (vd. đọc từng khối Excel) vào bước phase."""
+        it = iter(iterable)
+        while True:
+            self.mark(phase)
+            try:
+                item = next(it)
+            except StopIteration:
+                self.mark(None)
+                return
+            self.add_rows(phase, len(item))
+            yield item
+
+    def total(self):
+        return sum(p["sec"] for p in self.phases.values())
+
+    def summary(self):
+        parts = [f"{name} {p['sec']:.2f}s" + (f" ({p['rows']:,} dòng)" if p["rows"] else "")
+                 for name, p in self.phases.items()]
+        mem = peak_memory_mb()
+        return f"Tổng {self.total():.2f}s: " + " | ".join(parts) + (f" | RAM đỉnh {mem:,.0f} MB" if mem else "")
+
+    def record(self):
+        return {"time": self.started.isoformat(timespec="seconds"), "engine": self.engine,
+                "total_sec": round(self.total(), 4), "peak_mb": peak_memory_mb(),
+                "phases": {k: dict(v, sec=round(v["sec"], 4)) for k, v in self.phases.items()}, **self.info}
+
+    def append_log(self, path=PERF_LOG):
+        try:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(self.record(), ensure_ascii=False) + "\n")
+        except: pass
+
+def run_profiled(fn, *args, **kwargs):
+    """Chạy fn dưới cProfile + tracemalloc; trả về (kết quả, báo cáo dạng text)."""
+    prof = cProfile.Profile()
+    tracemalloc.start()
+    try:
+        result = prof.runcall(fn, *args, **kwargs)
+        snap = tracemalloc.take_snapshot()
+        cur, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    out = io.StringIO()
+    out.write(f"tracemalloc: đỉnh {peak / 2**20:.1f} MB, còn giữ {cur / 2**20:.1f} MB\n\n")
+    for st in snap.statistics("lineno")[:25]:
+        out.write(f"{st}\n")
+    out.write("\n")
+    pstats.Stats(prof, stream=out).sort_stats("cumulative").print_stats(40)
+    return result, out.getvalue()
+
+def save_profile_report(text, directory=PROFILE_DIR):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"profile_{datetime.now():%Y%m%d_%H%M%S}.txt")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return path
+
+class AnalysisCancelled(Exception):
+    pass
+
+class AnalysisJob:
+    """1 lần phân tích chạy nền: cờ hủy + báo tiến độ.
+    Job có DataProcessor riêng; giao diện chỉ thay processor đang hiển thị bằng processor của job khi job xong."""
+    def __init__(self, processor, on_progress=None):
+        self.processor = processor
+        self.on_progress = on_progress # gọi từ luồng nền: (phase, done)
+        self.cancelled = threading.Event()
+        self.result = None
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def report(self, phase, done=None):
+        if self.cancelled.is_set(): raise AnalysisCancelled()
+        if self.on_progress: self.on_progress(phase, done)
+
+    def run(self, engine=None):
+        p = self.processor
+        try:
+            if p.cfg.data["perf"].get("profile"):
+                self.result, report = run_profiled(p.run_analysis, engine, job=self)
+                p.stats.info["profile"] = save_profile_report(report)
+            else:
+                self.result = p.run_analysis(engine, job=self)
+        except AnalysisCancelled:
+            self.result = None
+        return self.result
+
+class ToleranceRules:
+    """Dung sai chung + các rule riêng trong cfg["tolerance"]["rules"], biên dịch 1 lần cho mỗi lần tính trạng thái.
+    Rule: {"item": mã | [mã], "group": tên nhóm trong "item_groups", "key_prefix": "ST" | [..], "pct": false,
+           "kg_min": .., "kg_max": .., "bag_diff": ..} - điều kiện nào có thì phải khớp hết, rule đầu tiên khớp được dùng;
+    trường dung sai bỏ trống lấy theo dung sai chung. pct: các giá trị của rule là % SL đặt của (Key, Item).
+    Áp cho cả mảng nhóm: rule được xét trên các cặp (Item, lớp tiền tố Key) duy nhất rồi trải ra bằng chỉ mục NumPy,
+    nên hàng trăm rule không làm chậm theo số nhóm."""
+    FIELDS = ("kg_min", "kg_max", "bag_diff")
+
+    def __init__(self, tol):
+        norm = lambda t: unicodedata.normalize("NFC", " ".join(str(t).strip().upper().split()))
+        as_list = lambda v: [norm(x) for x in (v if isinstance(v, (list, tuple, set)) else [v]) if x is not None and str(x).strip()]
+        groups = {norm(k): [norm(x) for x in v] for k, v in (tol.get("item_groups") or {}).items()}
+        self.match = [] # (tập mã hàng | None, tuple tiền tố Key | None)
+        values, pct = [], []
+        for r in tol.get("rules") or []:
+            items = None
+            if r.get("item") or r.get("group"):
+                items = set(as_list(r.get("item")))
+                for name in as_list(r.get("group")): items.update(groups.get(name, ()))
+            self.match.append((items, tuple(as_list(r.get("key_prefix"))) or None))
+            values.append([float(r[f]) if r.get(f) not in (None, "") else float(tol[f]) for f in self.FIELDS])
+            pct.append([bool(r.get("pct")) and r.get(f) not in (None, "") for f in self.FIELDS])
+        values.append([float(tol[f]) for f in self.FIELDS]) # dòng cuối: dung sai chung
+        pct.append([False] * len(self.FIELDS))
+        self.values, self.pct = np.array(values, dtype=float), np.array(pct, dtype=bool)
+
+    def thresholds(self, keys, items, dat):
+        """{"kg_min", "kg_max", "bag_diff"} -> mảng dung sai của từng (keys[i], items[i]); dat: SL đặt (cho rule theo %)."""
+        n = len(items)
+        rule = np.full(n, len(self.match), dtype=np.int32)
+        if self.match and n:
+            ic, iu = pd.factorize(pd.Series(items, dtype=object))
+            kc, ku = pd.factorize(pd.Series(keys, dtype=object))
+            # Lớp Key: tổ hợp các bộ tiền tố mà Key khớp (thường chỉ vài lớp)
+            prefix_sets = list(dict.fromkeys(pf for _, pf in self.match if pf is not None))
+            hits = np.array([[str(u).startswith(pf) for pf in prefix_sets] for u in ku], dtype=bool).reshape(len(ku), len(prefix_sets))
+            classes, k_cls = np.unique(hits, axis=0, return_inverse=True)
+            pairs, pair_codes = np.unique(ic.astype(np.int64) * len(classes) + k_cls.reshape(-1)[kc], return_inverse=True)
+            pair_item, pair_cls = pairs // len(classes), pairs % len(classes)
+            item_pos = {u: i for i, u in enumerate(iu)}
+            pair_rule = np.full(len(pairs), len(self.match), dtype=np.int32)
+            for ri in range(len(self.match) - 1, -1, -1): # duyệt ngược: rule đứng trước ghi đè sau cùng
+                items_ok, prefixes = self.match[ri]
+                m = np.ones(len(pairs), dtype=bool)
+                if items_ok is not None:
+                    ok = np.zeros(len(iu), dtype=bool)
+                    ok[[item_pos[x] for x in items_ok if x in item_pos]] = True
+                    m &= ok[pair_item]
+                if prefixes is not None:
+                    m &= classes[pair_cls, prefix_sets.index(prefixes)]
+                pair_rule[m] = ri
+            rule = pair_rule[pair_codes.reshape(-1)]
+        vals = self.values[rule]
+        pct = self.pct[rule]
+        if pct.any():
+            base = np.abs(np.nan_to_num(np.asarray(dat, dtype=float)))[:, None]
+            vals = np.where(pct, vals / 100.0 * base, vals)
+        return {f: vals[:, i] for i, f in enumerate(self.FIELDS)}
+
+class DataProcessor:
+    ENGINES = ("vector", "loop")
+
+    def __init__(self, config_mgr, previous=None):
+        self.cfg = config_mgr
+        self.cache = ParseCache(self.cfg.data["cache"])
+        self.layouts = HeaderLayouts() # bố cục tiêu đề theo mẫu file (đọc chỉ các cột cần dùng)
+        self.previous = previous # DataProcessor của lần kiểm tra trước (chế độ cộng dồn Phiếu Xuất, xem _run_incremental)
+        
+        # Dữ liệu hiển thị (List of Dict)
+        self.res_tab1 = [] 
+        self.res_tab2 = [] 
+        self.res_tab3 = [] 
+        
+        # Dữ liệu chi tiết cho Popup (Map: (Key, Item) -> {Orders:[], Exports:[]})
+        self.detail_map = {} 
+
+        # Dữ liệu dòng đã khóa của lần chạy "vector" gần nhất (dùng cho update_status / update_aliases)
+        self._acc = None
+        self._g2 = None # Unit / tổng / Status / Tag của Tab 2 theo nhóm (Tab2Rows đọc trải xuống từng dòng PX)
+        self._tab3 = ExceptionGroups() # ngoại lệ đang gom, res_tab3 = self._tab3.records()
+        self._job = None
+        self.version = 0 # tăng mỗi khi kết quả thay đổi (giao diện dựng lại chỉ mục tìm kiếm)
+        self.stats = RunStats() # thời gian từng bước của lần chạy gần nhất
+        self.changes = None # lần chạy cộng dồn: {"rows", "groups", "new_groups", "status_changed"}
+        # Chế độ theo dõi file: giữ khung đã đọc của từng bên để lần chạy lại sau dùng lại bên không đổi
+        self.keep_frames = False
+        self.changed_sides = None # các bên có file đổi (FileWatcher); None = chỉ so chữ ký file
+        self._frames = {} # bên -> ((chữ ký file, spec_key), DataFrame), khi keep_frames
+        self._reuse = {} # _frames của lần chạy trước, chỉ trong lúc chạy
+
+    def normalize(self, text):
+        if pd.isna(text) or text == "": return ""
+        t = str(text).strip().upper()
+        t = " ".join(t.split())
+        return unicodedata.normalize('NFC', t)
+
+    def extract_key(self, text):
+        s = self.normalize(text)
+        match = re.search(r'((ST|DC|KH)\d+)', s)
+        return match.group(1) if match else "UNKNOWN"
+
+    def run_analysis(self, engine=None, job=None):
+        """job (AnalysisJob, tùy chọn): nhận tiến độ theo từng bước và có thể hủy giữa chừng (AnalysisCancelled)."""
+        self._job = job
+        self.stats = RunStats(engine or self.cfg.data.get("engine", "vector"))
+        try:
+            return self._run(engine)
+        finally:
+            self.stats.mark(None)
+            self._job = None
+            self._reuse = {}
+
+    def _progress(self, phase, done=None):
+        if self._job: self._job.report(phase, done)
+
+    def _run(self, engine):
+        self.res_tab1, self.res_tab2, self.res_tab3 = [], [], []
+        self.detail_map = {}
+        self._acc = self._g2 = None
+        self._tab3 = ExceptionGroups()
+        self.version += 1
+        
+        p_dh = resolve_inputs(self.cfg.data["paths"]["dh"])
+        p_px = resolve_inputs(self.cfg.data["paths"]["px"])
+        engine = engine or self.cfg.data.get("engine", "vector")
+        if engine not in self.ENGINES:
+            return False, f"Engine không hợp lệ: {engine}"
+
+        # --- 1. ĐỌC FILE ---
+        if not p_dh or not p_px:
+            return False, "Lỗi đọc file: chưa chọn file " + ("Đơn Hàng" if not p_dh else "Phiếu Xuất")
+        self.stats.info["files"] = {"dh": len(p_dh), "px": len(p_px)}
+        self._dh_sig, self._cfg_sig = file_signature(p_dh), self._settings_sig()
+        prev, self.previous = self.previous, None # không giữ chuỗi các lần chạy cũ trong bộ nhớ
+        if prev is not None and self.keep_frames: # bên không đọc lại (cộng dồn chỉ đọc Phiếu Xuất) vẫn giữ khung cũ
+            self._reuse, self._frames = prev._frames, dict(prev._frames)
+        if engine == "vector" and prev is not None and self.cfg.data.get("incremental", True) and not self.use_stream(p_px):
+            try:
+                if self._run_incremental(prev, p_px):
+                    self.stats.info["incremental"] = self.changes["rows"]
+                    return True, "Xử lý hoàn tất!"
+            except AnalysisCancelled:
+                raise
+            except Exception as e:
+                return False, f"Lỗi đọc file: {str(e)}"
+        self.changes = None
+
+        if engine == "vector" and self.use_stream(p_dh + p_px):
+            rows = self.cfg.data["stream"].get("chunk_rows", 50000)
+            cmap = self._settings()[0]
+            chunks = lambda files, side: (c for p in files for c in iter_excel_chunks(
+                p, rows, read_spec(cmap, side, self.cfg.data.get("read", {})), self.layouts))
+            try:
+                self._analyze_chunks(chunks(p_dh, "dh"), chunks(p_px, "px"), streaming=True)
+            except AnalysisCancelled:
+                raise
+            except Exception as e:
+                return False, f"Lỗi đọc file: {str(e)}"
+            return True, "Xử lý hoàn tất!"
+
+        try:
+            self.stats.mark("Đọc file")
+            df_dh, df_px = self.read_inputs(dh=p_dh, px=p_px)
+            self.stats.add_rows("Đọc file", len(df_dh) + len(df_px))
+        except AnalysisCancelled:
+            raise
+        except Exception as e:
+            return False, f"Lỗi đọc file: {str(e)}"
+
+        if engine == "loop":
+            self._analyze_loop(df_dh, df_px)
+        else:
+            self._analyze_vector(df_dh, df_px)
+        return True, "Xử lý hoàn tất!"
+
+    def use_stream(self, paths):
+        # openpyxl read-only chỉ đọc được định dạng xlsx
+        return self.cfg.data["stream"].get("enabled", False) and all(
+            p.lower().endswith((".xlsx", ".xlsm")) for p in paths)
+
+    def read_spec(self, side):
+        return read_spec(self._settings()[0], side, self.cfg.data.get("read", {}))
+
+    def read_excel(self, path, side):
+        spec = self.read_spec(side)
+        return self.cache.read(path, lambda p: self._parse(p, spec), spec_key(spec))
+
+    def _parse_args(self, path, spec):
+        # Tham số parse_excel: kèm bố cục đã lưu của mẫu file (nếu có)
+        return path, spec, self.layouts.get(path, spec) if spec else None
+
+    def _parse(self, path, spec, result=None):
+        """parse_excel (hoặc kết quả của nó từ process pool) -> DataFrame; ghi nhớ bố cục vừa dùng."""
+        df, layout = result or parse_excel(*self._parse_args(path, spec))
+        if layout: self.layouts.put(path, spec, layout)
+        df.attrs["files"] = [(len(df), layout["row"] + 2 if layout else 2)] # xem RowNumbers; ParseCache lưu kèm
+        return df
+
+    def read_inputs(self, **sides):
+        """Đọc mọi file của từng bên (dh=[...], px=[...]), chỉ các cột cần dùng (read_spec); file chưa có trong cache
+        được đọc song song trên process pool. Trả về 1 DataFrame cho mỗi bên theo thứ tự tham số,
+        các file cùng 1 bên được nối theo thứ tự danh sách. Bên không đổi so với lần chạy trước (keep_frames, cùng chữ ký
+        file + cách đọc, không nằm trong changed_sides) dùng lại khung đã đọc, không đọc lại."""
+        specs = {side: self.read_spec(side) for side in sides}
+        keys = {side: (file_signature(files), spec_key(specs[side])) for side, files in sides.items()}
+        reused = {}
+        for side in sides:
+            old = self._reuse.get(side)
+            if old is not None and old[0] == keys[side] and side not in (self.changed_sides or ()):
+                reused[side] = old[1]
+        frames, tickets, misses = {}, {}, []
+        for job in dict.fromkeys((side, p) for side, files in sides.items() if side not in reused for p in files):
+            df, tickets[job] = self.cache.lookup(job[1], spec_key(specs[job[0]]))
+            if df is not None: frames[job] = df
+            else: misses.append(job)
+        rows = sum(len(df) for df in frames.values())
+        if frames: self._progress("Đọc file", rows)
+
+        workers = self.cfg.data.get("read_workers", 0) or os.cpu_count() or 1
+        if len(misses) > 1 and workers > 1:
+            pool = ProcessPoolExecutor(max_workers=min(len(misses), workers))
+            try:
+                futures = {pool.submit(parse_excel, *self._parse_args(job[1], specs[job[0]])): job for job in misses}
+                for fut in as_completed(futures):
+                    job = futures[fut]
+                    frames[job] = self._parse(job[1], specs[job[0]], fut.result())
+                    self.cache.store(tickets[job], frames[job])
+                    rows += len(frames[job])
+                    self._progress("Đọc file", rows)
+            finally:
+                pool.shutdown(wait=False, cancel_futures=True)
+        else:
+            for job in misses:
+                frames[job] = self._parse(job[1], specs[job[0]])
+                self.cache.store(tickets[job], frames[job])
+                rows += len(frames[job])
+                self._progress("Đọc file", rows)
+
+        def join(side, files):
+            if side in reused: return reused[side]
+            if len(files) == 1: return frames[side, files[0]]
+            out = pd.concat([frames[side, p] for p in files], ignore_index=True)
+            out.attrs["files"] = [f for p in files for f in frames[side, p].attrs.get("files") or [(len(frames[side, p]), 2)]]
+            return out
+        out = tuple(join(side, files) for side, files in sides.items())
+        if self.keep_frames:
+            self._frames.update((side, (keys[side], df)) for side, df in zip(sides, out))
+        return out
+
+    def _settings(self):
+        cmap = self.cfg.data["col_map"] if self.cfg.data["col_map"] else SYSTEM_COLS
+        bag_list = set(self.cfg.data["bag_items"])
+        alias_map = self.cfg.data["alias_map"]
+        return cmap, bag_list, alias_map
+
+    # -------------------------------------------------------------------------
+    # ENGINE "loop": duyệt từng dòng (bản gốc, giữ lại để đối chiếu kết quả)
+    # -------------------------------------------------------------------------
+    def _analyze_loop(self, df_dh, df_px):
+        cmap, bag_list, alias_map = self._settings()
+        rows_dh, rows_px = RowNumbers.of(df_dh), RowNumbers.of(df_px) # số dòng Excel cho Tab 3
+
+        # --- 2. XỬ LÝ ĐƠN HÀNG ---
+        self.stats.mark("Đơn hàng", len(df_dh))
+        # Map cột
+        dh_c_code = cmap.get("dh_code", "")
+        dh_c_item = cmap.get("dh_item", "")
+        dh_c_sl = cmap.get("dh_sl", "")
+        dh_c_name = cmap.get("dh_name", "")
+        dh_c_so = cmap.get("dh_so", "")
+        dh_c_note = cmap.get("dh_note", "Ghi chú")
+
+        # Temp Storage
+        orders_agg = {} # (Key, Item) -> Total SL
+        orders_count = {} # (Key, Item) -> Count lines (để check gộp)
+
+        for idx, row in df_dh.iterrows():
+            if idx % 5000 == 0: self._progress("Gom nhóm", idx)
+            raw_key = str(row.get(dh_c_code, ''))
+            key = self.extract_key(raw_key)
+            
+            raw_item = self.normalize(row.get(dh_c_item, ''))
+            item = alias_map.get(raw_item, raw_item)
+            
+            try: sl = float(row.get(dh_c_sl, 0))
+            except: sl = 0
+            if sl <= 0: continue
+
+            if key == "UNKNOWN":
+                self._tab3.add_one("Đơn Hàng", "Không định danh Khách", raw_key, int(rows_dh(idx)), lambda: f"{raw_key}|{raw_item}")
+                continue
+
+            k = (key, item)
+            
+            # Cộng dồn
+            orders_agg[k] = orders_agg.get(k, 0) + sl
+            orders_count[k] = orders_count.get(k, 0) + 1
+            
+            # Lưu chi tiết vào detail_map
+            if k not in self.detail_map: self.detail_map[k] = {'orders': [], 'exports': []}
+            self.detail_map[k]['orders'].append({
+                "SoDH": row.get(dh_c_so, ''),
+                "Name": row.get(dh_c_name, ''),
+                "SL": sl,
+                "Note": row.get(dh_c_note, '')
+            })
+
+        # --- 3. XỬ LÝ PHIẾU XUẤT ---
+        self.stats.mark("Phiếu xuất", len(df_px))
+        exports_agg = {}
+        list_px_lines = []
+
+        px_c_code = cmap.get("px_code", "")
+        px_c_item = cmap.get("px_item", "")
+        px_c_sl_x = cmap.get("px_sl_xuat", "")
+        px_c_sl_t = cmap.get("px_sl_tui", "")
+        px_c_so = cmap.get("px_so", "")
+        px_c_name = cmap.get("px_name", "")
+
+        for idx, row in df_px.iterrows():
+            if idx % 5000 == 0: self._progress("Gom nhóm", len(df_dh) + idx)
+            raw_key = str(row.get(px_c_code, ''))
+            key = self.extract_key(raw_key)
+            raw_item = self.normalize(row.get(px_c_item, ''))
+            item = alias_map.get(raw_item, raw_item)
+            
+            try: sl_x = float(row.get(px_c_sl_x, 0))
+            except: sl_x = 0
+            try: sl_t = float(row.get(px_c_sl_t, 0))
+            except: sl_t = 0
+            
+            if key == "UNKNOWN":
+                self._tab3.add_one("Phiếu Xuất", "Không định danh Khách", raw_key, int(rows_px(idx)), lambda: f"{raw_key}|{raw_item}|PX:{row.get(px_c_so,'')}")
+                continue
+            if item == "":
+                self._tab3.add_one("Phiếu Xuất", "Mã hàng rỗng", raw_key, int(rows_px(idx)), lambda: str(row.values))
+                continue
+
+            k = (key, item)
+            
+            # Cộng dồn
+            if k not in exports_agg: exports_agg[k] = {'Kg': 0.0, 'Tui': 0.0}
+            exports_agg[k]['Kg'] += sl_x
+            exports_agg[k]['Tui'] += sl_t
+
+            # Lưu chi tiết
+            if k not in self.detail_map: self.detail_map[k] = {'orders': [], 'exports': []}
+            self.detail_map[k]['exports'].append({
+                "SoPX": row.get(px_c_so, ''),
+                "Name": row.get(px_c_name, ''),
+                "SL_Xuat": sl_x,
+                "SL_Tui": sl_t
+            })
+
+            # Lưu dòng để tính Tab 2
+            list_px_lines.append({
+                "SoPX": str(row.get(px_c_so, '')),
+                "Key": key, "Item": item, "Name": str(row.get(px_c_name, '')),
+                "SL_Xuat": sl_x, "SL_Tui": sl_t
+            })
+
+        self.res_tab3 = self._tab3.records()
+
+        # --- 4. TÍNH TOÁN TAB 1 (TỔNG HỢP) ---
+        self._progress("Tính trạng thái")
+        all_keys = set(orders_agg.keys()) | set(exports_agg.keys())
+        self.stats.mark("Tab 1", len(all_keys))
+        
+        # Dung sai theo từng (Key, Item): tính 1 lần cho cả danh sách
+        all_keys = list(all_keys)
+        tol = ToleranceRules(self.cfg.data["tolerance"]).thresholds(
+            [k for k, _ in all_keys], [i for _, i in all_keys], [orders_agg.get(k, 0) for k in all_keys])
+        tol = zip(*(tol[f].tolist() for f in ToleranceRules.FIELDS))
+        tab2_status = {} # (Key, Item) -> (Status, Tag) của Tab 2, dùng chung cho mọi dòng PX của nhóm
+
+        for (k, item), (tol_min, tol_max, tol_bag) in zip(all_keys, tol):
+            sl_dat = orders_agg.get((k, item), 0)
+            ex_data = exports_agg.get((k, item), {'Kg': 0, 'Tui': 0})
+            
+            is_bag = item in bag_list
+            unit = "Túi" if is_bag else "Kg"
+            
+            sl_xuat_final = ex_data['Tui'] if is_bag else ex_data['Kg']
+            lech = sl_xuat_final - sl_dat
+            
+            # Logic Trạng Thái
+            status = "ĐỦ"
+            tag = "ok"
+            status2 = "" # nhãn Tab 2 (theo tổng)
+            
+            if is_bag:
+                if abs(lech) > tol_bag:
+                    if sl_dat == 0: status = "KHÔNG ĐẶT MÀ XUẤT"; status2 = "SAI MÃ / KHÔNG ĐẶT"; tag = "tim"
+                    elif lech < 0: status = f"THIẾU {abs(lech):.0f}"; status2 = "TỔNG THIẾU"; tag = "do"
+                    else: status = f"THỪA {abs(lech):.0f}"; status2 = "TỔNG THỪA"; tag = "vang"
+            else:
+                if lech < tol_min: status = f"THIẾU {abs(lech):.2f}"; status2 = "TỔNG THIẾU"; tag = "do"
+                elif lech > tol_max:
+                    if sl_dat == 0: status = "KHÔNG ĐẶT MÀ XUẤT"; status2 = "SAI MÃ / KHÔNG ĐẶT"; tag = "tim"
+                    else: status = f"THỪA {abs(lech):.2f}"; status2 = "TỔNG THỪA"; tag = "vang"
+            tab2_status[(k, item)] = (status2, tag)
+            
+            # Check Gộp
+            is_merged = orders_count.get((k, item), 0) > 1
+            if is_merged:
+                tag = "gop" if tag == "ok" else tag # Nếu lỗi thì ưu tiên màu lỗi, nếu đủ thì màu gộp
+                # Nhưng yêu cầu là màu xanh dương cho dòng gộp. 
+                # Ta sẽ xử lý hiển thị icon ở giao diện.
+            
+            self.res_tab1.append({
+                "Key": k, "Item": item, "Unit": unit,
+                "SL_Dat": sl_dat, "SL_Xuat": sl_xuat_final, "Lech": lech,
+                "Status": status, "Tag": tag, "IsMerged": is_merged
+            })
+
+        # --- 5. TÍNH TOÁN TAB 2 (CHI TIẾT) ---
+        self.stats.mark("Tab 2", len(list_px_lines))
+        for row in list_px_lines:
+            k = row['Key']; item = row['Item']
+            is_bag = item in bag_list
+            unit = "Túi" if is_bag else "Kg"
+            
+            total_dat = orders_agg.get((k, item), 0)
+            total_xuat = exports_agg.get((k, item), {'Kg':0, 'Tui':0})
+            val_xuat_total = total_xuat['Tui'] if is_bag else total_xuat['Kg']
+            
+            lech_tong = val_xuat_total - total_dat
+            
+            # Trạng thái đã tính theo nhóm ở Tab 1
+            status, tag = tab2_status[(k, item)]
+
+            row_out = row.copy()
+            row_out.update({
+                "Unit": unit, "SL_Dong": row['SL_Tui'] if is_bag else row['SL_Xuat'],
+                "Total_Dat": total_dat, "Total_Xuat": val_xuat_total,
+                "Lech_Tong": lech_tong, "Status": status, "Tag": tag
+            })
+            self.res_tab2.append(row_out)
+
+    # -------------------------------------------------------------------------
+    # ENGINE "vector": xử lý nguyên cột bằng pandas/NumPy
+    # -------------------------------------------------------------------------
+    def _col(self, df, name, default=""):
+        # Giống row.get(name, default): thiếu cột thì trả về cột hằng
+        if name in df.columns: return df[name]
+        return pd.Series(default, index=df.index, dtype=object)
+
+    def _per_unique(self, s, fn, na_value):
+        # Chỉ tính fn trên các giá trị duy nhất rồi trải lại theo dòng (mã KH/mã hàng lặp rất nhiều)
+        codes, uniques = pd.factorize(s)
+        out = fn(pd.Series(uniques, dtype=object)).to_numpy(dtype=object)
+        out = np.append(out, na_value) # code -1 (NaN) -> na_value
+        return pd.Series(out[codes], index=s.index, dtype=object)
+
+    def _normalize_uniques(self, u):
+        u = u.astype(str).str.strip().str.upper()
+        return u.str.split().str.join(" ").str.normalize('NFC')
+
+    def normalize_col(self, s):
+        return self._per_unique(s, self._normalize_uniques, "")
+
+    def extract_key_col(self, s):
+        def keys(u):
+            return self._normalize_uniques(u).str.extract(r'((?:ST|DC|KH)\d+)', expand=False).fillna("UNKNOWN")
+        return self._per_unique(s, keys, "UNKNOWN")
+
+    def _safe_float(self, v):
+        try: return float(v)
+        except: return 0.0
+
+    def to_float_col(self, s):
+        # Tương đương float(x): chuỗi lỗi -> 0, ô trống (NaN) giữ NaN như float(nan)
+        def parse(u):
+            try: return u.astype(float)
+            except (TypeError, ValueError): return u.map(self._safe_float)
+        return self._per_unique(s, parse, np.nan).to_numpy(dtype=float)
+
+    def to_str_col(self, s):
+        # Tương đương str(x): NaN -> "nan"
+        return s.astype(object).where(s.notna(), "nan")
+
+    def alias_col(self, items, alias_map):
+        if not alias_map: return items
+        mapped = items.map(alias_map)
+        return items.where(mapped.isna(), mapped)
+
+    def _records(self, columns):
+        # {cột: mảng} -> list of dict (định dạng res_tab*/detail_map hiện tại), nhanh hơn DataFrame.to_dict
+        names = list(columns)
+        lists = [v.tolist() if hasattr(v, "tolist") else list(v) for v in columns.values()]
+        return [dict(zip(names, vals)) for vals in zip(*lists)]
+
+    def _status_arrays(self, is_bag, dat, lech, tol, labels):
+        """Gán Status/Tag cho cả mảng. labels: (không đặt, thiếu, thừa) - chuỗi có thể chứa {v} (giá trị lệch).
+        tol: dung sai chung (số) hoặc theo từng dòng (mảng, ToleranceRules.thresholds)."""
+        tol_min, tol_max, tol_bag = tol["kg_min"], tol["kg_max"], tol["bag_diff"]
+        abs_lech = np.abs(lech)
+        bag_err = is_bag & (abs_lech > tol_bag)
+        kg_thieu = ~is_bag & (lech < tol_min)
+        kg_thua = ~is_bag & ~kg_thieu & (lech > tol_max)
+        err = bag_err | kg_thua
+        khong_dat = err & (dat == 0)
+
+        rules = [
+            (khong_dat, labels[0], "tim", None),
+            (bag_err & ~khong_dat & (lech < 0), labels[1], "do", "%.0f"),
+            (bag_err & ~khong_dat & ~(lech < 0), labels[2], "vang", "%.0f"),
+            (kg_thieu, labels[1], "do", "%.2f"),
+            (kg_thua & ~khong_dat, labels[2], "vang", "%.2f"),
+        ]
+        status = np.full(len(lech), labels[3], dtype=object)
+        tag = np.full(len(lech), "ok", dtype=object)
+        for mask, label, t, fmt in rules:
+            if not mask.any(): continue
+            if fmt and "{v}" in label:
+                head = label.replace("{v}", "")
+                status[mask] = np.char.add(head, np.char.mod(fmt, abs_lech[mask]))
+            else:
+                status[mask] = label
+            tag[mask] = t
+        return status, tag
+
+    def _key_patterns(self, raw_key):
+        return self._per_unique(raw_key, lambda u: u.map(key_pattern), "(trống)").to_numpy()
+
+    def _prepare_orders(self, df, cmap, alias_map, numbers, base=0):
+        """Chuẩn hóa 1 khối Đơn Hàng -> dòng hợp lệ; ngoại lệ gom vào self._tab3.
+        numbers: RowNumbers của bên Đơn Hàng; base: vị trí dòng đầu khối trong bên đó."""
+        raw_key = self._col(df, cmap.get("dh_code", ""))
+        key = self.extract_key_col(raw_key)
+        raw_item = self.normalize_col(self._col(df, cmap.get("dh_item", "")))
+        item = self.alias_col(raw_item, alias_map)
+        sl = self.to_float_col(self._col(df, cmap.get("dh_sl", ""), 0))
+
+        valid = ~(sl <= 0) # NaN vẫn được giữ như bản gốc
+        unknown = valid & (key == "UNKNOWN").to_numpy()
+        ok = valid & ~unknown
+
+        pos = np.flatnonzero(unknown)
+        self._tab3.add("Đơn Hàng", "Không định danh Khách", self._key_patterns(raw_key.iloc[pos]), numbers(base + pos),
+                       lambda i: (self.to_str_col(raw_key.iloc[pos[i]]) + "|" + raw_item.iloc[pos[i]]).tolist())
+        lines = pd.DataFrame({
+            "Key": key[ok], "Item": item[ok], "RawItem": raw_item[ok],
+            "SoDH": self._col(df, cmap.get("dh_so", ""))[ok],
+            "Name": self._col(df, cmap.get("dh_name", ""))[ok],
+            "SL": sl[ok],
+            "Note": self._col(df, cmap.get("dh_note", "Ghi chú"))[ok],
+        })
+        return lines
+
+    def _prepare_exports(self, df, cmap, alias_map, numbers, base=0):
+        """Chuẩn hóa 1 khối Phiếu Xuất -> dòng hợp lệ; ngoại lệ gom vào self._tab3.
+        numbers: RowNumbers của bên Phiếu Xuất; base: vị trí dòng đầu khối trong bên đó."""
+        raw_key = self._col(df, cmap.get("px_code", ""))
+        key = self.extract_key_col(raw_key)
+        raw_item = self.normalize_col(self._col(df, cmap.get("px_item", "")))
+        item = self.alias_col(raw_item, alias_map)
+        so = self._col(df, cmap.get("px_so", ""))
+
+        unknown = (key == "UNKNOWN").to_numpy()
+        empty = ~unknown & (item == "").to_numpy()
+        ok = ~unknown & ~empty
+
+        pos = np.flatnonzero(unknown)
+        self._tab3.add("Phiếu Xuất", "Không định danh Khách", self._key_patterns(raw_key.iloc[pos]), numbers(base + pos),
+                       lambda i: (self.to_str_col(raw_key.iloc[pos[i]]) + "|" + raw_item.iloc[pos[i]]
+                                  + "|PX:" + self.to_str_col(so.iloc[pos[i]])).tolist())
+        pos_e = np.flatnonzero(empty)
+        self._tab3.add("Phiếu Xuất", "Mã hàng rỗng", self._key_patterns(raw_key.iloc[pos_e]), numbers(base + pos_e),
+                       lambda i: [str(v) for v in df.iloc[pos_e[i]].to_numpy(dtype=object)])
+
+        lines = pd.DataFrame({
+            "SoPX": so[ok], "Key": key[ok], "Item": item[ok], "RawItem": raw_item[ok],
+            "Name": self._col(df, cmap.get("px_name", ""))[ok],
+            "SL_Xuat": self.to_float_col(self._col(df, cmap.get("px_sl_xuat", ""), 0))[ok],
+            "SL_Tui": self.to_float_col(self._col(df, cmap.get("px_sl_tui", ""), 0))[ok],
+        })
+        return lines
+
+    def _analyze_vector(self, df_dh, df_px):
+        self._analyze_chunks([df_dh], [df_px])
+
+    def _analyze_chunks(self, dh_chunks, px_chunks, streaming=False):
+        """Xử lý Đơn Hàng rồi Phiếu Xuất theo từng khối; chỉ giữ lại các cột cần cho kết quả."""
+        cmap, bag_list, alias_map = self._settings()
+        acc = GroupAccumulator()
+        dh_parts, px_parts = [], []
+        dh_codes, px_codes, px_fp = [], [], []
+        self._px_cols = None
+
+        done = n_dh = n_px = 0 # n_dh / n_px: số dòng đã qua của từng bên (số dòng nguồn cho Tab 3)
+        rows_dh, rows_px = RowNumbers(), RowNumbers()
+
+        # --- 2. ĐƠN HÀNG ---
+        for chunk in (self.stats.iterate("Đọc file", dh_chunks) if streaming else dh_chunks):
+            self.stats.mark("Đơn hàng", len(chunk))
+            done += len(chunk)
+            if streaming: self._progress("Đọc file", done)
+            rows_dh.add_frame(chunk)
+            lines = self._prepare_orders(chunk, cmap, alias_map, rows_dh, n_dh)
+            n_dh += len(chunk)
+            codes = acc.codes_for(lines["Key"], lines["Item"])
+            acc.add_orders(codes, lines["SL"].to_numpy())
+            dh_parts.append(lines.drop(columns=["Key", "Item"]))
+            dh_codes.append(codes)
+            self._progress("Gom nhóm", done)
+
+        # --- 3. PHIẾU XUẤT ---
+        for chunk in (self.stats.iterate("Đọc file", px_chunks) if streaming else px_chunks):
+            self.stats.mark("Phiếu xuất", len(chunk))
+            done += len(chunk)
+            px_fp.append(self._fingerprint(chunk))
+            if self._px_cols is None: self._px_cols = list(chunk.columns)
+            if streaming: self._progress("Đọc file", done)
+            rows_px.add_frame(chunk)
+            lines = self._prepare_exports(chunk, cmap, alias_map, rows_px, n_px)
+            n_px += len(chunk)
+            codes = acc.codes_for(lines["Key"], lines["Item"])
+            acc.add_exports(codes, lines["SL_Xuat"].to_numpy(), lines["SL_Tui"].to_numpy())
+            px_parts.append(lines.drop(columns=["Key", "Item"]))
+            px_codes.append(codes)
+            self._progress("Gom nhóm", done)
+
+        self._px_fp = np.concatenate(px_fp) if px_fp else np.zeros(0, dtype=np.uint64)
+        self._finalize(acc,
+                       pd.concat(dh_parts, ignore_index=True), np.concatenate(dh_codes),
+                       pd.concat(px_parts, ignore_index=True), np.concatenate(px_codes))
+
+    # -------------------------------------------------------------------------
+    # CỘNG DỒN: Phiếu Xuất được ghi thêm dòng trong ngày -> chỉ xử lý các dòng mới
+    # -------------------------------------------------------------------------
+    def _settings_sig(self):
+        return settings_signature(self.cfg.data)
+
+    @staticmethod
+    def _fingerprint(df):
+        # Dấu vân tay từng dòng (theo giá trị các ô) để nhận ra file chỉ được nối thêm dòng
+        return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+    def _adopt(self, prev):
+        """Chép trạng thái của lần chạy trước để cộng dồn tiếp; không sửa gì trên prev (giao diện vẫn đang hiển thị nó)."""
+        acc = GroupAccumulator()
+        acc.index, acc.keys, acc.size = dict(prev._acc.index), list(prev._acc.keys), prev._acc.size
+        acc.sl_dat, acc.cnt, acc.kg, acc.tui = (a.copy() for a in (prev._acc.sl_dat, prev._acc.cnt, prev._acc.kg, prev._acc.tui))
+        self._acc = acc
+        self._dh, self._c_dh, self._dh_view = prev._dh, prev._c_dh, prev._dh_view # phía Đơn Hàng không đổi, chỉ đọc
+        self._px, self._c_px, self._px_view = prev._px, prev._c_px, prev._px_view
+        self._g_key, self._g_item, self._alive = prev._g_key, prev._g_item, prev._alive.copy()
+        self._g2 = prev._g2 # chỉ thay bằng mảng mới (_set_tab2_groups), không sửa tại chỗ
+        self._tab1_rows = list(prev._tab1_rows) # chỉ thay từng bản ghi bằng dict mới, không sửa tại chỗ
+        self.res_tab2 = Tab2Rows(self)
+        self._tab3 = prev._tab3.copy()
+        self.detail_map = prev.detail_map # ảnh chụp chỉ đọc, dựng lại sau khi cộng dồn
+        self._px_cols = prev._px_cols
+
+    def _run_incremental(self, prev, p_px):
+        """Cùng Đơn Hàng + cấu hình, Phiếu Xuất mới chứa nguyên các dòng cũ ở đầu (so theo dấu vân tay):
+        chỉ cộng dồn các dòng mới và tính lại trạng thái các (Key, Item) chúng chạm tới.
+        Trả về False nếu không dùng được (khi đó chạy lại toàn bộ)."""
+        if not prev.can_update() or getattr(prev, "_px_fp", None) is None: return False
+        if prev._dh_sig != self._dh_sig or prev._cfg_sig != self._cfg_sig: return False
+
+        self.stats.mark("Đọc file")
+        df_px, = self.read_inputs(px=p_px)
+        self.stats.add_rows("Đọc file", len(df_px))
+        fp = self._fingerprint(df_px)
+        n_old = len(prev._px_fp)
+        if list(df_px.columns) != prev._px_cols or len(fp) < n_old or not np.array_equal(fp[:n_old], prev._px_fp):
+            return False
+
+        self._adopt(prev)
+        acc = self._acc
+        new = df_px.iloc[n_old:].reset_index(drop=True)
+        self.stats.mark("Phiếu xuất", len(new))
+        self._progress("Gom nhóm", len(new))
+        cmap, bag_list, alias_map = self._settings()
+        lines = self._prepare_exports(new, cmap, alias_map, RowNumbers.of(df_px), n_old)
+        codes = acc.codes_for(lines["Key"], lines["Item"])
+        acc.add_exports(codes, lines["SL_Xuat"].to_numpy(), lines["SL_Tui"].to_numpy())
+        self._px = pd.concat([self._px, lines.drop(columns=["Key", "Item"])], ignore_index=True)
+        self._px_view = CompactColumns(self._px)
+        self._c_px = np.concatenate([self._c_px, codes])
+        self._px_fp = fp
+
+        n_g = len(self._g_key)
+        if acc.size > n_g:
+            new_keys = acc.keys[n_g:]
+            self._g_key = np.concatenate([self._g_key, np.array([k for k, _ in new_keys], dtype=object)])
+            self._g_item = np.concatenate([self._g_item, np.array([i for _, i in new_keys], dtype=object)])
+            self._alive = np.concatenate([self._alive, np.zeros(len(new_keys), dtype=bool)])
+            self._tab1_rows.extend([None] * len(new_keys))
+
+        # Chỉ các nhóm có dòng mới: bản ghi mới thay cho bản ghi cũ (không sửa tại chỗ)
+        g = np.unique(codes)
+        self._progress("Tính trạng thái", len(g))
+        self.stats.mark("Tab 1", len(g))
+        self._alive[g] = True
+        old_status = {gi: self._tab1_rows[gi]["Status"] for gi in g if self._tab1_rows[gi] is not None}
+        d = self._derive(g)
+        for gi, rec in zip(g, self._tab1_records(g, d)):
+            self._tab1_rows[gi] = rec
+        self.res_tab1 = [r for r in self._tab1_rows if r is not None]
+
+        self.stats.mark("Tab 2", len(g))
+        self._set_tab2_groups(g, d) # dòng PX mới nằm cuối _px, Tab2Rows đọc theo thứ tự
+        self.res_tab3 = self._tab3.records()
+
+        self.stats.mark("Chi tiết", len(g))
+        self.detail_map = DetailIndex(self)
+
+        self.changes = {
+            "rows": len(new), "groups": {acc.keys[gi] for gi in g}, "new_groups": int(acc.size - n_g),
+            "status_changed": sum(1 for gi, s in old_status.items() if self._tab1_rows[gi]["Status"] != s),
+        }
+        return True
+
+    def _finalize(self, acc, dh, c_dh, px, c_px):
+        # Giữ lại dữ liệu dòng đã khóa để tính lại nhanh khi đổi hàng túi / dung sai / alias
+        self._acc = acc
+        self._dh, self._c_dh, self._dh_view = dh, c_dh, CompactColumns(dh)
+        self._px, self._c_px, self._px_view = px, c_px, CompactColumns(px)
+        self._g_key = np.array([k for k, _ in acc.keys], dtype=object)
+        self._g_item = np.array([i for _, i in acc.keys], dtype=object)
+        self._alive = np.ones(acc.size, dtype=bool)
+
+        self._progress("Tính trạng thái", acc.size)
+        self.stats.mark("Tab 1", acc.size)
+        g = np.arange(acc.size)
+        d = self._derive(g)
+        self._tab1_rows = self._tab1_records(g, d)
+        self.res_tab1 = list(self._tab1_rows)
+        self.stats.mark("Tab 2", len(px))
+        self._g2 = None
+        self._set_tab2_groups(g, d)
+        self.res_tab2 = Tab2Rows(self)
+        self.res_tab3 = self._tab3.records()
+        self.stats.mark("Chi tiết", len(dh) + len(px))
+        self.detail_map = DetailIndex(self)
+
+    def _derive(self, g):
+        """Unit / SL_Xuat / Lech / Status / Tag của các nhóm g (mảng mã nhóm) từ tổng đã cộng dồn."""
+        acc = self._acc
+        is_bag = pd.Series(self._g_item[g], dtype=object).isin(set(self.cfg.data["bag_items"])).to_numpy()
+        sl_dat = acc.sl_dat[g]
+        tol = ToleranceRules(self.cfg.data["tolerance"]).thresholds(self._g_key[g], self._g_item[g], sl_dat)
+        sl_xuat = np.where(is_bag, acc.tui[g], acc.kg[g])
+        lech = sl_xuat - sl_dat
+
+        status, tag = self._status_arrays(is_bag, sl_dat, lech, tol,
+                                          ("KHÔNG ĐẶT MÀ XUẤT", "THIẾU {v}", "THỪA {v}", "ĐỦ"))
+        is_merged = acc.cnt[g] > 1
+        # Tab 2: cùng ngưỡng nhưng nhãn theo tổng, không tô màu gộp
+        status2, tag2 = self._status_arrays(is_bag, sl_dat, lech, tol,
+                                            ("SAI MÃ / KHÔNG ĐẶT", "TỔNG THIẾU", "TỔNG THỪA", ""))
+        return {
+            "is_bag": is_bag, "unit": np.where(is_bag, "Túi", "Kg").astype(object),
+            "sl_dat": sl_dat, "sl_xuat": sl_xuat, "lech": lech, "is_merged": is_merged,
+            "status": status, "tag": np.where(is_merged & (tag == "ok"), "gop", tag).astype(object),
+            "status2": status2, "tag2": tag2,
+        }
+
+    def _tab1_records(self, g, d=None):
+        if d is None: d = self._derive(g)
+        return self._records({
+            "Key": self._g_key[g], "Item": self._g_item[g], "Unit": d["unit"],
+            "SL_Dat": d["sl_dat"], "SL_Xuat": d["sl_xuat"], "Lech": d["lech"],
+            "Status": d["status"], "Tag": d["tag"], "IsMerged": d["is_merged"],
+        })
+
+    def _set_tab2_groups(self, g, d):
+        """Ghi kết quả _derive của các nhóm g vào _g2. Luôn tạo mảng mới: processor cũ (đang hiển thị) dùng chung mảng cũ."""
+        n, old = len(self._g_key), self._g2
+        g2 = {}
+        for f in ("is_bag", "unit", "sl_dat", "sl_xuat", "lech", "status2", "tag2"):
+            a = np.empty(n, dtype=d[f].dtype)
+            if old is not None: a[:len(old[f])] = old[f]
+            a[g] = d[f]
+            g2[f] = a
+        self._g2 = g2
+
+    # -------------------------------------------------------------------------
+    # TÍNH LẠI NHANH (không đọc lại file) sau lần chạy engine "vector"
+    # -------------------------------------------------------------------------
+    def can_update(self):
+        return self._acc is not None
+
+    def snapshot(self):
+        """Bản chụp kết quả hiện tại cho luồng nền (lưu results.db) trong khi giao diện tiếp tục đổi trạng thái / alias.
+        Các lần tính lại chỉ gán list / mảng / dict mới chứ không sửa tại chỗ, nên chép tham chiếu là đủ."""
+        snap = copy.copy(self)
+        snap.res_tab1, snap.res_tab3 = list(self.res_tab1), list(self.res_tab3)
+        snap.res_tab2 = Tab2Rows(snap) if isinstance(self.res_tab2, Tab2Rows) else list(self.res_tab2)
+        snap.cfg = copy.copy(self.cfg)
+        snap.cfg.data = {**self.cfg.data, "paths": dict(self.cfg.data["paths"])}
+        return snap
+
+    def update_status(self, items=None):
+        """Hàng túi / dung sai thay đổi: tính lại Unit, SL_Xuat, Lech, Status, Tag cho các mặt hàng items (None = tất cả)."""
+        if not self.can_update(): return False
+        if items is None:
+            g = np.flatnonzero(self._alive)
+        else:
+            g = np.flatnonzero(self._alive & pd.Series(self._g_item, dtype=object).isin(set(items)).to_numpy())
+        if not len(g):
+            self._cfg_sig = self._settings_sig(); return True
+
+        d = self._derive(g)
+        for gi, rec in zip(g, self._tab1_records(g, d)):
+            self._tab1_rows[gi] = {**self._tab1_rows[gi], **rec} # bản ghi mới: lần chạy trước có thể đang dùng chung bản cũ
+        self.res_tab1 = [r for r in self._tab1_rows if r is not None]
+        self._set_tab2_groups(g, d)
+        self.version += 1
+        self._cfg_sig = self._settings_sig()
+        return True
+
+    def update_aliases(self, old_alias_map):
+        """alias_map thay đổi: đổi khóa các dòng có mã gốc bị ảnh hưởng rồi cộng dồn lại chỉ các nhóm liên quan.
+        Trả về False nếu cần chạy lại toàn bộ (chưa có dữ liệu, hoặc alias dính tới mã rỗng - các dòng đó không được lưu)."""
+        if not self.can_update(): return False
+        new_map = self.cfg.data["alias_map"]
+        changed = {k for k in set(old_alias_map) | set(new_map) if old_alias_map.get(k) != new_map.get(k)}
+        if not changed:
+            self._cfg_sig = self._settings_sig(); return True
+        if "" in changed or any(m.get(k) == "" for m in (old_alias_map, new_map) for k in changed):
+            return False
+
+        acc = self._acc
+        touched = []
+        self._c_dh, self._c_px = self._c_dh.copy(), self._c_px.copy() # có thể đang dùng chung với lần chạy trước
+        for frame, codes in ((self._dh, self._c_dh), (self._px, self._c_px)):
+            rows = np.flatnonzero(frame["RawItem"].isin(changed).to_numpy())
+            if not len(rows): continue
+            new_item = self.alias_col(pd.Series(frame["RawItem"].to_numpy()[rows], dtype=object), new_map)
+            new_codes = acc.codes_for(pd.Series(self._g_key[codes[rows]], dtype=object), new_item)
+            touched.append(codes[rows].copy())
+            touched.append(new_codes)
+            codes[rows] = new_codes
+        if not touched:
+            self._cfg_sig = self._settings_sig(); return True
+
+        # Nhóm mới (nếu có) nối vào cuối
+        n_old = len(self._g_key)
+        if acc.size > n_old:
+            new_keys = acc.keys[n_old:]
+            self._g_key = np.concatenate([self._g_key, np.array([k for k, _ in new_keys], dtype=object)])
+            self._g_item = np.concatenate([self._g_item, np.array([i for _, i in new_keys], dtype=object)])
+            self._alive = np.concatenate([self._alive, np.ones(len(new_keys), dtype=bool)])
+            self._tab1_rows.extend([None] * len(new_keys))
+
+        # Cộng dồn lại các nhóm liên quan theo đúng thứ tự dòng
+        g = np.unique(np.concatenate(touched))
+        mask = np.zeros(acc.size, dtype=bool); mask[g] = True
+        acc.reset(g)
+        rows_dh = np.flatnonzero(mask[self._c_dh])
+        rows_px = np.flatnonzero(mask[self._c_px])
+        acc.add_orders(self._c_dh[rows_dh], self._dh["SL"].to_numpy()[rows_dh])
+        acc.add_exports(self._c_px[rows_px], self._px["SL_Xuat"].to_numpy()[rows_px], self._px["SL_Tui"].to_numpy()[rows_px])
+        used = np.bincount(np.concatenate([self._c_dh[rows_dh], self._c_px[rows_px]]), minlength=acc.size)
+        self._alive[g] = used[g] > 0
+
+        # Tab 1: bỏ nhóm rỗng, dựng lại nhóm còn dòng
+        for gi in g[~self._alive[g]]:
+            self._tab1_rows[gi] = None
+        live = g[self._alive[g]]
+        d = self._derive(live)
+        for gi, rec in zip(live, self._tab1_records(live, d)):
+            old = self._tab1_rows[gi]
+            self._tab1_rows[gi] = rec if old is None else {**old, **rec}
+        self.res_tab1 = [r for r in self._tab1_rows if r is not None]
+
+        # Tab 2 (dòng PX đã mang mã nhóm mới) / chi tiết popup
+        self._set_tab2_groups(live, d)
+        self.detail_map = DetailIndex(self)
+        self.version += 1
+        self._cfg_sig = self._settings_sig()
+        return True
+
+class SearchIndex:
+    """Chỉ mục tìm kiếm cho 1 tab, dựng 1 lần sau mỗi lần phân tích.
+    Mỗi trường (Key, Item, SoPX, Status...) được mã hóa theo giá trị duy nhất + chỉ mục trigram trên các giá trị đó;
+    từ khóa có dấu cách (có thể vắt qua 2 trường) thì quét chuỗi tìm kiếm ghép sẵn.
+    Kết quả giống `keyword in f"{...}".upper()` của bản cũ."""
+    GRAM = 3
+
+    def __init__(self, records, fields, text_fn=None):
+        self.records = records
+        self.n = len(records)
+        self.fields = []
+        for f in fields:
+            codes, uniques = pd.factorize(pd.Series(field_values(records, f), dtype=object))
+            terms = [str(u).upper() for u in uniques]
+            grams = {}
+            for ti, t in enumerate(terms):
+                for g in {t[j:j + self.GRAM] for j in range(len(t) - self.GRAM + 1)}:
+                    grams.setdefault(g, []).append(ti)
+            self.fields.append((codes, terms, grams))
+        self.text_fn = text_fn
+        self.names = fields
+        self._texts = None
+        self.last = None # (từ khóa, chỉ số dòng khớp) của lần tìm trước
+
+    def texts(self):
+        if self._texts is None:
+            if self.text_fn:
+                texts = [self.text_fn(r) for r in self.records]
+            else: # ghép theo cột, không cần dựng từng bản ghi
+                cols = [field_values(self.records, f) for f in self.names]
+                texts = [" ".join(map(str, vals)).upper() for vals in zip(*cols)]
+            self._texts = np.array(texts, dtype=object)
+        return self._texts
+
+    def _term_hits(self, terms, grams, kw):
+        hit = np.zeros(len(terms), dtype=bool)
+        if len(kw) >= self.GRAM:
+            cand = None
+            for g in {kw[j:j + self.GRAM] for j in range(len(kw) - self.GRAM + 1)}:
+                post = grams.get(g)
+                if not post: return hit
+                cand = set(post) if cand is None else cand.intersection(post)
+                if not cand: return hit
+            cand = sorted(cand)
+        else:
+            cand = range(len(terms))
+        for ti in cand:
+            if kw in terms[ti]: hit[ti] = True
+        return hit
+
+    def search(self, keyword):
+        """Trả về mảng chỉ số dòng (tăng dần) khớp keyword; None nếu keyword rỗng (tất cả)."""
+        if not keyword: return None
+        cand = None
+        if self.last and self.last[0] in keyword:
+            cand = self.last[1] # gõ thêm ký tự -> chỉ lọc tiếp trên kết quả trước
+        if " " in keyword or not self.fields:
+            texts = self.texts() if cand is None else self.texts()[cand]
+            hit = np.fromiter((keyword in t for t in texts), dtype=bool, count=len(texts))
+        else:
+            hit = np.zeros(self.n if cand is None else len(cand), dtype=bool)
+            for codes, terms, grams in self.fields:
+                th = self._term_hits(terms, grams, keyword)
+                if th.any(): hit |= th[codes if cand is None else codes[cand]]
+        ids = np.flatnonzero(hit) if cand is None else cand[hit]
+        self.last = (keyword, ids)
+        return ids
+
+class AliasSuggester:
+    """Gợi ý mã hàng bên Đơn Hàng cho các dòng "KHÔNG ĐẶT MÀ XUẤT" (Tag "tim") của Tab 1.
+    Mã đặt được đánh chỉ mục n-gram (mã + tên) theo từng Key: mỗi mã xuất lệch chỉ chấm điểm các mã đặt
+    cùng Key có chung n-gram, không so từng cặp. Điểm = Dice trên n-gram mã (và tên nếu có), 0..1;
+    mã đặt đang bị xuất thiếu được cộng thêm một ít (thường chính là mã bị gõ sai ở Phiếu Xuất)."""
+    GRAM = 3
+    W_CODE, W_NAME, BONUS_SHORT = 0.6, 0.4, 0.1
+
+    def __init__(self, res_tab1, detail_map):
+        """res_tab1 / detail_map: kết quả của DataProcessor (engine nào cũng được)."""
+        self.tab1 = res_tab1
+        self.detail_map = detail_map
+        self.index = {} # Key -> ({gram mã: [chỉ số mã đặt]}, {gram tên: [...]})
+        self.catalog = [] # (Item, số gram mã, số gram tên, đang thiếu)
+        self.ordered_in = Counter() # Item -> số Key có đặt mã đó
+        self._grams = {} # chuỗi -> tập gram (mã / tên lặp lại ở nhiều Key)
+        self._names = {} # "orders" / "exports" -> {(Key, Item): tên hàng đầu tiên}
+        keys = {r["Key"] for r in res_tab1 if r["Tag"] == "tim"} # chỉ Key có dòng lệch mới cần chỉ mục
+        for r in res_tab1:
+            if not r["SL_Dat"] > 0: continue
+            key, item = r["Key"], r["Item"]
+            self.ordered_in[item] += 1
+            if key not in keys: continue
+            cg, ng = self.grams(item), self.name_grams(self.name_of(key, item, "orders"))
+            ci = len(self.catalog)
+            self.catalog.append((item, len(cg), len(ng), r["Tag"] == "do"))
+            idx = self.index.get(key)
+            if idx is None: idx = self.index[key] = ({}, {})
+            for post, grams in zip(idx, (cg, ng)):
+                for g in grams:
+                    if g in post: post[g].append(ci)
+                    else: post[g] = [ci]
+
+    def grams(self, text):
+        gs = self._grams.get(text)
+        if gs is None:
+            t = f" {text} " # đệm 2 đầu: mã ngắn vẫn có gram, đầu/cuối mã được tính riêng
+            gs = self._grams[text] = frozenset(t[j:j + self.GRAM] for j in range(len(t) - self.GRAM + 1))
+        return gs
+
+    def name_grams(self, name):
+        name = "" if name is None or name != name else str(name) # None / NaN
+        return self.grams(unicodedata.normalize("NFC", " ".join(name.upper().split()))) if name.strip() else frozenset()
+
+    def name_of(self, key, item, side):
+        names = self._names.get(side)
+        if names is None: # tính 1 lần cho mọi nhóm
+            if isinstance(self.detail_map, DetailIndex):
+                names = self.detail_map.first_text(side, "Name")
+            else:
+                names = {k: next((l["Name"] for l in d[side] if isinstance(l.get("Name"), str) and l["Name"].strip()), "")
+                         for k, d in self.detail_map.items()}
+            self._names[side] = names
+        return names.get((key, item), "")
+
+    def suggest(self, key, item, name="", top=3, min_score=0.3):
+        """Các mã đặt cùng Key giống item nhất: [(Item đặt, điểm)] giảm dần."""
+        cg, ng = self.grams(item), self.name_grams(name)
+        hits = {}
+        for side, (post, grams) in enumerate(zip(self.index.get(key, ({}, {})), (cg, ng))):
+            for g in grams:
+                for ci in post.get(g, ()):
+                    h = hits.setdefault(ci, [0, 0])
+                    h[side] += 1
+        out = []
+        for ci, (hc, hn) in hits.items():
+            cand, n_c, n_n, short = self.catalog[ci]
+            if cand == item: continue
+            code = 2 * hc / (len(cg) + n_c)
+            if ng and n_n:
+                score = self.W_CODE * code + self.W_NAME * 2 * hn / (len(ng) + n_n)
+            else:
+                score = code
+            if short: score = min(1.0, score + self.BONUS_SHORT)
+            if score >= min_score: out.append((cand, score))
+        out.sort(key=lambda t: (-t[1], t[0]))
+        return out[:top]
+
+    def suggest_all(self, top=3, min_score=0.3):
+        """Gợi ý cho mọi dòng Tag "tim" -> list of dict, mỗi gợi ý 1 dòng (Rank 0 = tốt nhất).
+        Các mã xếp theo điểm gợi ý tốt nhất giảm dần, gợi ý phụ nằm ngay dưới gợi ý chính."""
+        groups = []
+        for r in self.tab1:
+            if r["Tag"] != "tim": continue
+            key, item = r["Key"], r["Item"]
+            name = self.name_of(key, item, "exports")
+            found = self.suggest(key, item, name, top, min_score)
+            if found: groups.append([])
+            for rank, (cand, score) in enumerate(found):
+                groups[-1].append({
+                    "Key": key, "Item": item, "Name": name, "SL_Xuat": r["SL_Xuat"],
+                    "Suggest": cand, "SuggestName": self.name_of(key, cand, "orders"),
+                    "Score": round(score, 3), "Rank": rank,
+                    "OrderedElsewhere": self.ordered_in[item], # mã xuất này vẫn là mã đặt hợp lệ ở Key khác
+                })
+        groups.sort(key=lambda g: -g[0]["Score"]) # sắp xếp ổn định: cùng điểm giữ thứ tự Tab 1
+        return [d for g in groups for d in g]
+
+    @staticmethod
+    def accept(alias_map, item, target):
+        """Ghi alias item -> target vào alias_map (tại chỗ); các mã gốc đang trỏ tới item cũng chuyển sang target."""
+        for raw, mapped in list(alias_map.items()):
+            if mapped == item: alias_map[raw] = target
+        alias_map[item] = target
+
+class SortOrders:
+    """Các thứ tự sắp xếp của 1 tab: thứ tự mặc định (theo nhóm trạng thái) và hoán vị theo từng cột.
+    Mỗi hoán vị chỉ tính 1 lần (sắp xếp ổn định) rồi giữ lại cho tới lần phân tích sau."""
+    def __init__(self, records, default):
+        self.records = records
+        self.default = default
+        self.cache = {}
+
+    def get(self, field=None, descending=False):
+        if field is None: return self.default
+        if (field, descending) not in self.cache:
+            vals = pd.Series(field_values(self.records, field), dtype=object)
+            try:
+                codes, _ = pd.factorize(vals, sort=True)
+            except TypeError: # lẫn kiểu dữ liệu -> so sánh dạng chuỗi
+                codes, _ = pd.factorize(vals.astype(str), sort=True)
+            if descending: # ô trống (mã -1) luôn ở cuối
+                order = np.argsort(-codes, kind="stable")
+            else:
+                order = np.argsort(np.where(codes < 0, codes.max(initial=0) + 1, codes), kind="stable")
+            self.cache[(field, descending)] = order
+        return self.cache[(field, descending)]
+
+# sqlite3 không nhận kiểu NumPy; NaN được SQLite lưu thành NULL (đọc ra đổi lại NaN)
+for _t in (np.float64, np.float32, np.int64, np.int32, np.bool_):
+    sqlite3.register_adapter(_t, lambda v: v.item())
+
+class ResultStore:
+    """Lưu kết quả các lần chạy (Tab 1/2/3 + chi tiết popup) vào SQLite để mở lại không cần đọc file.
+    Mỗi bảng có run_id + rid (vị trí dòng trong res_tab*); prio/is_err giống thứ tự mặc định và "Chỉ hiện lỗi" trên giao diện,
+    search = chuỗi tìm kiếm ghép sẵn (như SearchIndex) để lọc bằng instr()."""
+    TABS = {
+        1: ("tab1", ["Key", "Item", "Unit", "SL_Dat", "SL_Xuat", "Lech", "Status", "Tag", "IsMerged"], ["Key", "Item", "Status"]),
+        2: ("tab2", ["SoPX", "Key", "Item", "Name", "SL_Xuat", "SL_Tui", "Unit", "SL_Dong", "Total_Dat", "Total_Xuat", "Lech_Tong", "Status", "Tag"],
+            ["Key", "Item", "SoPX", "Status"]),
+        3: ("tab3", ["Loại", "Lỗi", "Mẫu Key", "Số dòng", "Dòng", "Dữ liệu"], ["Loại", "Lỗi", "Mẫu Key", "Dòng", "Dữ liệu"]),
+    }
+    DETAIL = {"orders": ["SoDH", "Name", "SL", "Note"], "exports": ["SoPX", "Name", "SL_Xuat", "SL_Tui"]}
+    INDEXES = [
+        ("tab1", ["Key", "Item"]), ("tab1", ["Tag"]), ("tab1", ["Status"]), ("tab1", ["prio", "rid"]),
+        ("tab2", ["Key", "Item"]), ("tab2", ["SoPX"]), ("tab2", ["Tag"]), ("tab2", ["Status"]), ("tab2", ["prio", "rid"]),
+        ("detail_orders", ["Key", "Item", "seq"]), ("detail_exports", ["Key", "Item", "seq"]),
+    ]
+
+    lock = threading.Lock() # ghi tuần tự (lưu lần chạy mới / lưu lại sau khi đổi trạng thái)
+
+    def __init__(self, path=RESULT_DB):
+        self.path = path
+        self._ready = False
+
+    def _connect(self):
+        con = sqlite3.connect(self.path, timeout=30)
+        con.execute("PRAGMA journal_mode=WAL") # giao diện đọc trang trong lúc luồng nền đang ghi
+        con.execute("PRAGMA synchronous=NORMAL")
+        if not self._ready:
+            self._create(con)
+            self._ready = True
+        return con
+
+    @staticmethod
+    def _q(name):
+        return '"' + name.replace('"', '""') + '"'
+
+    def _create(self, con):
+        q = self._q
+        con.execute("CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY AUTOINCREMENT, created TEXT, dh TEXT, px TEXT, "
+                    "engine TEXT, n1 INTEGER, n2 INTEGER, n3 INTEGER, errors INTEGER)")
+        for table, cols, _ in self.TABS.values():
+            con.execute(f"CREATE TABLE IF NOT EXISTS {table} (run_id INTEGER, rid INTEGER, prio INTEGER, is_err INTEGER, search TEXT, "
+                        + ", ".join(q(c) for c in cols) + ", PRIMARY KEY (run_id, rid))")
+        for table, cols, _ in self.TABS.values(): # results.db của bản cũ: thêm cột mới (dòng cũ để NULL)
+            have = {r[1] for r in con.execute(f"PRAGMA table_info({table})")}
+            for c in cols:
+                if c not in have: con.execute(f"ALTER TABLE {table} ADD COLUMN {q(c)}")
+        for side, cols in self.DETAIL.items():
+            con.execute(f"CREATE TABLE IF NOT EXISTS detail_{side} (run_id INTEGER, Key TEXT, Item TEXT, seq INTEGER, "
+                        + ", ".join(q(c) for c in cols) + ")")
+        for table, cols in self.INDEXES:
+            con.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_{'_'.join(c.lower() for c in cols)} ON {table} (run_id, "
+                        + ", ".join(q(c) for c in cols) + ")")
+        con.commit()
+
+    @staticmethod
+    def _prio(tab, tag):
+        # Giống MainApp.build_search_index: Tab 1 lỗi -> gộp -> đủ; Tab 2 lỗi trước
+        if tab == 1: return 0 if tag in ("do", "vang", "tim") else 1 if tag == "gop" else 2
+        if tab == 2: return 0 if tag != "ok" else 1
+        return 0
+
+    def _rows(self, run_id, tab, records):
+        _, cols, fields = self.TABS[tab]
+        text = (lambda r: " ".join(str(r[f]) for f in fields).upper()) if fields else (lambda r: str(r).upper())
+        for rid, r in enumerate(records):
+            prio = self._prio(tab, r.get("Tag"))
+            is_err = prio != 2 if tab == 1 else prio == 0
+            yield (run_id, rid, prio, int(is_err), text(r)) + tuple(map(r.get, cols))
+
+    @staticmethod
+    def _detail_rows(run_id, detail_map, side, cols):
+        # seq: thứ tự dòng trong nhóm (detail_lines trả các dòng của 1 nhóm liền nhau)
+        last, seq = None, 0
+        for r in detail_lines(detail_map, side):
+            k = (r["Key"], r["Item"])
+            seq = seq + 1 if k == last else 0
+            last = k
+            yield (run_id, k[0], k[1], seq) + tuple(map(r.get, cols))
+
+    def save_run(self, processor, run_id=None):
+        """Ghi kết quả hiện tại của processor; run_id có sẵn thì ghi đè lần chạy đó (sau khi đổi trạng thái / alias)."""
+        p = processor
+        t1, t2, t3, dm = p.res_tab1, p.res_tab2, p.res_tab3, p.detail_map
+        paths = p.cfg.data["paths"]
+        errors = sum(1 for r in t1 if r["Tag"] in ("do", "vang", "tim"))
+        with self.lock:
+            con = self._connect()
+            try:
+                with con:
+                    info = (datetime.now().isoformat(timespec="seconds"), str(paths["dh"]), str(paths["px"]),
+                            p.stats.engine, len(t1), len(t2), len(t3), errors)
+                    if run_id is None:
+                        run_id = con.execute("INSERT INTO runs (created, dh, px, engine, n1, n2, n3, errors) VALUES (?,?,?,?,?,?,?,?)", info).lastrowid
+                    else:
+                        con.execute("UPDATE runs SET n1=?, n2=?, n3=?, errors=? WHERE id=?", info[4:] + (run_id,))
+                        self._delete_rows(con, [run_id])
+                    for tab, records in ((1, t1), (2, t2), (3, t3)):
+                        table, cols, _ = self.TABS[tab]
+                        marks = ",".join("?" * (len(cols) + 5))
+                        con.executemany(f"INSERT INTO {table} VALUES ({marks})", self._rows(run_id, tab, records))
+                    for side, cols in self.DETAIL.items():
+                        marks = ",".join("?" * (len(cols) + 4))
+                        con.executemany(f"INSERT INTO detail_{side} VALUES ({marks})", self._detail_rows(run_id, dm, side, cols))
+            finally:
+                con.close()
+        return run_id
+
+    def _delete_rows(self, con, run_ids):
+        marks = ",".join("?" * len(run_ids))
+        for table in [t for t, _, _ in self.TABS.values()] + [f"detail_{s}" for s in self.DETAIL]:
+            con.execute(f"DELETE FROM {table} WHERE run_id IN ({marks})", run_ids)
+
+    def prune(self, keep=30):
+        """Chỉ giữ keep lần chạy gần nhất."""
+        with self.lock:
+            con = self._connect()
+            try:
+                with con:
+                    old = [r[0] for r in con.execute("SELECT id FROM runs ORDER BY id DESC LIMIT -1 OFFSET ?", (keep,))]
+                    if old:
+                        self._delete_rows(con, old)
+                        con.execute(f"DELETE FROM runs WHERE id IN ({','.join('?' * len(old))})", old)
+            finally:
+                con.close()
+
+    def runs(self, limit=50):
+        """Các lần chạy đã lưu, mới nhất trước: list dict (id, created, dh, px, engine, n1, n2, n3, errors)."""
+        con = self._connect()
+        try:
+            cur = con.execute("SELECT * FROM runs ORDER BY id DESC LIMIT ?", (limit,))
+            names = [d[0] for d in cur.description]
+            return [dict(zip(names, r)) for r in cur]
+        finally:
+            con.close()
+
+    def run(self, run_id):
+        """Thông tin 1 lần chạy (như runs()); None nếu không có / đã bị xóa bớt."""
+        con = self._connect()
+        try:
+            cur = con.execute("SELECT * FROM runs WHERE id = ?", (run_id,))
+            row = cur.fetchone()
+            return dict(zip([d[0] for d in cur.description], row)) if row else None
+        finally:
+            con.close()
+
+    def _where(self, run_id, keyword, errors_only):
+        sql, args = "run_id = ?", [run_id]
+        if keyword:
+            sql += " AND instr(search, ?) > 0"; args.append(keyword)
+        if errors_only:
+            sql += " AND is_err = 1"
+        return sql, args
+
+    def count(self, run_id, tab, keyword="", errors_only=False):
+        table = self.TABS[tab][0]
+        where, args = self._where(run_id, keyword, errors_only)
+        con = self._connect()
+        try:
+            return con.execute(f"SELECT COUNT(*) FROM {table} WHERE {where}", args).fetchone()[0]
+        finally:
+            con.close()
+
+    def page(self, run_id, tab, offset, limit, keyword="", errors_only=False, order=(None, False)):
+        """1 trang bản ghi (dict như res_tab*) theo bộ lọc; order = (trường, giảm dần?) như SortOrders, None = thứ tự mặc định."""
+        table, cols, _ = self.TABS[tab]
+        where, args = self._where(run_id, keyword, errors_only)
+        field, desc = order
+        if field is None:
+            order_sql = "prio, rid"
+        else: # ô trống luôn ở cuối, bằng nhau thì giữ thứ tự dòng (như sắp xếp ổn định)
+            f = self._q(field)
+            order_sql = f"({f} IS NULL), {f}{' DESC' if desc else ''}, rid"
+        con = self._connect()
+        try:
+            cur = con.execute(f"SELECT {', '.join(self._q(c) for c in cols)} FROM {table} WHERE {where} "
+                              f"ORDER BY {order_sql} LIMIT ? OFFSET ?", args + [limit, offset])
+            return [self._record(cols, r) for r in cur]
+        finally:
+            con.close()
+
+    @staticmethod
+    def _record(cols, row):
+        rec = {c: (np.nan if v is None else v) for c, v in zip(cols, row)}
+        if "IsMerged" in rec: rec["IsMerged"] = bool(rec["IsMerged"])
+        return rec
+
+    def detail(self, run_id, key, item):
+        """Chi tiết 2 bên của 1 (Key, Item) như detail_map[(key, item)]; None nếu không có."""
+        con = self._connect()
+        try:
+            out = {}
+            for side, cols in self.DETAIL.items():
+                cur = con.execute(f"SELECT {', '.join(self._q(c) for c in cols)} FROM detail_{side} "
+                                  "WHERE run_id = ? AND Key = ? AND Item = ? ORDER BY seq", (run_id, key, item))
+                out[side] = [self._record(cols, r) for r in cur]
+        finally:
+            con.close()
+        return out if out["orders"] or out["exports"] else None
+
+    def detail_count(self, run_id, key, item):
+        """Số dòng chi tiết mỗi bên của 1 (Key, Item): {"orders": n, "exports": n}."""
+        con = self._connect()
+        try:
+            return {side: con.execute(f"SELECT COUNT(*) FROM detail_{side} WHERE run_id = ? AND Key = ? AND Item = ?",
+                                      (run_id, key, item)).fetchone()[0] for side in self.DETAIL}
+        finally:
+            con.close()
+
+    def detail_page(self, run_id, key, item, side, offset, limit):
+        """Dòng chi tiết thứ offset .. offset+limit-1 của 1 bên; seq liên tục từ 0 trong nhóm nên đi thẳng theo chỉ mục."""
+        cols = self.DETAIL[side]
+        con = self._connect()
+        try:
+            cur = con.execute(f"SELECT {', '.join(self._q(c) for c in cols)} FROM detail_{side} "
+                              "WHERE run_id = ? AND Key = ? AND Item = ? AND seq >= ? AND seq < ? ORDER BY seq",
+                              (run_id, key, item, offset, offset + limit))
+            return [self._record(cols, r) for r in cur]
+        finally:
+            con.close()
+
+    def iter_details(self, run_id, side):
+        """Toàn bộ dòng chi tiết 1 bên của lần chạy (kèm Key, Item), theo Key, Item, thứ tự dòng - đọc dần, không giữ hết trong bộ nhớ."""
+        cols = ["Key", "Item"] + self.DETAIL[side]
+        con = self._connect()
+        try:
+            cur = con.execute(f"SELECT {', '.join(self._q(c) for c in cols)} FROM detail_{side} "
+                              "WHERE run_id = ? ORDER BY Key, Item, seq", (run_id,))
+            for r in cur: yield self._record(cols, r)
+        finally:
+            con.close()
+
+    def items(self, run_id):
+        """Các mã hàng có trong lần chạy (cho Quản lý hàng túi)."""
+        con = self._connect()
+        try:
+            return {r[0] for r in con.execute("SELECT DISTINCT Item FROM tab1 WHERE run_id = ?", (run_id,))}
+        finally:
+            con.close()
+
+# =============================================================================
+# XUẤT EXCEL (ghi dần, chạy nền)
+# =============================================================================
+# (khóa, tên sheet, [(trường, tiêu đề cột)]) - tên sheet Tab 1/2/3 giống batch.py
+EXPORT_SHEETS = (
+    ("tab1", "TongHop", [("Key", "Key"), ("Item", "Mã Hàng"), ("Unit", "Đơn Vị"), ("SL_Dat", "SL Đặt"),
+                         ("SL_Xuat", "SL Xuất"), ("Lech", "LỆCH"), ("Status", "TRẠNG THÁI")]),
+    ("tab2", "ChiTiet", [("SoPX", "Số PX"), ("Key", "Key"), ("Item", "Mã Hàng"), ("Name", "Tên Hàng"), ("Unit", "Đơn Vị"),
+                         ("SL_Dong", "SL Dòng"), ("Total_Dat", "Tổng Đặt"), ("Total_Xuat", "Tổng Xuất"),
+                         ("Lech_Tong", "LỆCH TỔNG"), ("Status", "TRẠNG THÁI")]),
+    ("tab3", "NgoaiLe", [("Loại", "Loại"), ("Lỗi", "Lỗi"), ("Mẫu Key", "Mẫu Key"), ("Số dòng", "Số dòng"), ("Dòng", "Dòng"), ("Dữ liệu", "Dữ liệu")]),
+    ("orders", "DonHang_TheoMa", [("Key", "Key"), ("Item", "Mã Hàng"), ("SoDH", "Số ĐH"), ("Name", "Tên Hàng"),
+                                  ("SL", "SL"), ("Note", "Ghi chú")]),
+    ("exports", "PhieuXuat_TheoMa", [("Key", "Key"), ("Item", "Mã Hàng"), ("SoPX", "Số PX"), ("Name", "Tên Hàng"),
+                                     ("SL_Xuat", "SL Xuất"), ("SL_Tui", "SL Túi")]),
+)
+# Màu theo Tag như trên lưới: (nền, chữ)
+EXPORT_COLORS = {"do": ("FFCDD2", None), "vang": ("FFF9C4", None), "tim": ("E1BEE7", None), "gop": ("BBDEFB", "0D47A1")}
+EXPORT_REPORT_EVERY = 5000 # số dòng giữa 2 lần báo tiến độ / kiểm tra hủy
+EXPORT_MAX_ROWS = 1048575 # giới hạn dòng của 1 sheet Excel (trừ dòng tiêu đề)
+
+_XML_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+_XML_ILLEGAL = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]") # ký tự điều khiển XML không cho phép
+
+class XlsxStreamWriter:
+    """Ghi .xlsx tối giản, ghi dần từng dòng thẳng vào file zip (bộ nhớ không tăng theo số dòng, chỉ thư viện chuẩn).
+    openpyxl write_only cũng ghi dần nhưng chậm ~30µs/ô khi không có lxml: 500k dòng mất vài phút.
+    Chuỗi ghi dạng inlineStr (không cần bảng sharedStrings giữ trong bộ nhớ).
+    styles: [(nền, màu chữ, đậm)] khai báo trước; append(style=...) nhận 0 = mặc định, 1 = tiêu đề đậm, 2 + i = styles[i]."""
+    def __init__(self, path, styles=()):
+        self.zf = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, compresslevel=1, allowZip64=True)
+        self.sheets = []
+        self.styles = list(styles)
+        self.f = None
+
+    def add_sheet(self, name, header=None, freeze_header=True):
+        self._close_sheet()
+        self.sheets.append(name)
+        raw = self.zf.open(f"xl/worksheets/sheet{len(self.sheets)}.xml", "w", force_zip64=True)
+        self.f = io.TextIOWrapper(io.BufferedWriter(raw, 1 << 20), encoding="utf-8")
+        self.f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                     '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">')
+        if header is not None and freeze_header:
+            self.f.write('<sheetViews><sheetView workbookViewId="0"><pane ySplit="1" topLeftCell="A2" '
+                         'activePane="bottomLeft" state="frozen"/></sheetView></sheetViews>')
+        self.f.write("<sheetData>")
+        self.n = 0
+        if header is not None: self.append(header, style=1)
+
+    def append(self, values, style=0):
+        """values: list giá trị (str / số / bool / None)."""
+        self.n += 1
+        s = f' s="{style}"' if style else ""
+        out = [f'<row r="{self.n}">']
+        for v in values:
+            if v is None or v != v or v in (float("inf"), float("-inf")): # trống / NaN / vô cực
+                out.append(f"<c{s}/>" if s else "<c/>")
+            elif isinstance(v, str):
+                if not v.isprintable(): v = _XML_ILLEGAL.sub("", v)
+                v = v.translate(_XML_ESCAPE)
+                out.append(f'<c{s} t="inlineStr"><is><t xml:space="preserve">{v}</t></is></c>')
+            elif isinstance(v, (bool, np.bool_)):
+                out.append(f'<c{s} t="b"><v>{int(v)}</v></c>')
+            else:
+                out.append(f"<c{s}><v>{v!r}</v></c>" if isinstance(v, float) else f"<c{s}><v>{v}</v></c>")
+        out.append("</row>")
+        self.f.write("".join(out))
+
+    def _close_sheet(self):
+        if self.f is None: return
+        self.f.write("</sheetData></worksheet>")
+        self.f.close()
+        self.f = None
+
+    def close(self):
+        self._close_sheet()
+        n = len(self.sheets)
+        sheets = "".join(f'<sheet name="{name.translate(_XML_ESCAPE)}" sheetId="{i}" r:id="rId{i}"/>'
+                         for i, name in enumerate(self.sheets, 1))
+        self.zf.writestr("[Content_Types].xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+            + "".join(f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+                      'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>' for i in range(1, n + 1))
+            + "</Types>")
+        self.zf.writestr("_rels/.rels",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+            "</Relationships>")
+        self.zf.writestr("xl/workbook.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f"<sheets>{sheets}</sheets></workbook>")
+        self.zf.writestr("xl/_rels/workbook.xml.rels",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            + "".join(f'<Relationship Id="rId{i}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+                      f'Target="worksheets/sheet{i}.xml"/>' for i in range(1, n + 1))
+            + f'<Relationship Id="rId{n + 1}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+            "</Relationships>")
+        self.zf.writestr("xl/styles.xml", self._styles_xml())
+        self.zf.close()
+
+    def _styles_xml(self):
+        # xf 0: mặc định, xf 1: tiêu đề đậm, xf 2..: self.styles theo thứ tự
+        fonts = ['<font><sz val="11"/><name val="Calibri"/></font>', '<font><b/><sz val="11"/><name val="Calibri"/></font>']
+        fills = ['<fill><patternFill patternType="none"/></fill>', '<fill><patternFill patternType="gray125"/></fill>']
+        xfs = ['<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>',
+               '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>']
+        for bg, fg, bold in self.styles:
+            font_id, fill_id = 0, 0
+            if fg or bold:
+                color = f'<color rgb="FF{fg}"/>' if fg else ""
+                fonts.append(f'<font>{"<b/>" if bold else ""}{color}<sz val="11"/><name val="Calibri"/></font>')
+                font_id = len(fonts) - 1
+            if bg:
+                fills.append(f'<fill><patternFill patternType="solid"><fgColor rgb="FF{bg}"/><bgColor indexed="64"/></patternFill></fill>')
+                fill_id = len(fills) - 1
+            xfs.append(f'<xf numFmtId="0" fontId="{font_id}" fillId="{fill_id}" borderId="0" xfId="0" applyFont="1" applyFill="1"/>')
+        return ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                f'<fonts count="{len(fonts)}">{"".join(fonts)}</fonts>'
+                f'<fills count="{len(fills)}">{"".join(fills)}</fills>'
+                '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+                '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+                f'<cellXfs count="{len(xfs)}">{"".join(xfs)}</cellXfs>'
+                '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+                "</styleSheet>")
+
+def export_workbook(path, tab1=(), tab2=(), tab3=(), orders=(), exports=(), job=None):
+    """Ghi kết quả ra 1 file .xlsx, mỗi phần 1 sheet (xem EXPORT_SHEETS); mỗi phần là iterable bản ghi (dict).
+    Ghi dần qua XlsxStreamWriter nên bộ nhớ không tăng theo số dòng; dòng có Tag lỗi / gộp giữ màu như trên lưới.
+    job (AnalysisJob): báo tiến độ ("Xuất <sheet>", số dòng) và hủy giữa chừng (file dở bị xóa).
+    Trả về {tên sheet: số dòng}."""
+    parts = {"tab1": tab1, "tab2": tab2, "tab3": tab3, "orders": orders, "exports": exports}
+    style_of = {tag: i + 2 for i, tag in enumerate(EXPORT_COLORS)}
+    w = XlsxStreamWriter(path, [(bg, fg, False) for bg, fg in EXPORT_COLORS.values()])
+    counts = {}
+    try:
+        for key, sheet, cols in EXPORT_SHEETS:
+            fields = [f for f, _ in cols]
+            header = [title for _, title in cols]
+            w.add_sheet(sheet, header)
+            n = 0
+            for r in parts[key]:
+                if n and n % EXPORT_MAX_ROWS == 0: # quá số dòng 1 sheet của Excel: sang sheet tiếp theo
+                    w.add_sheet(f"{sheet}_{n // EXPORT_MAX_ROWS + 1}", header)
+                vals = [r.get(f) for f in fields]
+                w.append([v.item() if isinstance(v, np.generic) else v for v in vals], style_of.get(r.get("Tag"), 0))
+                n += 1
+                if job and n % EXPORT_REPORT_EVERY == 0: job.report(f"Xuất {sheet}", n)
+            counts[sheet] = n
+            if job: job.report(f"Xuất {sheet}", n)
+        w.close()
+    except BaseException:
+        try:
+            w.zf.close()
+        except Exception: pass
+        try:
+            os.remove(path)
+        except OSError: pass
+        raise
+    return counts
+
+def processor_details(records, detail_map):
+    """Chi tiết Đơn Hàng / Phiếu Xuất (kèm Key, Item) của các nhóm trong records (dòng Tab 1), theo thứ tự records.
+    -> (orders, exports) dạng generator cho export_workbook."""
+    keys = lambda: [(r["Key"], r["Item"]) for r in records]
+    return detail_lines(detail_map, "orders", keys()), detail_lines(detail_map, "exports", keys())
+
+def stored_details(store, run_id, records, total):
+    """Như processor_details cho kết quả đã lưu: đọc dần bảng chi tiết (theo Key, Item), chỉ giữ nhóm có trong records.
+    records đủ total dòng (không lọc) thì lấy hết, không cần dựng tập khóa."""
+    keys = []
+    def side(name):
+        if not keys: keys.append(None if len(records) == total else {(r["Key"], r["Item"]) for r in records})
+        for d in store.iter_details(run_id, name):
+            if keys[0] is None or (d["Key"], d["Item"]) in keys[0]: yield d
+    return side("orders"), side("exports")
+
+class ExportJob(AnalysisJob):
+    """Xuất Excel chạy nền: cùng cơ chế hủy / báo tiến độ với AnalysisJob."""
+    def __init__(self, path, parts, on_progress=None):
+        super().__init__(None, on_progress)
+        self.path, self.parts = path, parts
+
+    def run(self):
+        try:
+            self.result = export_workbook(self.path, job=self, **self.parts)
+        except AnalysisCancelled:
+            self.result = None
+        return self.result
+
+# =============================================================================
+# DANH MỤC ALIAS / HÀNG TÚI <-> EXCEL
+# =============================================================================
+CATALOG_SHEETS = {"alias": ("Alias", ["Mã gốc", "Mã chuẩn"]), "bag": ("HangTui", ["Mã hàng"])}
+
+def export_catalog(config_mgr, path):
+    """Ghi alias_map + bag_items ra 1 file Excel (2 sheet, sắp xếp theo mã)."""
+    alias, bags = config_mgr.data["alias_map"], config_mgr.data["bag_items"]
+    (a_sheet, a_cols), (b_sheet, b_cols) = CATALOG_SHEETS["alias"], CATALOG_SHEETS["bag"]
+    with pd.ExcelWriter(path) as writer:
+        pd.DataFrame(sorted(alias.items()), columns=a_cols).to_excel(writer, sheet_name=a_sheet, index=False)
+        pd.DataFrame(sorted(bags), columns=b_cols).to_excel(writer, sheet_name=b_sheet, index=False)
+    return len(alias), len(bags)
+
+def read_catalog(config_mgr, path):
+    """Đọc danh mục từ Excel (bố cục như export_catalog) -> (alias dict | None, mã túi set | None); thiếu sheet nào thì None.
+    Mã được chuẩn hóa như khi đối chiếu (hoa, bỏ khoảng trắng thừa, NFC); trùng mã gốc thì dòng dưới thắng."""
+    sheets = pd.read_excel(path, sheet_name=None, dtype=str)
+    p = DataProcessor(config_mgr)
+    (a_sheet, (c_raw, c_target)), (b_sheet, (c_item,)) = CATALOG_SHEETS["alias"], CATALOG_SHEETS["bag"]
+    alias = bags = None
+    df = sheets.get(a_sheet)
+    if df is not None:
+        if c_raw not in df.columns or c_target not in df.columns:
+            raise ValueError(f"Sheet {a_sheet} cần 2 cột: {c_raw}, {c_target}")
+        raw, target = p.normalize_col(df[c_raw]), p.normalize_col(df[c_target])
+        keep = ((raw != "") & (raw != target)).to_numpy()
+        alias = dict(zip(raw[keep], target[keep]))
+    df = sheets.get(b_sheet)
+    if df is not None:
+        if c_item not in df.columns: raise ValueError(f"Sheet {b_sheet} cần cột: {c_item}")
+        bags = set(p.normalize_col(df[c_item])) - {""}
+    if alias is None and bags is None:
+        raise ValueError(f"Không có sheet {a_sheet} / {b_sheet}")
+    return alias, bags
+
+def merge_catalog(config_mgr, alias, bags, replace=False):
+    """Gộp kết quả read_catalog vào cấu hình rồi save(). replace=True: thay hẳn phần có trong file.
+    Trả về (alias_map cũ, các mã túi thay đổi, số alias đổi) - đưa vào apply_alias_change / apply_status_change."""
+    cur_alias, cur_bags = config_mgr.data["alias_map"], config_mgr.data["bag_items"]
+    old_alias, old_bags = dict(cur_alias), set(cur_bags)
+    if alias is not None:
+        if replace: cur_alias.clear()
+        cur_alias.update(alias)
+    if bags is not None:
+        if replace: cur_bags.clear()
+        cur_bags.update(bags)
+    config_mgr.save()
+    n_alias = sum(1 for k in cur_alias.keys() | old_alias.keys() if cur_alias.get(k) != old_alias.get(k))
+    return old_alias, set(cur_bags) ^ old_bags, n_alias
+
+def import_catalog(config_mgr, path, replace=False):
+    return merge_catalog(config_mgr, *read_catalog(config_mgr, path), replace=replace)
@@ -0,0 +1,373 @@
+"""Dịch vụ đối soát chạy nền trên máy (HTTP/JSON) cho tích hợp ERP - không cần mở giao diện.
+
+    python service.py --port 8765 --workers 2
+
+Các process con được khởi động sẵn (đã nạp pandas / openpyxl) nên mỗi yêu cầu không phải trả giá nạp thư viện;
+kết quả lưu vào results.db (ResultStore) và được nhớ theo (băm nội dung file, băm cấu hình, engine):
+gọi lại / gọi đồng thời cùng bộ file + cấu hình thì trả về ngay lần chạy đã có (hoặc đang chạy).
+
+    GET  /health
+    POST /runs                      {"dh": "...", "px": "...", "engine": "vector", "force": false}
+    GET  /runs                      các lần chạy đã lưu (mới nhất trước)
+    GET  /runs/<id>
+    GET  /runs/<id>/tab/<1|2|3>     ?offset=0&limit=500&q=&errors=1&sort=Key&desc=1
+    GET  /runs/<id>/detail          ?key=ST01&item=A01
+    GET  /alias                     POST /alias {"set": {"mã gốc": "mã chuẩn"}, "remove": ["mã gốc"]}
+    GET  /bags                      POST /bags  {"add": ["mã"], "remove": ["mã"]}
+
+dh / px nhận giống ô nhập trên giao diện: 1 file, 1 thư mục hoặc nhiều file ngăn bởi ';'.
+Chỉ nghe trên 127.0.0.1 (mặc định). Lỗi trả về {"error": "..."} với mã HTTP 4xx / 5xx.
+"""
+import argparse
+import copy
+import hashlib
+import json
+import math
+import os
+import signal
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from check_config import CONFIG_FILE, RESULT_DB, ConfigManager
+
+SETTINGS_KEYS = ("col_map", "read", "alias_map", "bag_items", "tolerance") # gửi kèm mỗi job, cũng là phần được băm
+MAX_PAGE = 5000
+
+# -----------------------------------------------------------------------------
+# PROCESS CON
+# -----------------------------------------------------------------------------
+def _warm():
+    # initializer của pool: nạp sẵn thư viện nặng 1 lần cho mỗi process
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C chỉ để process chính dừng pool
+    import check_core # noqa: F401
+    for mod in ("openpyxl", "pyarrow.feather"):
+        try:
+            __import__(mod)
+        except ImportError:
+            pass
+
+def _ping():
+    return os.getpid()
+
+def run_job(config_path, settings, dh, px, engine, db):
+    """Chạy trong process con: run_analysis với cấu hình chụp lúc gửi + ghi kết quả vào db. Lỗi trả về trong dict."""
+    from check_core import DataProcessor, ResultStore
+    t0 = time.perf_counter()
+    res = {"ok": False, "msg": ""}
+    try:
+        cfg = ConfigManager(config_path)
+        cfg.data.update(settings)
+        cfg.data["paths"] = {"dh": dh, "px": px}
+        cfg.data["read_workers"] = 1 # đã song song theo process, không mở thêm pool đọc file bên trong
+        p = DataProcessor(cfg)
+        ok, msg = p.run_analysis(engine)
+        res.update(ok=ok, msg=msg)
+        if ok:
+            res["run_id"] = ResultStore(db).save_run(p)
+            res.update(tab1=len(p.res_tab1), tab2=len(p.res_tab2), tab3=len(p.res_tab3),
+                       errors=sum(1 for r in p.res_tab1 if r["Tag"] in ("do", "vang", "tim")))
+    except Exception as e:
+        res["msg"] = f"{type(e).__name__}: {e}"
+    res["sec"] = round(time.perf_counter() - t0, 3)
+    return res
+
+# -----------------------------------------------------------------------------
+# DỊCH VỤ
+# -----------------------------------------------------------------------------
+class ServiceError(Exception):
+    def __init__(self, msg, status=400):
+        super().__init__(msg)
+        self.status = status
+
+class ReconcileService:
+    """Pool process con + bộ nhớ kết quả theo (băm file, băm cấu hình, engine). Dùng được không qua HTTP."""
+    def __init__(self, config_path=CONFIG_FILE, db=RESULT_DB, workers=2, cache_runs=20):
+        from check_core import ResultStore # luồng chính cũng cần pandas để đọc trang kết quả
+        self.config_path = config_path
+        self.cfg = ConfigManager(config_path)
+        self._cfg_sig = self._config_signature()
+        self.db = db
+        self.store = ResultStore(db)
+        self.cache_runs = cache_runs
+        self.keep_runs = max(cache_runs, self.cfg.data["store"].get("keep_runs", 30))
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=_warm)
+        self.workers = [self.pool.submit(_ping) for _ in range(workers)] # khởi động process ngay, không đợi yêu cầu đầu
+        self.lock = threading.Lock()
+        self.cfg_lock = threading.Lock()
+        self.results = OrderedDict() # khóa -> kết quả job (LRU)
+        self.running = {} # khóa -> Future đang chạy (yêu cầu trùng chờ chung)
+        self._hashes = {} # (đường dẫn, size, mtime) -> sha256 nội dung
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+    # --- khóa bộ nhớ kết quả ---
+    def file_hash(self, path):
+        from check_core import ParseCache
+        st = os.stat(path)
+        sig = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+        h = self._hashes.get(sig)
+        if h is None:
+            h = self._hashes[sig] = ParseCache.file_hash(path)
+        return h
+
+    def input_hash(self, dh, px):
+        from check_core import resolve_inputs
+        h = hashlib.sha256()
+        for side, spec in (("dh", dh), ("px", px)):
+            files = resolve_inputs(spec)
+            if not files: raise ServiceError(f"Không thấy file {side}: {spec}")
+            h.update(side.encode())
+            for path in files:
+                if not os.path.isfile(path): raise ServiceError(f"Không thấy file: {path}")
+                h.update(self.file_hash(path).encode())
+        return h.hexdigest()
+
+    # --- cấu hình ---
+    def _config_signature(self):
+        # size + mtime của file cấu hình và catalog (kể cả -wal: Catalog ghi WAL, file chính có thể chưa đổi)
+        cat = self.cfg.catalog.path
+        sig = []
+        for path in (self.config_path, cat, cat + "-wal"):
+            try:
+                st = os.stat(path)
+                sig.append((st.st_size, st.st_mtime_ns))
+            except OSError:
+                sig.append(None)
+        return sig
+
+    def _reload(self):
+        # Giao diện / process khác có thể đã lưu cấu hình hoặc danh mục: đọc lại khi file đổi. Gọi khi giữ cfg_lock.
+        sig = self._config_signature()
+        if sig != self._cfg_sig:
+            self.cfg = ConfigManager(self.config_path)
+            self._cfg_sig = self._config_signature()
+
+    def settings(self):
+        """Bản sao SETTINGS_KEYS + engine mặc định, theo cấu hình / danh mục mới nhất trên đĩa."""
+        with self.cfg_lock:
+            self._reload()
+            return copy.deepcopy({k: self.cfg.data[k] for k in SETTINGS_KEYS + ("engine",)})
+
+    def alias(self):
+        with self.cfg_lock:
+            self._reload()
+            return dict(self.cfg.data["alias_map"])
+
+    def bags(self):
+        with self.cfg_lock:
+            self._reload()
+            return sorted(self.cfg.data["bag_items"])
+
+    def _save_catalog(self):
+        # Chỉ ghi danh mục (không ghi lại file JSON từ bản cấu hình đang giữ); ghi ngay để job gửi sau thấy.
+        # File JSON cũ còn danh mục thì phải lưu cả file (vừa đọc lại nên không đè thiết lập mới hơn).
+        if self.cfg.migrate:
+            self.cfg.save()
+        else:
+            self.cfg.catalog.save(self.cfg.data["alias_map"], self.cfg.data["bag_items"])
+        if not self.cfg.catalog.flush(): raise ServiceError(self.cfg.catalog.error, 500)
+
+    # --- chạy ---
+    def run(self, dh, px, engine=None, force=False):
+        from check_core import DataProcessor, settings_signature
+        settings = self.settings()
+        default_engine = settings.pop("engine")
+        engine = engine or default_engine
+        if engine not in DataProcessor.ENGINES: raise ServiceError(f"Engine không hợp lệ: {engine}")
+        key = (self.input_hash(dh, px), hashlib.sha256(settings_signature(settings).encode()).hexdigest(), engine)
+        with self.lock:
+            hit = None if force else self.results.get(key)
+            if hit is not None and self.store.run(hit["run_id"]) is None: # đã bị xóa bớt khỏi results.db
+                self.results.pop(key); hit = None
+            if hit is not None:
+                self.results.move_to_end(key)
+                return dict(hit, cached=True)
+            fut = self.running.get(key)
+            owner = fut is None
+            if owner:
+                fut = self.running[key] = self.pool.submit(run_job, self.config_path, settings, dh, px, engine, self.db)
+        try:
+            res = fut.result()
+        except Exception as e: # process con bị dừng giữa chừng
+            res = {"ok": False, "msg": f"{type(e).__name__}: {e}"}
+        if owner:
+            with self.lock: # nhớ kết quả trước khi bỏ khỏi running: yêu cầu đến sau luôn thấy 1 trong 2
+                if res["ok"]:
+                    self.results[key] = res
+                    while len(self.results) > self.cache_runs: self.results.popitem(last=False)
+                self.running.pop(key, None)
+            if res["ok"]: self.store.prune(self.keep_runs)
+        return dict(res, cached=not owner)
+
+    # --- đọc kết quả ---
+    def run_info(self, run_id):
+        info = self.store.run(run_id)
+        if info is None: raise ServiceError(f"Không có lần chạy {run_id}", 404)
+        return info
+
+    def page(self, run_id, tab, offset=0, limit=500, keyword="", errors_only=False, sort=None, desc=False):
+        from check_core import ResultStore
+        self.run_info(run_id)
+        if tab not in ResultStore.TABS: raise ServiceError(f"Tab không hợp lệ: {tab}")
+        if sort is not None and sort not in ResultStore.TABS[tab][1]: raise ServiceError(f"Không sắp xếp được theo: {sort}")
+        keyword = normalize(keyword)
+        errors_only = errors_only and tab != 3
+        rows = self.store.page(run_id, tab, max(0, offset), max(0, min(limit, MAX_PAGE)), keyword, errors_only, (sort, desc))
+        return {"total": self.store.count(run_id, tab, keyword, errors_only), "offset": offset, "rows": rows}
+
+    def detail(self, run_id, key, item):
+        self.run_info(run_id)
+        d = self.store.detail(run_id, normalize(key), normalize(item))
+        if d is None: raise ServiceError(f"Không có chi tiết cho ({key}, {item})", 404)
+        return d
+
+    # --- danh mục ---
+    def update_alias(self, set_=None, remove=()):
+        """Ghi alias vào cấu hình (mã được chuẩn hóa như khi đối chiếu). Lần chạy sau tự có khóa cấu hình mới."""
+        alias = {normalize(k): normalize(v) for k, v in (set_ or {}).items()}
+        alias = {k: v for k, v in alias.items() if k and k != v}
+        with self.cfg_lock:
+            self._reload()
+            cur = self.cfg.data["alias_map"]
+            old = dict(cur)
+            for k in remove: cur.pop(normalize(k), None)
+            cur.update(alias)
+            self._save_catalog()
+            return {"alias": len(cur), "changed": sum(1 for k in cur.keys() | old.keys() if cur.get(k) != old.get(k))}
+
+    def update_bags(self, add=(), remove=()):
+        with self.cfg_lock:
+            self._reload()
+            cur = self.cfg.data["bag_items"]
+            old = set(cur)
+            cur.difference_update(normalize(x) for x in remove)
+            cur.update(x for x in map(normalize, add) if x)
+            self._save_catalog()
+            return {"bags": len(cur), "changed": len(cur ^ old)}
+
+def normalize(text):
+    # Như DataProcessor.normalize / ô tìm kiếm: hoa, bỏ khoảng trắng thừa, NFC
+    import unicodedata
+    return unicodedata.normalize("NFC", " ".join(str(text or "").strip().upper().split()))
+
+def clean(obj):
+    # NaN / inf không hợp lệ trong JSON -> null
+    if isinstance(obj, float): return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict): return {k: clean(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)): return [clean(v) for v in obj]
+    return obj
+
+# -----------------------------------------------------------------------------
+# HTTP
+# -----------------------------------------------------------------------------
+class Handler(BaseHTTPRequestHandler):
+    service = None # ReconcileService, gán trong make_server
+    server_version = "DoiSoat/1.0"
+
+    def log_message(self, fmt, *args):
+        pass # không ghi log mỗi yêu cầu ra stderr
+
+    def _send(self, status, obj):
+        body = json.dumps(clean(obj), ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        if not n: return {}
+        try:
+            data = json.loads(self.rfile.read(n).decode("utf-8"))
+        except ValueError:
+            raise ServiceError("Nội dung không phải JSON")
+        if not isinstance(data, dict): raise ServiceError("Nội dung phải là 1 object JSON")
+        return data
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        q = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        svc = self.service
+        flag = lambda name: q.get(name, "").lower() in ("1", "true", "yes")
+        try:
+            if method == "GET" and parts == ["health"]:
+                return 200, {"ok": True, "workers": len(svc.workers), "cached": len(svc.results), "running": len(svc.running)}
+            if parts == ["runs"]:
+                if method == "POST":
+                    b = self._body()
+                    if not b.get("dh") or not b.get("px"): raise ServiceError("Thiếu dh hoặc px")
+                    res = svc.run(b["dh"], b["px"], b.get("engine"), bool(b.get("force")))
+                    return (200 if res["ok"] else 422), res
+                return 200, {"runs": svc.store.runs(int(q.get("limit", 50)))}
+            if method == "GET" and len(parts) >= 2 and parts[0] == "runs":
+                run_id = int(parts[1])
+                if len(parts) == 2: return 200, svc.run_info(run_id)
+                if len(parts) == 4 and parts[2] == "tab":
+                    return 200, svc.page(run_id, int(parts[3]), int(q.get("offset", 0)), int(q.get("limit", 500)),
+                                         q.get("q", ""), flag("errors"), q.get("sort") or None, flag("desc"))
+                if len(parts) == 3 and parts[2] == "detail":
+                    if "key" not in q or "item" not in q: raise ServiceError("Cần key và item")
+                    return 200, svc.detail(run_id, q["key"], q["item"])
+            if parts == ["alias"]:
+                if method == "POST":
+                    b = self._body()
+                    return 200, svc.update_alias(b.get("set"), b.get("remove") or ())
+                return 200, {"alias": svc.alias()}
+            if parts == ["bags"]:
+                if method == "POST":
+                    b = self._body()
+                    return 200, svc.update_bags(b.get("add") or (), b.get("remove") or ())
+                return 200, {"bags": svc.bags()}
+            return 404, {"error": f"Không có đường dẫn: {method} {url.path}"}
+        except ServiceError as e:
+            return e.status, {"error": str(e)}
+        except ValueError as e: # id / offset / limit không phải số
+            return 400, {"error": str(e)}
+        except Exception as e:
+            return 500, {"error": f"{type(e).__name__}: {e}"}
+
+    def do_GET(self):
+        self._send(*self._dispatch("GET"))
+
+    def do_POST(self):
+        self._send(*self._dispatch("POST"))
+
+def make_server(service, host="127.0.0.1", port=8765):
+    handler = type("BoundHandler", (Handler,), {"service": service})
+    return ThreadingHTTPServer((host, port), handler)
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Dịch vụ đối soát Đơn Hàng / Phiếu Xuất qua HTTP/JSON")
+    ap.add_argument("--config", default=CONFIG_FILE)
+    ap.add_argument("--db", default=RESULT_DB, help="SQLite lưu kết quả (dùng chung với giao diện)")
+    ap.add_argument("--host")
+    ap.add_argument("--port", type=int)
+    ap.add_argument("--workers", type=int, help="số process chạy đối soát")
+    ap.add_argument("--cache-runs", type=int, help="số kết quả nhớ theo (file, cấu hình)")
+    args = ap.parse_args(argv)
+    conf = ConfigManager(args.config).data["service"] # tham số bỏ trống lấy theo cấu hình
+    for k in ("host", "port", "workers", "cache_runs"):
+        if getattr(args, k) is None: setattr(args, k, conf.get(k))
+
+    service = ReconcileService(args.config, args.db, max(1, args.workers), max(1, args.cache_runs))
+    server = make_server(service, args.host, args.port)
+    print(f"Đang nghe http://{args.host}:{server.server_port} ({args.workers} process). Ctrl+C để dừng.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())